@@ -0,0 +1,88 @@
+"""
+Benchmark of the communication type classification.
+
+Compares the former row-by-row implementation of Preprocessor.add_communication_type
+(iterrows, list concatenation per word) with the vectorized LanguageClassifier.
+The row-by-row path is timed on a sample and extrapolated to the full size.
+
+Usage:
+    python benchmarks/communication_type.py --rows 1000000 --legacy-rows 20000
+"""
+import time
+import click
+import numpy as np
+import pandas as pd
+from wa_visualizer.settings import (basicConfig, keywordsFilter)
+from wa_visualizer.language_classifier import LanguageClassifier
+
+
+def make_messages(rows: int, seed: int = 42) -> pd.DataFrame:
+    """
+    Creates random bilingual messages with media, urls and emoji.
+    """
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array(keywordsFilter.dutch_stopwords[:200] + keywordsFilter.italian_stopwords[:200]
+                          + ['fiets', 'school', 'spiaggia', 'Hoi!', 'Ciao?', 'morgen', 'domani'])
+    lengths = rng.integers(1, 12, rows)
+    words = rng.choice(vocabulary, lengths.sum())
+    messages = [" ".join(chunk) for chunk in np.split(words, np.cumsum(lengths)[:-1])]
+    kind = rng.random(rows)
+    messages = np.where(kind < 0.05, "<Media omitted>", messages)
+    messages = np.where((kind >= 0.05) & (kind < 0.07), "kijk https://www.example.com", messages)
+    messages = np.where((kind >= 0.07) & (kind < 0.10), "😀", messages)
+    return pd.DataFrame({
+        basicConfig.message_col: messages,
+        basicConfig.has_emoji_col: kind < 0.12,
+    })
+
+
+def legacy_communication_type(df: pd.DataFrame) -> pd.Series:
+    """
+    Former implementation of Preprocessor.add_communication_type.
+    """
+    strings = keywordsFilter
+    labels = pd.Series(index=df.index, dtype=object)
+    for idx, row in df.iterrows():
+        message = row[basicConfig.message_col]
+        text = message.replace('?', "").replace('!', "").lower().strip().split(" ")
+        if '<Media' in message or 'http' in message or 'www.' in message:
+            labels.at[idx] = basicConfig.nonverbal_cat
+        elif len(text) == 1 and row[basicConfig.has_emoji_col]:
+            labels.at[idx] = basicConfig.nonverbal_cat
+        else:
+            guessed_language = "NL"
+            for word in text:
+                if word in strings.dutch_stopwords + strings.dutch_frequentwords:
+                    guessed_language = "NL"
+                if word in strings.italian_stopwords + strings.italian_frequentwords:
+                    guessed_language = "IT"
+            labels.at[idx] = guessed_language
+    return labels
+
+
+@click.command()
+@click.option("--rows", default=1_000_000, help="Number of messages to classify")
+@click.option("--legacy-rows", default=20_000, help="Sample size for the row-by-row implementation")
+def main(rows, legacy_rows):
+    df = make_messages(rows)
+    classifier = LanguageClassifier(basicConfig, keywordsFilter)
+
+    start = time.perf_counter()
+    labels = classifier(df)
+    vectorized = time.perf_counter() - start
+
+    sample = df.iloc[:legacy_rows]
+    start = time.perf_counter()
+    legacy_labels = legacy_communication_type(sample)
+    legacy = (time.perf_counter() - start) * rows / legacy_rows
+
+    identical = labels.iloc[:legacy_rows].equals(legacy_labels.astype(labels.dtype))
+    print(f"rows:                {rows:,}")
+    print(f"row-by-row (est.):   {legacy:8.1f} s")
+    print(f"vectorized:          {vectorized:8.1f} s")
+    print(f"speedup:             {legacy / vectorized:8.1f} x")
+    print(f"identical labels:    {identical} (on {legacy_rows:,} rows)")
+
+
+if __name__ == "__main__":
+    main()
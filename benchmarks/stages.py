@@ -0,0 +1,220 @@
+"""
+Benchmark of the processing stages on synthetic chats of increasing size.
+
+For every scale a synthetic chat (see synthetic_chat.py) is written to a temporary folder
+and run through the stages of the pipeline: DataCleaner.clean_data, loading the processed
+data, add_communication_type, add_topics, preprocess_week4, saving the data and, when
+sentence-transformers is installed, create_embedding on a sample. Every stage is timed and
+the peak resident memory during the stage is sampled.
+
+The results can be stored as a baseline (json) and later runs are compared with it; a stage
+that is slower than the baseline by more than the tolerance is reported as a regression.
+Baselines depend on the machine, compare runs on the same machine only.
+
+Usage:
+    python benchmarks/stages.py --scales 10k,100k,1M --save-baseline
+    python benchmarks/stages.py --scales 10k,100k,1M --fail-on-regression
+"""
+import importlib.util
+import json
+import resource
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+import click
+from loguru import logger
+from wa_visualizer.settings import (Folders, basicConfig, embeddingSettings, extraRegexes, keywordsFilter)
+from wa_visualizer.data_cleaning import DataCleaner
+from wa_visualizer.data_processing import Preprocessor
+from wa_visualizer.data_writer import dataWriter
+from wa_visualizer.embedding_encoder import BatchEncoder
+from synthetic_chat import SyntheticChat
+
+PAGE_SIZE = resource.getpagesize()
+
+
+class MemorySampler:
+    """
+    Samples the resident memory of the process in a thread, as a context manager.
+
+    Reads /proc/self/statm; where that does not exist the peak is the maximum resident
+    memory of the process so far (getrusage), which only grows.
+
+    Attributes:
+        interval (float): seconds between samples.
+        peak (float): highest resident memory in MB while the context was active.
+    """
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.peak = 0.0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    def rss() -> float:
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * PAGE_SIZE / 1e6
+        except OSError:
+            # kilobytes on Linux, bytes on macOS
+            scale = 1e6 if sys.platform == 'darwin' else 1e3
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+    def sample(self) -> None:
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, self.rss())
+
+    def __enter__(self) -> "MemorySampler":
+        self.peak = self.rss()
+        self.thread = threading.Thread(target=self.sample, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.stopped.set()
+        self.thread.join()
+        self.peak = max(self.peak, self.rss())
+
+
+def parse_scale(scale: str) -> int:
+    """
+    Parses a number of messages such as 10k, 1M or 250000.
+    """
+    scale = scale.strip()
+    factor = {'k': 1_000, 'm': 1_000_000}.get(scale[-1].lower(), 1)
+    return int(float(scale[:-1] if factor > 1 else scale) * factor)
+
+
+def make_folders(folder: Path) -> Folders:
+    raw, processed = folder / 'raw', folder / 'processed'
+    raw.mkdir()
+    processed.mkdir()
+    return Folders(raw=raw, processed=processed, datafile=processed / 'chat.parq',
+                   rawdatafile=raw / 'chat.parq', csv=processed / 'chat.csv', csvraw=raw / 'chat.csv')
+
+
+def run_stages(folder: Path, rows: int, seed: int, embedding_rows: int) -> dict:
+    """
+    Runs the stages on a synthetic chat in folder.
+
+    Args:
+        folder (Path): empty temporary folder
+        rows (int): number of messages
+        seed (int): seed of the synthetic chat
+        embedding_rows (int): sample size of create_embedding, 0 to skip it
+
+    Returns:
+        dict: stage -> {'seconds': duration, 'peak_mb': peak resident memory}
+    """
+    folders = make_folders(folder)
+    SyntheticChat(seed).write(folders.rawdatafile, rows)
+    results = {}
+    state = {}
+
+    def measure(name, stage):
+        with MemorySampler() as memory:
+            start = time.perf_counter()
+            stage()
+            seconds = time.perf_counter() - start
+        results[name] = {'seconds': round(seconds, 4), 'peak_mb': round(memory.peak, 1)}
+
+    def clean():
+        cleaner = DataCleaner(folders, extraRegexes, basicConfig, True)
+        cleaner.clean_data()
+        state['cleaner'] = cleaner
+
+    def save_clean():
+        state.pop('cleaner').save_data()
+        dataWriter.flush()
+
+    def load():
+        processor = Preprocessor(folders, basicConfig, keywordsFilter)
+        # saves are measured separately
+        processor.defer_save = True
+        state['processor'] = processor
+
+    def save():
+        processor = state['processor']
+        processor.defer_save = False
+        processor.save_data()
+        dataWriter.flush()
+
+    def embed():
+        processor = state['processor']
+        subset = processor.data.sample(min(embedding_rows, len(processor.data)), random_state=seed)
+        processor.create_embedding(subset, BatchEncoder(embeddingSettings))
+
+    measure('DataCleaner.clean_data', clean)
+    measure('save cleaned data', save_clean)
+    measure('load processed data', load)
+    measure('add_communication_type', lambda: state['processor'].add_communication_type())
+    measure('add_topics', lambda: state['processor'].add_topics())
+    measure('preprocess_week4', lambda: state['processor'].preprocess_week4())
+    measure('save processed data', save)
+    if embedding_rows:
+        measure('create_embedding', embed)
+    state.clear()
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Lists the stages that are slower than the baseline by more than the tolerance.
+    """
+    regressions = []
+    for scale, stages in results.items():
+        for stage, result in stages.items():
+            reference = baseline.get(scale, {}).get(stage)
+            if reference and result['seconds'] > reference['seconds'] * (1 + tolerance):
+                regressions.append((scale, stage, result['seconds'] / reference['seconds']))
+    return regressions
+
+
+def report(results: dict, baseline: dict) -> None:
+    print(f"{'messages':>10}  {'stage':<26} {'seconds':>9} {'peak MB':>9} {'vs baseline':>12}")
+    for scale, stages in results.items():
+        for stage, result in stages.items():
+            reference = baseline.get(scale, {}).get(stage)
+            ratio = f"{result['seconds'] / reference['seconds']:11.2f}x" if reference and reference['seconds'] else f"{'-':>12}"
+            print(f"{int(scale):>10,}  {stage:<26} {result['seconds']:9.3f} {result['peak_mb']:9.1f} {ratio}")
+
+
+@click.command()
+@click.option("--scales", default="10k,100k,1M", help="Comma separated numbers of messages, e.g. 10k,100k,1M,10M")
+@click.option("--seed", default=42, help="Seed of the synthetic chats")
+@click.option("--baseline", default=Path(__file__).parent / "baselines.json",
+              type=click.Path(dir_okay=False, path_type=Path), help="Baseline results (json)")
+@click.option("--save-baseline", is_flag=True, help="Store the results as the new baseline")
+@click.option("--tolerance", default=0.2, help="Allowed slowdown against the baseline, 0.2 is 20%")
+@click.option("--fail-on-regression", is_flag=True, help="Exit with status 1 when a stage regressed")
+@click.option("--embedding-rows", default=2_000, help="Sample size of create_embedding, 0 to skip it")
+@click.option("--verbose", is_flag=True, help="Show the log of the stages")
+def main(scales, seed, baseline, save_baseline, tolerance, fail_on_regression, embedding_rows, verbose):
+    if not verbose:
+        logger.remove()
+        logger.add(sys.stderr, level="WARNING")
+    if importlib.util.find_spec('sentence_transformers') is None:
+        logger.warning('sentence-transformers is not installed, create_embedding is skipped')
+        embedding_rows = 0
+    results = {}
+    for rows in map(parse_scale, scales.split(',')):
+        with tempfile.TemporaryDirectory() as folder:
+            results[str(rows)] = run_stages(Path(folder), rows, seed, embedding_rows)
+
+    stored = json.loads(baseline.read_text()) if baseline.exists() else {}
+    report(results, stored)
+    if save_baseline:
+        baseline.write_text(json.dumps({**stored, **results}, indent=2))
+        print(f"Baseline saved to {baseline}")
+        return
+    regressions = compare(results, stored, tolerance)
+    for scale, stage, ratio in regressions:
+        print(f"REGRESSION {int(scale):,} messages, {stage}: {ratio:.2f}x the baseline")
+    if regressions and fail_on_regression:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Seeded synthetic WhatsApp chat in the format of the raw datafile.
+
+Four family members (the authors of Preprocessor.dob_mapping) with different activity and a
+different mix of Dutch and Italian, plus an alias of one of them and a system author, both
+handled by DataCleaner. Messages are built from the stopwords, frequent words and topic
+keywords of keywordsFilter and contain emoji, media markers, links, e-mail addresses,
+mentions and deleted messages. Timestamps span several years, follow a daily rhythm and are
+more frequent during the lockdowns.
+
+All columns are generated vectorized (the texts with Arrow kernels) and written in chunks,
+so 10M messages take a few GB of memory at most.
+
+Usage:
+    python benchmarks/synthetic_chat.py --rows 1000000 --output data/raw/synthetic.parq
+"""
+from pathlib import Path
+import click
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from wa_visualizer.settings import (basicConfig, keywordsFilter)
+
+# author -> (share of the messages, share of Italian messages)
+AUTHORS = {
+    'effervescent-camel': (0.30, 0.15),
+    'nimble-wombat': (0.22, 0.70),
+    'hilarious-goldfinch': (0.25, 0.35),
+    'spangled-rabbit': (0.19, 0.10),
+    # alias merged into effervescent-camel and system messages, both removed by the cleaner
+    'funny-bouncing': (0.03, 0.15),
+    'glittering-penguin': (0.01, 0.0),
+}
+# relative number of messages per hour of the day
+HOURS = np.array([2, 1, 0.5, 0.3, 0.2, 0.3, 1, 4, 6, 5, 4, 5, 7, 6, 5, 5, 7, 9, 10, 9, 8, 8, 6, 4], dtype=float)
+LOCKDOWN = ('2020-03-09', '2021-01-15')
+EMOJI = ['😀', '😂', '❤️', '👍', '🙏', '😘', '🍕', '🚂', '🎉', '😴']
+# message kind -> probability; the rest is text
+SPECIAL = {
+    '<Media weggelaten>': 0.05,
+    'https://www.example.com/foto': 0.02,
+    'Dit bericht is verwijderd': 0.01,
+    'mail naar iemand@example.com': 0.005,
+    '@31612345678 kijk even': 0.005,
+}
+
+
+class SyntheticChat:
+    """
+    Generates synthetic raw chat data.
+
+    Attributes:
+        seed (int): seed of the random generator, the same seed gives the same chat.
+        start (str): first day of the chat.
+        end (str): last day of the chat.
+    """
+    def __init__(self, seed: int = 42, start: str = '2018-01-01', end: str = '2023-12-31'):
+        self.seed = seed
+        self.start = pd.Timestamp(start)
+        self.end = pd.Timestamp(end)
+        topics = [word.replace('\\b', '') for words in keywordsFilter.topic_keywords.values() for word in words]
+        self.vocabulary = {
+            'NL': np.array(keywordsFilter.dutch_stopwords + keywordsFilter.dutch_frequentwords + topics),
+            'IT': np.array(keywordsFilter.italian_stopwords + keywordsFilter.italian_frequentwords + topics),
+        }
+
+    def timestamps(self, rng: np.random.Generator, rows: int) -> np.ndarray:
+        """
+        Sorted timestamps with a daily rhythm, more messages in the weekend and during the lockdowns.
+        """
+        days = pd.date_range(self.start, self.end, freq='D')
+        weights = np.where(days.dayofweek >= 5, 1.3, 1.0)
+        weights *= np.where((days >= LOCKDOWN[0]) & (days <= LOCKDOWN[1]), 1.6, 1.0)
+        day = rng.choice(len(days), rows, p=weights / weights.sum())
+        hour = rng.choice(24, rows, p=HOURS / HOURS.sum())
+        seconds = hour * 3600 + rng.integers(0, 3600, rows)
+        timestamps = days.to_numpy()[day] + seconds.astype('timedelta64[s]')
+        return np.sort(timestamps)
+
+    def texts(self, rng: np.random.Generator, italian: np.ndarray) -> pa.Array:
+        """
+        Random sentences of 1 to 15 words, in Italian where italian is True.
+        """
+        rows = len(italian)
+        lengths = np.minimum(rng.geometric(0.18, rows), 15)
+        word_italian = np.repeat(italian, lengths)
+        sizes = np.where(word_italian, len(self.vocabulary['IT']), len(self.vocabulary['NL']))
+        index = (rng.random(len(word_italian)) * sizes).astype(np.int64)
+        words = np.where(word_italian, self.vocabulary['IT'][np.minimum(index, len(self.vocabulary['IT']) - 1)],
+                         self.vocabulary['NL'][np.minimum(index, len(self.vocabulary['NL']) - 1)])
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        sentences = pa.LargeListArray.from_arrays(pa.array(offsets), pa.array(words, type=pa.large_string()))
+        return pc.binary_join(sentences, pa.scalar(' ', pa.large_string()))
+
+    def chunk(self, rng: np.random.Generator, timestamps: np.ndarray) -> pd.DataFrame:
+        """
+        Messages of one chunk of (sorted) timestamps.
+        """
+        rows = len(timestamps)
+        names = list(AUTHORS)
+        shares = np.array([share for share, _ in AUTHORS.values()])
+        author = rng.choice(len(names), rows, p=shares / shares.sum())
+        italian = rng.random(rows) < np.array([share for _, share in AUTHORS.values()])[author]
+        texts = self.texts(rng, italian)
+
+        # emoji after the text, or a message of only emoji
+        kind = rng.random(rows)
+        emoji = pa.array(np.array(EMOJI)[rng.integers(0, len(EMOJI), rows)], type=pa.large_string())
+        with_emoji = pc.binary_join_element_wise(texts, emoji, pa.scalar(' ', pa.large_string()))
+        messages = pc.if_else(pa.array(kind < 0.25), with_emoji, texts)
+        messages = pc.if_else(pa.array(kind > 0.95), emoji, messages)
+
+        special = rng.random(rows)
+        threshold = 0.0
+        for marker, probability in SPECIAL.items():
+            mask = (special >= threshold) & (special < threshold + probability)
+            messages = pc.if_else(pa.array(mask), pa.scalar(marker, pa.large_string()), messages)
+            threshold += probability
+        system = np.array(names)[author] == 'glittering-penguin'
+        messages = pc.if_else(pa.array(system), pa.scalar('Berichten zijn end-to-end versleuteld', pa.large_string()), messages)
+
+        return pd.DataFrame({
+            basicConfig.timestamp_col: timestamps.astype('datetime64[ns]'),
+            basicConfig.author_col: np.array(names)[author],
+            basicConfig.message_col: pd.Series(messages.cast(pa.string()).to_numpy(zero_copy_only=False)),
+            basicConfig.has_emoji_col: (kind < 0.25) | (kind > 0.95),
+        })
+
+    def generate(self, rows: int, chunk_size: int = 1_000_000):
+        """
+        Yields the chat in chunks of consecutive messages.
+
+        Args:
+            rows (int): number of messages
+            chunk_size (int, optional): messages per chunk
+
+        Yields:
+            pd.DataFrame: raw messages with timestamp, author, message and has_emoji
+        """
+        rng = np.random.default_rng(self.seed)
+        timestamps = self.timestamps(rng, rows)
+        for start in range(0, rows, chunk_size):
+            # every chunk has its own stream, so the chat does not depend on the chunk size
+            chunk_rng = np.random.default_rng([self.seed, start])
+            yield self.chunk(chunk_rng, timestamps[start:start + chunk_size])
+
+    def to_pandas(self, rows: int) -> pd.DataFrame:
+        return pd.concat(self.generate(rows), ignore_index=True)
+
+    def write(self, filepath: Path, rows: int, chunk_size: int = 1_000_000) -> Path:
+        """
+        Writes the chat as a raw parquet datafile, chunk by chunk.
+        """
+        writer = None
+        try:
+            for df in self.generate(rows, chunk_size):
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(filepath, table.schema)
+                writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+        return Path(filepath)
+
+
+@click.command()
+@click.option("--rows", default=100_000, help="Number of messages")
+@click.option("--output", default="synthetic.parq", type=click.Path(dir_okay=False, path_type=Path), help="Raw parquet file")
+@click.option("--seed", default=42, help="Random seed")
+def main(rows, output, seed):
+    SyntheticChat(seed).write(output, rows)
+    print(f"Wrote {rows:,} messages to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,246 @@
 import warnings
+from pathlib import Path
 import matplotlib.pyplot as plt  
+from matplotlib.colors import LogNorm
+import numpy as np
 import pandas as pd
 import seaborn as sns
 import streamlit as st
+from wa_visualizer.compact_schema import CompactSchema
+from wa_visualizer.settings import storageSchema
+from wa_visualizer.sketches import (MEASURES, SketchSet)
+from wa_visualizer.search_index import (MANIFEST, SearchIndex)
 
 warnings.simplefilter(action="ignore", category=FutureWarning)
 
+# processed datafile of the visualizer, the cube, sketches and index are named after it
+DATAFILE = Path("../../data/processed/whatsapp-20241030-143002.parq")
+# above this number of rows the plots are aggregated on the server before plotting
+DENSITY_THRESHOLD = 50_000
+# number of bins per numeric axis of the density grid and the histogram
+GRID_BINS = 100
+# categories per axis, the most frequent ones are kept
+MAX_CATEGORIES = 30
+# number of matching messages listed by the search
+SEARCH_RESULTS = 200
+# measures of the aggregate cube: name -> (numerator, denominator) of its columns
+CUBE_MEASURES = {
+    "Messages": ("count", None),
+    "Average message length": ("message_length", "count"),
+    "Emoji share (%)": ("emoji", "count"),
+}
+
+
+def derived(name: str) -> Path:
+    """
+    Path of a file the visualizer derived from the datafile, as Folders.derived.
+    """
+    return DATAFILE.parent / f"{DATAFILE.stem}_{name}"
+
 
 def load_whatsapp_dataset() -> pd.DataFrame:
     """
     Loads the WhatsApp dataset from a specified Parquet file.
 
     This function reads the Parquet file located at the given path and returns it as a Pandas DataFrame.
+    The columns are converted to the compact schema of the visualizer (categoricals, narrow integers and
+    Arrow strings), so much larger chats stay resident in the session.
 
     Returns:
         pd.DataFrame: A DataFrame containing the WhatsApp dataset.
     """
-    datafile = "../../data/processed/whatsapp-20241030-143002.parq"
-    df = pd.read_parquet(datafile)
+    df = CompactSchema(storageSchema).compact(pd.read_parquet(DATAFILE), "dashboard data")
     print(df.columns)  # Prints column names for debugging purposes
     return df
 
 
+def load_cube() -> pd.DataFrame:
+    """
+    Loads the aggregate cube (messages per author and day, and per author, hour, topic and language) written by the visualizer.
+
+    Returns:
+        pd.DataFrame: the cube cells, empty when the visualizer has not built the cube yet.
+    """
+    cubefile = derived("cube.parq")
+    if not cubefile.exists():
+        return pd.DataFrame()
+    return pd.read_parquet(cubefile)
+
+
+def load_sketches() -> SketchSet:
+    """
+    Loads the distribution sketches (t-digests and HyperLogLog) written by the visualizer.
+
+    Returns:
+        SketchSet: the sketches, None when the visualizer has not built them yet.
+    """
+    sketchfile = derived("sketches.parq")
+    if not sketchfile.exists():
+        return None
+    return SketchSet.read(sketchfile)
+
+
+def load_search_index() -> SearchIndex:
+    """
+    Loads the full-text search index written by the visualizer.
+
+    Returns:
+        SearchIndex: the index, None when the visualizer has not built it yet.
+    """
+    indexdir = derived("index")
+    if not (indexdir / MANIFEST).exists():
+        return None
+    return SearchIndex.read(indexdir)
+
+
+def cube_summary(cube: pd.DataFrame, dimension: str, measure: str, hue: str = None) -> pd.DataFrame:
+    """
+    Rolls the cube up to one dimension (and optionally a hue) and computes a measure.
+
+    The day cells of the cube are per author and date, the hour cells per author, hour, topic
+    and language: the day cells are used when the date is a dimension, the hour cells otherwise.
+
+    Args:
+        cube (pd.DataFrame): cube cells
+        dimension (str): key column on the x-axis
+        measure (str): name of the measure in CUBE_MEASURES
+        hue (str, optional): key column for the lines or bars
+
+    Returns:
+        pd.DataFrame: the measure per dimension value, one column per hue value
+    """
+    numerator, denominator = CUBE_MEASURES[measure]
+    keys = [dimension] + ([hue] if hue else [])
+    cells = cube[cube["date"].notna()] if "date" in keys else cube[cube["hour"].notna()]
+    sums = cells.groupby(keys, observed=True)[list({numerator, "count"})].sum()
+    values = sums[numerator] if denominator is None else sums[numerator] / sums[denominator]
+    if numerator == "emoji":
+        values = values * 100
+    return values.unstack(hue) if hue else values.to_frame(measure)
+
+
+def bin_axis(series: pd.Series, bins: int = GRID_BINS, max_categories: int = MAX_CATEGORIES) -> tuple:
+    """
+    Maps the values of a column to grid cells: numeric and datetime columns in equal width bins,
+    other columns per category (the most frequent categories).
+
+    Args:
+        series (pd.Series): column to bin
+        bins (int, optional): number of bins of a numeric column
+        max_categories (int, optional): number of categories kept
+
+    Returns:
+        tuple: cell per row (-1 for missing or dropped values), number of cells and the tick labels per cell
+    """
+    if pd.api.types.is_bool_dtype(series) or not (pd.api.types.is_numeric_dtype(series)
+                                                  or pd.api.types.is_datetime64_any_dtype(series)):
+        top = series.value_counts().index[:max_categories]
+        codes = pd.Categorical(series, categories=top.tolist()).codes.astype(np.int64)
+        return codes, len(top), [str(label) for label in top]
+    is_date = pd.api.types.is_datetime64_any_dtype(series)
+    values = series.to_numpy(dtype='datetime64[ns]').astype(np.int64) if is_date else series.to_numpy(dtype=float)
+    valid = series.notna().to_numpy()
+    if not valid.any():
+        return np.full(len(series), -1, dtype=np.int64), 1, [""]
+    edges = np.histogram_bin_edges(values[valid], bins)
+    codes = np.clip(np.searchsorted(edges, values, side="right") - 1, 0, bins - 1)
+    codes[~valid] = -1
+    centers = (edges[:-1] + edges[1:]) / 2
+    labels = [str(pd.Timestamp(int(c)).date()) for c in centers] if is_date else [f"{c:.3g}" for c in centers]
+    return codes, bins, labels
+
+
+def density_plot(ax, df: pd.DataFrame, x: str, y: str) -> None:
+    """
+    Draws the number of rows per cell of an x/y grid instead of a point per row.
+
+    Args:
+        ax (matplotlib.axes.Axes): axes to draw on
+        df (pd.DataFrame): data
+        x (str): column on the x-axis
+        y (str): column on the y-axis
+    """
+    cx, nx, xlabels = bin_axis(df[x])
+    cy, ny, ylabels = bin_axis(df[y])
+    valid = (cx >= 0) & (cy >= 0)
+    grid = np.bincount(cy[valid] * nx + cx[valid], minlength=nx * ny).reshape(ny, nx)
+    image = ax.imshow(np.ma.masked_equal(grid, 0), origin="lower", aspect="auto", cmap="viridis",
+                      norm=LogNorm(vmin=1, vmax=max(grid.max(), 1)), interpolation="nearest")
+    plt.colorbar(image, ax=ax, label="Number of messages")
+    for set_ticks, set_labels, labels in ((ax.set_xticks, ax.set_xticklabels, xlabels), (ax.set_yticks, ax.set_yticklabels, ylabels)):
+        ticks = np.linspace(0, len(labels) - 1, min(len(labels), 10)).round().astype(int)
+        set_ticks(ticks)
+        set_labels([labels[t] for t in ticks])
+    ax.set_xlabel(x)
+    ax.set_ylabel(y)
+
+
+def histogram_plot(ax, series: pd.Series) -> None:
+    """
+    Draws a histogram from counts computed on the server, with a smoothed density line for numeric columns.
+
+    Args:
+        ax (matplotlib.axes.Axes): axes to draw on
+        series (pd.Series): column to count
+    """
+    codes, n, labels = bin_axis(series)
+    counts = np.bincount(codes[codes >= 0], minlength=n)
+    ax.bar(np.arange(n), counts, width=1.0, alpha=0.6)
+    if pd.api.types.is_numeric_dtype(series) and not pd.api.types.is_bool_dtype(series):
+        # kernel density estimate of the binned counts
+        kernel = np.exp(-0.5 * np.linspace(-3, 3, 13) ** 2)
+        ax.plot(np.arange(n), np.convolve(counts, kernel / kernel.sum(), mode="same"))
+    ticks = np.linspace(0, n - 1, min(n, 10)).round().astype(int)
+    ax.set_xticks(ticks)
+    ax.set_xticklabels([labels[t] for t in ticks])
+    ax.set_xlabel(series.name)
+    ax.set_ylabel("Count")
+
+
+def sketch_histogram_plot(ax, sketches: SketchSet, measure: str) -> None:
+    """
+    Draws a histogram of a measure estimated from its t-digest, without the messages.
+
+    Args:
+        ax (matplotlib.axes.Axes): axes to draw on
+        sketches (SketchSet): distribution sketches
+        measure (str): measure of the sketches, see MEASURES
+    """
+    edges, counts = sketches.histogram(measure, GRID_BINS)
+    ax.bar(edges[:-1], counts, width=np.diff(edges), align="edge", alpha=0.6)
+    ax.set_xlabel(measure)
+    ax.set_ylabel("Count")
+
+
+def box_stats(df: pd.DataFrame, by: str, column: str) -> list:
+    """
+    Computes the box plot statistics per category, the whiskers are clipped to the data range.
+
+    Args:
+        df (pd.DataFrame): data
+        by (str): category column
+        column (str): numeric column
+
+    Returns:
+        list: statistics per category, as used by Axes.bxp
+    """
+    grouped = df.groupby(by, observed=True)[column]
+    quartiles = grouped.quantile([0.25, 0.5, 0.75]).unstack()
+    lowest, highest = grouped.min(), grouped.max()
+    stats = []
+    for label, (q1, median, q3) in quartiles.iterrows():
+        iqr = q3 - q1
+        stats.append({"label": str(label), "q1": q1, "med": median, "q3": q3,
+                      "whislo": max(lowest[label], q1 - 1.5 * iqr), "whishi": min(highest[label], q3 + 1.5 * iqr)})
+    return stats
+
+
 def main() -> None:
     """
     Main function for running the Streamlit app.
 
     This function manages the user interface and controls the different plot types
-    that can be displayed (Scatterplot, Histogram, Boxplot). The function checks
+    that can be displayed (Scatterplot, Histogram, Boxplot, Aggregates, Distributions, Search). The function checks
     the user's plot selection and renders the appropriate visualization.
     It also ensures that the WhatsApp dataset is loaded and cached in the session.
 
@@ -40,12 +253,24 @@ def main() -> None:
         with the dashboard. The dataset is loaded only once and reused for all subsequent interactions.
         """
         st.session_state.whatsapp = load_whatsapp_dataset()
+    if "sketches" not in st.session_state:
+        st.session_state.sketches = load_sketches()
+    sketches = st.session_state.sketches
+    if "search_index" not in st.session_state:
+        st.session_state.search_index = load_search_index()
 
     st.title("Whatsapp Chats Dashboard")
 
+    # Large chats are aggregated on the server, so every interaction draws a fixed number of cells
+    threshold = st.sidebar.number_input("Aggregate plots above (rows)", min_value=0, value=DENSITY_THRESHOLD, step=10_000)
+    aggregate = len(st.session_state.whatsapp) > threshold
+    st.sidebar.caption(f"Data in memory: {CompactSchema.memory(st.session_state.whatsapp) / 2**20:.1f} MB")
+    if aggregate:
+        st.caption(f"{len(st.session_state.whatsapp)} messages: showing aggregated plots")
+
     plot_type = st.radio(
         "Choose a Plot Type", 
-        ["Scatterplot", "Histogram", "Boxplot"],
+        ["Scatterplot", "Histogram", "Boxplot", "Aggregates", "Distributions", "Search"],
         key="plot_type"  # Unique key for the radio button
     )
 
@@ -72,9 +297,13 @@ def main() -> None:
 
         # Plotting the scatter plot
         fig, ax = plt.subplots()
-        sns.scatterplot(data=st.session_state.whatsapp, x=option1, y=option2, hue=color)
+        if aggregate:
+            # density of all messages, the color column is not used
+            density_plot(ax, st.session_state.whatsapp, option1, option2)
+        else:
+            sns.scatterplot(data=st.session_state.whatsapp, x=option1, y=option2, hue=color)
+            ax.legend(bbox_to_anchor=(1.0, 1), loc='upper right')
         plt.xticks(rotation=45, ha="right")
-        ax.legend(bbox_to_anchor=(1.0, 1), loc='upper right')
         st.pyplot(fig)
 
     # Histogram condition
@@ -88,7 +317,13 @@ def main() -> None:
         print(option)  # Debugging output
         # Plotting the histogram
         fig, ax = plt.subplots()
-        sns.histplot(st.session_state.whatsapp[option], kde=True)
+        if aggregate and sketches and option in MEASURES:
+            # estimated from the t-digest of the column
+            sketch_histogram_plot(ax, sketches, option)
+        elif aggregate:
+            histogram_plot(ax, st.session_state.whatsapp[option])
+        else:
+            sns.histplot(st.session_state.whatsapp[option], kde=True)
         plt.xticks(rotation=45, ha="right")
         st.pyplot(fig)
 
@@ -102,7 +337,14 @@ def main() -> None:
         )
         # Plotting the boxplot
         fig, ax = plt.subplots()
-        sns.boxplot(x="author", y=option, data=st.session_state.whatsapp)
+        if aggregate:
+            stats = (sketches.box_stats(option) if sketches and option in MEASURES
+                     else box_stats(st.session_state.whatsapp, "author", option))
+            ax.bxp(stats, showfliers=False)
+            ax.set_xlabel("author")
+            ax.set_ylabel(option)
+        else:
+            sns.boxplot(x="author", y=option, data=st.session_state.whatsapp)
         
         # Rotate the x-axis labels (author names) for better readability
         plt.xticks(rotation=45, ha="right")  # 45 degrees rotation, horizontally aligned to the right
@@ -110,6 +352,77 @@ def main() -> None:
         # Display the plot in the Streamlit app
         st.pyplot(fig)
 
+    # Aggregates condition: answered from the precomputed cube instead of the messages
+    elif plot_type == "Aggregates":
+        if "cube" not in st.session_state:
+            st.session_state.cube = load_cube()
+        if st.session_state.cube.empty:
+            st.warning("No aggregate cube found, run the visualizer first")
+            return
+        dimensions = ["date", "hour", "author", "topic", "language"]
+        dimension = st.selectbox("Select the x-axis", dimensions, index=1, key="cube_dimension")
+        measure = st.selectbox("Select the measure", list(CUBE_MEASURES), key="cube_measure")
+        # the day cells only have the author next to the date, see cube_summary
+        if dimension == "date":
+            hues = ["author"]
+        else:
+            hues = [d for d in dimensions if d != dimension and (d != "date" or dimension == "author")]
+        hue = st.selectbox("Select the color", [None] + hues, key="cube_hue")
+        summary = cube_summary(st.session_state.cube, dimension, measure, hue)
+        fig, ax = plt.subplots()
+        if dimension in ("date", "hour"):
+            summary.plot(ax=ax)
+        else:
+            summary.plot.bar(ax=ax)
+        ax.set_ylabel(measure)
+        plt.xticks(rotation=45, ha="right")
+        st.pyplot(fig)
+
+    # Distributions condition: box plots, vocabulary sizes and emoji from the sketches, in kilobytes
+    elif plot_type == "Distributions":
+        if not sketches:
+            st.warning("No sketches found, run the visualizer first")
+            return
+        measure = st.selectbox("Select the measure", list(MEASURES), key="sketch_measure")
+        by = st.selectbox("Group by", ["author", "year"], key="sketch_by")
+        fig, (box_ax, vocabulary_ax) = plt.subplots(1, 2, figsize=(12, 5))
+        box_ax.bxp(sketches.box_stats(measure, by), showfliers=False)
+        box_ax.set_xlabel(by)
+        box_ax.set_ylabel(measure)
+        box_ax.tick_params(axis="x", labelrotation=45)
+        sketches.vocabulary_size(by).plot.bar(ax=vocabulary_ax)
+        vocabulary_ax.set_ylabel("Distinct words")
+        fig.tight_layout()
+        st.pyplot(fig)
+        st.dataframe(sketches.quantiles(measure, [0.1, 0.25, 0.5, 0.75, 0.9, 0.99], by))
+        st.subheader("Most used emoji")
+        st.dataframe(sketches.emoji_frequencies(by, top=5), hide_index=True)
+
+    # Search condition: full-text search of the messages with the search index, in milliseconds
+    elif plot_type == "Search":
+        index = st.session_state.search_index
+        if index is None:
+            st.warning("No search index found, run the visualizer first")
+            return
+        query = st.text_input("Search the messages (word* for all words starting with it)", key="search_query")
+        authors = st.multiselect("Authors", index.authors, key="search_authors")
+        match_all = st.checkbox("Messages with all words", value=True, key="search_all")
+        if not query:
+            return
+        rows = index.search(query, authors, match_all=match_all)
+        st.caption(f"{len(rows)} messages")
+        if not len(rows):
+            return
+        fig, (author_ax, month_ax) = plt.subplots(1, 2, figsize=(12, 4))
+        index.facet_counts(rows, "author").plot.bar(ax=author_ax)
+        author_ax.set_ylabel("Messages")
+        index.facet_counts(rows, "month").plot(ax=month_ax)
+        fig.tight_layout()
+        st.pyplot(fig)
+        # the latest matches; the dashboard data holds the rows of the datafile
+        shown = rows[rows < len(st.session_state.whatsapp)][-SEARCH_RESULTS:]
+        st.dataframe(st.session_state.whatsapp.iloc[shown][["timestamp", "author", "message"]], hide_index=True)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,256 @@
+import json
+from pathlib import Path
+from loguru import logger
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from wa_visualizer.settings import (Config, Folders, extraRegexes, keywordsFilter)
+from wa_visualizer.stage_cache import StageCache
+from wa_visualizer.time_buckets import TimeBuckets
+
+CUBE_METADATA = b'wa_visualizer.cube'
+# bump when the cells change, a cube with another layout is rebuilt
+CUBE_LAYOUT = 2
+
+
+class AggregateCube:
+    """
+    Materialized aggregate of the messages in two rollups: per author and day (day cells) and
+    per author, hour of the day, topic and language (hour cells). Keying the cells on the day
+    and the hour, topic and language together would leave about a cell per message.
+
+    Every cell holds the number of messages, the sums of the message length and of the log
+    length, the number of messages with emoji and the log length sum of those messages. Both
+    rollups hold all messages, so a query sums the cells of one of them, see days and hours.
+    The cube is stored as parquet next to the processed datafile and is built once from the
+    message-level data; the incremental mode adds new messages to it. All weekly aggregates
+    (and the dashboard summaries) are answered from the cube: there is a day cell per day an
+    author was active, and at most 24 hour cells per author, topic and language.
+
+    The parquet metadata records the number of messages and the first and last timestamp the
+    cube was built from, to detect a cube that no longer matches the data, and a hash of the
+    settings the cells depend on (topic keywords, language word lists and cleaning patterns),
+    so a cube built with other settings is not used. The dates of birth are applied when the
+    cube is queried and are not part of the hash.
+
+    Attributes:
+        folders (Folders): paths of the processed data.
+        config (Config): Configuration object with the column names.
+        settings_hash (str): hash of the settings the cells depend on, see StageCache.hash_settings.
+        path (Path): parquet file of the cube.
+        topics (list): the topics in the order of the topic keywords, the other topic last.
+        cells (pd.DataFrame): the cube, loaded on first use.
+    """
+    def __init__(self, folders: Folders, config: Config, settings: tuple = None):
+        self.folders = folders
+        self.config = config
+        settings = (config, keywordsFilter, extraRegexes) if settings is None else settings
+        self.settings_hash = StageCache.hash_settings((*settings, {'layout': CUBE_LAYOUT}))
+        self.path = folders.derived('cube.parq')
+        self.keys = [config.author_col, config.date_col, config.hour_col, config.topic_col, config.language_col]
+        self.topics = [*keywordsFilter.topic_keywords, config.other_topic]
+        self.cells = None
+
+    def __len__(self) -> int:
+        return len(self.load())
+
+    def __repr__(self) -> str:
+        return f"AggregateCube({self.path.name}, cells={len(self) if self.path.exists() else 0})"
+
+    #******** building *******************
+
+    def build(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Aggregates processed messages into the day and hour cells of the cube.
+
+        Args:
+            df (pd.DataFrame): messages with the author, timestamp, topic, language,
+                message length, log length and has_emoji columns
+
+        Returns:
+            pd.DataFrame: one row per non-empty cell, the day cells without hour, topic and language and the hour cells without date
+        """
+        emoji = df[self.config.has_emoji_col].fillna(False).to_numpy(dtype=bool)
+        log_len = df[self.config.log_length_col].to_numpy(dtype=float)
+        frame = pd.DataFrame({
+            self.config.author_col: df[self.config.author_col].to_numpy(),
+            self.config.date_col: df[self.config.timestamp_col].dt.normalize().to_numpy(),
+            self.config.hour_col: df[self.config.timestamp_col].dt.hour.to_numpy(dtype=np.int8),
+            self.config.topic_col: df[self.config.topic_col].to_numpy(),
+            self.config.language_col: df[self.config.language_col].to_numpy(),
+            'count': np.ones(len(df), dtype=np.int64),
+            'message_length': df[self.config.message_length_col].to_numpy(dtype=np.int64),
+            'log_len': log_len,
+            'emoji': emoji.astype(np.int64),
+            'emoji_log_len': np.where(emoji, log_len, 0.0),
+        })
+        days = self.rollup(frame, [self.config.author_col, self.config.date_col])
+        hours = self.rollup(frame, [self.config.author_col, self.config.hour_col, self.config.topic_col, self.config.language_col])
+        return pd.concat([days, hours], ignore_index=True).astype({self.config.hour_col: 'Int8'})[frame.columns]
+
+    @staticmethod
+    def rollup(frame: pd.DataFrame, keys: list) -> pd.DataFrame:
+        """
+        Sums the measures of the messages per value of the keys.
+        """
+        measures = ['count', 'message_length', 'log_len', 'emoji', 'emoji_log_len']
+        return frame.groupby(keys, observed=True, dropna=False, sort=False)[measures].sum().reset_index()
+
+    def merge(self, cells: pd.DataFrame, update: pd.DataFrame) -> pd.DataFrame:
+        """
+        Adds two sets of cells; all measures are sums.
+        """
+        cells = pd.concat([cells, update], ignore_index=True)
+        return cells.groupby(self.keys, observed=True, dropna=False, sort=False).sum().reset_index()
+
+    @staticmethod
+    def fingerprint(df: pd.DataFrame, timestamp_col: str, previous: dict = None) -> dict:
+        """
+        Number of messages and the first and last timestamp, optionally added to a previous fingerprint.
+        """
+        first, last = df[timestamp_col].min(), df[timestamp_col].max()
+        if previous:
+            first = min(first, pd.Timestamp(previous['first']))
+            last = max(last, pd.Timestamp(previous['last']))
+        rows = len(df) + (previous['rows'] if previous else 0)
+        return {'rows': int(rows), 'first': pd.Timestamp(first).isoformat(), 'last': pd.Timestamp(last).isoformat()}
+
+    #******** storage *******************
+
+    def save(self, cells: pd.DataFrame, fingerprint: dict) -> None:
+        table = pa.Table.from_pandas(cells, preserve_index=False)
+        metadata = dict(table.schema.metadata or {})
+        metadata[CUBE_METADATA] = json.dumps({'fingerprint': fingerprint, 'settings': self.settings_hash}).encode()
+        tmpfile = self.path.with_suffix('.tmp')
+        pq.write_table(table.replace_schema_metadata(metadata), tmpfile)
+        tmpfile.replace(self.path)
+        self.cells = cells
+        logger.info(f'Aggregate cube: {len(cells)} cells for {fingerprint["rows"]} messages')
+
+    def load(self) -> pd.DataFrame:
+        if self.cells is None:
+            self.cells = pd.read_parquet(self.path)
+        return self.cells
+
+    def read_metadata(self) -> dict:
+        if not self.path.exists():
+            return {}
+        metadata = pq.read_schema(self.path).metadata or {}
+        return json.loads(metadata[CUBE_METADATA]) if CUBE_METADATA in metadata else {}
+
+    def stored_fingerprint(self) -> dict:
+        """
+        Fingerprint of the messages of the stored cube, None without a cube or for a cube built with other settings.
+        """
+        stored = self.read_metadata()
+        return stored.get('fingerprint') if stored.get('settings') == self.settings_hash else None
+
+    def is_fresh(self, df: pd.DataFrame) -> bool:
+        """
+        Checks that the stored cube was built from these messages.
+        """
+        return len(df) > 0 and self.stored_fingerprint() == self.fingerprint(df, self.config.timestamp_col)
+
+    def update(self, df: pd.DataFrame) -> None:
+        """
+        Adds new processed messages to the stored cube, see build.
+        """
+        previous = self.stored_fingerprint()
+        cells = self.build(df)
+        if previous is not None:
+            cells = self.merge(self.load(), cells)
+        self.save(cells, self.fingerprint(df, self.config.timestamp_col, previous))
+
+    def refresh(self, df: pd.DataFrame, add_features) -> None:
+        """
+        Rebuilds the cube when it does not match the data.
+
+        Args:
+            df (pd.DataFrame): all processed messages
+            add_features (callable): adds the feature columns to a copy of messages without them
+        """
+        if self.is_fresh(df):
+            return
+        needed = [self.config.topic_col, self.config.language_col, self.config.message_length_col, self.config.log_length_col]
+        # stored feature columns were tagged with the settings of the stored cube
+        stale = self.read_metadata().get('settings', self.settings_hash) != self.settings_hash
+        if all(column in df for column in needed) and not stale:
+            messages = df
+        else:
+            # the features are added to a frame with only the columns they are computed from, not to a copy of all data
+            inputs = [self.config.timestamp_col, self.config.author_col, self.config.message_col, self.config.has_emoji_col]
+            messages = add_features(pd.DataFrame({column: df[column] for column in inputs}, copy=False))
+        self.save(self.build(messages), self.fingerprint(df, self.config.timestamp_col))
+
+    #******** queries *******************
+
+    def days(self) -> pd.DataFrame:
+        """
+        Cells per author and day.
+        """
+        cells = self.load()
+        return cells[cells[self.config.date_col].notna()]
+
+    def hours(self) -> pd.DataFrame:
+        """
+        Cells per author, hour of the day, topic and language.
+        """
+        cells = self.load()
+        return cells[cells[self.config.hour_col].notna()]
+
+    def aggregate_languages(self, verbal_cat: str) -> pd.DataFrame:
+        """
+        Percentage of verbal and non-verbal messages per author, as Preprocessor.aggregate_languages.
+        """
+        cells = self.hours()
+        counts = cells.groupby([self.config.author_col, self.config.language_col])['count'].sum().unstack(fill_value=0)
+        counts[verbal_cat] = counts[['NL', 'IT']].sum(axis=1)
+        counts = counts.drop(['NL', 'IT'], axis=1)
+        percentages = counts.div(counts.sum(axis=1), axis=0) * 100
+        return percentages.sort_values(by=verbal_cat, ascending=False)
+
+    def calc_messages(self, start_date, end_date) -> pd.DataFrame:
+        """
+        Number of messages per ISO week between two dates (start exclusive), as Preprocessor.calc_messages.
+
+        Returns:
+            pd.DataFrame: message count in the timestamp column, indexed by week key, missing weeks are zero
+        """
+        cells = self.days()
+        days = TimeBuckets('day').keys(cells[self.config.date_col])
+        start, end = TimeBuckets('day').keys([start_date, end_date])
+        inside = (days > start) & (days <= end)
+        weeks = TimeBuckets('week')
+        counts = weeks.count(weeks.keys(cells[self.config.date_col][inside]), cells['count'][inside])
+        return counts.astype(np.int64).rename(self.config.timestamp_col).rename_axis(self.config.year_week_col).to_frame()
+
+    def topic_counts(self) -> pd.DataFrame:
+        """
+        Percentage of the messages per topic for every hour of the day, as Preprocessor.normalizeTopicCounts.
+        """
+        cells = self.hours()
+        counts = cells.groupby([cells[self.config.hour_col].astype(int), self.config.topic_col])['count'].sum().unstack(fill_value=0)
+        # the order of the topic keywords, as the tagged data; the figure highlights topics by position
+        counts = counts.reindex(index=range(24), columns=self.topics, fill_value=0)
+        counts.columns = [str(topic).capitalize() for topic in counts.columns]
+        counts.columns.name = None
+        counts.index.name = None
+        return counts.div(counts.sum(axis=1), axis=0) * 100
+
+    def average_log_length(self, dob_mapping: dict, with_emoji: str = 'With Emoji', without_emoji: str = 'Without Emoji') -> pd.DataFrame:
+        """
+        Average log message length per age and emoji status, as the result of Preprocessor.preprocess_week4.
+        """
+        cells = self.days()
+        age = cells[self.config.date_col].dt.year - cells[self.config.author_col].astype(object).map(dob_mapping)
+        sums = cells.assign(**{self.config.age_col: age}).groupby(self.config.age_col)[
+            ['count', 'log_len', 'emoji', 'emoji_log_len']].sum()
+        emoji = pd.DataFrame({self.config.emoji_status_col: with_emoji,
+                              self.config.log_length_col: sums['emoji_log_len'] / sums['emoji'].where(sums['emoji'] > 0)})
+        plain = sums['count'] - sums['emoji']
+        no_emoji = pd.DataFrame({self.config.emoji_status_col: without_emoji,
+                                 self.config.log_length_col: (sums['log_len'] - sums['emoji_log_len']) / plain.where(plain > 0)})
+        result = pd.concat([emoji, no_emoji]).dropna().reset_index()
+        return result.sort_values([self.config.age_col, self.config.emoji_status_col], ignore_index=True)[
+            [self.config.age_col, self.config.emoji_status_col, self.config.log_length_col]]
@@ -1,6 +1,8 @@
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 import pandas as pd
-from wa_visualizer.settings import Config
+from wa_visualizer.settings import (Config, renderSettings)
 from pathlib import Path
 from loguru import logger
 import seaborn as sns
@@ -22,10 +24,14 @@ class BasicPlot:
     filename (str): Filename for saving the plot.
     show_legend (bool): Flag indicating whether to display the legend.
 
+    fig (Figure): Figure of the plot, see new_figure.
+    ax (Axes): Main axes of the plot.
+
     Methods:
     __call__(data, *args, **kwargs): Creates the plot with the provided data.
+    new_figure(figsize, **kwargs): Creates the figure, without pyplot in headless mode.
     show_plot(): Displays the plot with the configured settings.
-    save(): Saves the plot to the specified filename.
+    save(): Saves the plot to the specified filename, in every output format.
     plot(data, *args, **kwargs): Defines how to create the plot, empty in the basicPlot class.
     """    
     def __init__(self, config: Config, title_fig: str, xlabel: str, ylabel: str, filename: str, figsize=(10, 5), show_legend: bool = True, legend_title:str=""):
@@ -41,6 +47,39 @@ class BasicPlot:
         self.color_highlight = self.config.basic_color_highlight
         #set gray scala colors as default
         self.custom_colors = self.config.color_palette 
+        # headless (batch) rendering never opens windows
+        self.headless = renderSettings.headless
+        self.fig = None
+        self.ax = None
+
+    def new_figure(self, figsize=(10, 5), **kwargs):
+        """
+        Creates the figure and axes of the plot.
+
+        In headless mode the figure is drawn on an Agg canvas without pyplot, so figures
+        can be rendered on servers and in worker processes.
+
+        Args:
+            figsize (tuple, optional): size of the figure in inches
+            **kwargs: arguments of Figure.subplots (nrows, ncols)
+
+        Returns:
+            tuple: the figure and the axes
+        """
+        if self.headless:
+            self.fig = Figure(figsize=figsize)
+            FigureCanvasAgg(self.fig)
+            self.ax = self.fig.subplots(**kwargs)
+        else:
+            self.fig, self.ax = plt.subplots(figsize=figsize, **kwargs)
+        return self.fig, self.ax
+
+    def close(self):
+        """
+        Releases the figure from pyplot, a no-op for headless figures.
+        """
+        if self.fig is not None:
+            plt.close(self.fig)
     
     def plot(self, data: pd.DataFrame):
         #to be defined for each plot
@@ -51,23 +90,25 @@ class BasicPlot:
         Shows the plot
         """        
         print(self.title_fig)
-        plt.title(self.title_fig)
-        plt.xlabel(self.xlabel)
-        plt.ylabel(self.ylabel)
-        plt.tight_layout()
+        self.ax.set_title(self.title_fig)
+        self.ax.set_xlabel(self.xlabel)
+        self.ax.set_ylabel(self.ylabel)
+        self.fig.tight_layout()
         if self.show_legend:
-            plt.legend(title=self.legend_title, bbox_to_anchor=(1.0, 1), loc='upper left')
-        plt.show()
-        plt.close()  # Close the figure to free up memory
+            self.ax.legend(title=self.legend_title, bbox_to_anchor=(1.0, 1), loc='upper left')
+        if not self.headless:
+            plt.show()
+        self.close()  # Close the figure to free up memory
 
     @logger.catch
     def save(self):
         """
-        Saves the plot to img folder with given filename
+        Saves the plot to img folder with given filename, once per output format
         """        
-        filepath = self.config.img_dir / Path(self.filename)
-        plt.savefig(filepath, bbox_inches='tight', transparent=False)
-        logger.success(f"Plot saved to: {filepath}")
+        for extension in renderSettings.formats:
+            filepath = (self.config.img_dir / Path(self.filename)).with_suffix(f".{extension}")
+            self.fig.savefig(filepath, bbox_inches='tight', transparent=False, dpi=renderSettings.dpi)
+            logger.success(f"Plot saved to: {filepath}")
         
 
 class BarPlot(BasicPlot):
@@ -108,12 +149,13 @@ class BarPlot(BasicPlot):
         stacked (bool): Stacks the bars if set to true, defult is False
         data(pd.DataFrame): data to plot
         """
-        ax = data.plot(kind='bar', stacked=stacked, figsize=(10, 8), color=self.config.custom_colors)
-        plt.title(self.title_fig)
-        plt.ylabel(self.ylabel)
-        plt.xlabel(self.xlabel)
-        plt.xticks(rotation=45)
-        plt.legend(title=self.legend_title, bbox_to_anchor=(1.05, 1), loc='upper left')
+        _, ax = self.new_figure(figsize=(10, 8))
+        data.plot(kind='bar', stacked=stacked, color=self.custom_colors, ax=ax)
+        ax.set_title(self.title_fig)
+        ax.set_ylabel(self.ylabel)
+        ax.set_xlabel(self.xlabel)
+        ax.tick_params(axis='x', labelrotation=45)
+        ax.legend(title=self.legend_title, bbox_to_anchor=(1.05, 1), loc='upper left')
 
 
 class BasicScatterPlot(BasicPlot):
@@ -0,0 +1,305 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import replace
+from pathlib import Path
+from loguru import logger
+import numpy as np
+import pandas as pd
+from wa_visualizer.settings import (BaseRegexes, BaseStrings, Config, Folders)
+from wa_visualizer.aggregate_cube import AggregateCube
+from wa_visualizer.basic_plots import BarPlot
+from wa_visualizer.data_cleaning import DataCleaner
+from wa_visualizer.data_processing import Preprocessor
+from wa_visualizer.data_writer import dataWriter
+from wa_visualizer.filehandler import FileHandler
+from wa_visualizer.sketches import (SketchSet, SketchStore)
+from wa_visualizer.time_buckets import TimeBuckets
+from wa_visualizer.tracing import tracer
+
+# name of the output folders of the cross-chat tables and figures
+ALL_CHATS = 'all_chats'
+
+
+def process_chat(folders: Folders, regexes: BaseRegexes, config: Config, strings: BaseStrings,
+                 week: str, cache: bool) -> tuple:
+    """
+    Cleans, preprocesses and visualizes one chat, in a worker process.
+
+    The chat is cleaned when it has no processed datafile yet; the figures are written to the
+    image folder of the config. The aggregate cube and the sketches of the chat are brought up
+    to date, the cross-chat tables are built from them. A chat whose figures were not all
+    written is reported with an error.
+
+    Returns:
+        tuple: result of the chat (name, messages, seconds, error) and the trace events of the worker
+    """
+    # visualize imports this module for the batch command
+    from wa_visualizer.visualize import run_visualization_pipeline
+    start = time.perf_counter()
+    name = Path(folders.datafile).stem
+    result = {'chat': name, 'messages': 0, 'seconds': 0.0, 'error': None}
+    try:
+        Path(config.img_dir).mkdir(parents=True, exist_ok=True)
+        if not Path(folders.datafile).exists():
+            DataCleaner(folders, regexes, config, True)()
+            dataWriter.flush()
+        failed = run_visualization_pipeline(folders, week, cache=cache, workers=1, config=config)
+        cube, sketches = AggregateCube(folders, config), SketchStore(folders, config)
+        timestamps = FileHandler(folders, config, columns=[config.timestamp_col]).data
+        if not (cube.is_fresh(timestamps) and sketches.is_fresh(timestamps)):
+            preprocessor = Preprocessor(folders, config, strings)
+            preprocessor.enable_cube(cube)
+            preprocessor.enable_sketches(sketches)
+        result['messages'] = len(timestamps)
+        dataWriter.flush()
+        if failed:
+            result['error'] = f"figures of week {', '.join(failed)} were not written"
+            logger.error(f"Processing chat {name} failed: {result['error']}")
+    except Exception as e:
+        logger.error(f"Processing chat {name} failed: {e}")
+        result['error'] = str(e)
+    result['seconds'] = round(time.perf_counter() - start, 2)
+    return result, tracer.drain()
+
+
+class BatchProcessor:
+    """
+    Processes every chat export in the raw folder, in parallel worker processes.
+
+    Every raw parquet datafile and native .txt export in the raw folder is a chat. A chat gets
+    its own output folders: processed/<chat>/ for the processed data, the cube, the stage cache
+    and the prepared figures, and img/<chat>/ for the figures. The chats are processed in a
+    process pool, one chat per worker; a chat runs its weeks one after another in its worker.
+    A chat that fails is reported and does not stop the others.
+
+    After all chats, the aggregate cubes and the sketches of the chats are combined into
+    cross-chat tables (processed/all_chats/) and figures (img/all_chats/).
+
+    Attributes:
+        raw (Path): folder with the chat exports.
+        processed (Path): folder for the processed chats.
+        config (Config): Configuration object with the column names and the image folder.
+        workers (int): maximum number of worker processes.
+    """
+    def __init__(self, raw: Path, processed: Path, regexes: BaseRegexes, config: Config, strings: BaseStrings,
+                 workers: int = None):
+        self.raw = Path(raw)
+        self.processed = Path(processed)
+        self.regexes = regexes
+        self.config = config
+        self.strings = strings
+        self.workers = workers or os.cpu_count() or 1
+
+    def __call__(self, week: str = 'all', cache: bool = True, pattern: str = '*') -> pd.DataFrame:
+        results = self.run(self.discover(pattern), week, cache)
+        chats = results.loc[results['error'].isna(), 'chat'].tolist()
+        tables = self.aggregate(chats)
+        if tables:
+            self.save(tables)
+            self.plot(tables)
+        return results
+
+    #******** chats *******************
+
+    def discover(self, pattern: str = '*') -> list:
+        """
+        Lists the chat exports in the raw folder.
+
+        Args:
+            pattern (str, optional): glob pattern of the export names, without extension
+
+        Returns:
+            list: Folders of every chat, sorted by name
+        """
+        exports = {}
+        for extension in ('parq', 'txt'):
+            for path in sorted(self.raw.glob(f'{pattern}.{extension}')):
+                # a parquet datafile wins over a .txt export of the same chat
+                exports.setdefault(path.stem, path)
+        return [self.folders(path) for _, path in sorted(exports.items())]
+
+    def folders(self, export: Path) -> Folders:
+        """
+        Paths of the raw and processed data of one chat.
+        """
+        name = export.stem
+        processed = (self.processed / name).resolve()
+        processed.mkdir(parents=True, exist_ok=True)
+        return Folders(
+            raw=self.raw,
+            processed=processed,
+            datafile=processed / f'{name}.parq',
+            rawdatafile=(self.raw / f'{name}.parq').resolve(),
+            csvraw=(self.raw / f'{name}.csv').resolve(),
+            csv=processed / f'{name}.csv',
+            rawtxt=export.resolve() if export.suffix == '.txt' else None,
+        )
+
+    def run(self, chats: list, week: str, cache: bool) -> pd.DataFrame:
+        """
+        Processes the chats in a process pool, see process_chat.
+
+        Args:
+            chats (list): Folders of the chats
+            week (str): week to visualize, or 'all'
+            cache (bool): use the stage cache of every chat
+
+        Returns:
+            pd.DataFrame: per chat the number of messages, the seconds it took and the error, if any
+        """
+        if not chats:
+            logger.warning(f"No chat exports (.parq or .txt) found in {self.raw}")
+            return pd.DataFrame(columns=['chat', 'messages', 'seconds', 'error'])
+        # no writes in flight while forking
+        dataWriter.flush()
+        jobs = [(folders, self.regexes, replace(self.config, img_dir=Path(self.config.img_dir) / Path(folders.datafile).stem),
+                 self.strings, week, cache) for folders in chats]
+        workers = min(self.workers, len(jobs))
+        logger.info(f"Processing {len(jobs)} chats with {workers} workers")
+        results = []
+        if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            for job in jobs:
+                result, events = process_chat(*job)
+                tracer.merge(events)
+                results.append(result)
+        else:
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                futures = [pool.submit(process_chat, *job) for job in jobs]
+                for future in as_completed(futures):
+                    result, events = future.result()
+                    tracer.merge(events)
+                    results.append(result)
+                    logger.info(f"Chat {result['chat']} done: {result['messages']} messages in {result['seconds']} s")
+        results = pd.DataFrame(results).sort_values('chat', ignore_index=True)
+        failed = results['error'].notna().sum()
+        if failed:
+            logger.warning(f"{failed} of {len(results)} chats failed: {', '.join(results.loc[results['error'].notna(), 'chat'])}")
+        return results
+
+    #******** cross-chat aggregates *******************
+
+    def cubes(self, chats: list) -> pd.DataFrame:
+        """
+        Cells of the aggregate cubes of the chats, with a chat column.
+        """
+        frames = []
+        for name in chats:
+            cube = AggregateCube(self.folders(self.raw / f'{name}.parq'), self.config)
+            if cube.path.exists():
+                cells = cube.load()
+                frames.append(cells.assign(chat=name).astype({self.config.author_col: object,
+                                                              self.config.topic_col: object,
+                                                              self.config.language_col: object}))
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+    def aggregate(self, chats: list) -> dict:
+        """
+        Builds the cross-chat tables from the aggregate cubes of the chats.
+
+        Args:
+            chats (list): names of the processed chats
+
+        Returns:
+            dict: table name -> DataFrame
+                - summary: per chat the messages, authors, first and last day, active days,
+                  average message length and the percentages of messages with emoji and non-verbal messages
+                - weekly: messages per ISO week (rows) and chat (columns), weeks without messages are zero
+                - topics: percentage of the messages per topic (columns) of every chat
+                - distributions: quartiles of the message length and reply latency and the vocabulary
+                  size of every chat and of all chats together, see distributions
+        """
+        cells = self.cubes(chats)
+        if cells.empty:
+            return {}
+        config = self.config
+        # both rollups of the cubes hold all messages: the days for the dates, the hours for the topics and languages
+        days = cells[cells[config.date_col].notna()].reset_index(drop=True)
+        hours = cells[cells[config.hour_col].notna()].reset_index(drop=True)
+        grouped = days.groupby('chat')
+        nonverbal = hours['count'].where(hours[config.language_col] == config.nonverbal_cat, 0)
+        summary = pd.DataFrame({
+            'messages': grouped['count'].sum(),
+            'authors': grouped[config.author_col].nunique(),
+            'first day': grouped[config.date_col].min().dt.date,
+            'last day': grouped[config.date_col].max().dt.date,
+            'active days': grouped[config.date_col].nunique(),
+            'average length': grouped['message_length'].sum() / grouped['count'].sum(),
+            'emoji %': grouped['emoji'].sum() / grouped['count'].sum() * 100,
+            'non-verbal %': nonverbal.groupby(hours['chat']).sum() / grouped['count'].sum() * 100,
+        }).sort_values('messages', ascending=False)
+
+        # one week range for all chats, counted per chat on integer week keys
+        weeks = TimeBuckets('week')
+        keys = weeks.keys(days[config.date_col])
+        first, last = keys.min(), keys.max()
+        weekly = pd.DataFrame({chat: weeks.count(keys[index], days['count'].to_numpy()[index], first, last).astype(np.int64)
+                               for chat, index in grouped.indices.items()})
+        weekly.index = weeks.labels(weekly.index).rename(config.year_week_col)
+
+        distributions = self.distributions(summary.index)
+
+        topics = hours.pivot_table(index='chat', columns=config.topic_col, values='count', aggfunc='sum', fill_value=0)
+        topics = topics.div(topics.sum(axis=1), axis=0) * 100
+        topics.columns = [str(topic).capitalize() for topic in topics.columns]
+        return {'summary': summary, 'weekly': weekly, 'topics': topics.loc[summary.index], 'distributions': distributions}
+
+    def distributions(self, chats: list) -> pd.DataFrame:
+        """
+        Message length and reply latency quartiles, vocabulary size and most used emoji per chat, from the sketches of the chats.
+
+        The sketches of all chats are merged for the 'all chats' row: its quartiles, vocabulary
+        and emoji are those of all messages together, not an average of the chats.
+
+        Args:
+            chats (list): names of the processed chats
+
+        Returns:
+            pd.DataFrame: a row per chat and a row for all chats
+        """
+        merged = SketchSet(self.config)
+        rows = {}
+        for name in chats:
+            store = SketchStore(self.folders(self.raw / f'{name}.parq'), self.config)
+            if store.path.exists():
+                sketches = store.load()
+                merged.merge(sketches)
+                rows[name] = sketches
+        rows[ALL_CHATS.replace('_', ' ')] = merged
+        table = {}
+        for name, sketches in rows.items():
+            length = sketches.quantiles('message_length', by=None)
+            latency = sketches.quantiles('latency', by=None)
+            table[name] = {
+                'length q1': length[0.25].iloc[0] if len(length) else np.nan,
+                'length median': length[0.5].iloc[0] if len(length) else np.nan,
+                'length q3': length[0.75].iloc[0] if len(length) else np.nan,
+                'latency median (min)': latency[0.5].iloc[0] / 60 if len(latency) else np.nan,
+                'vocabulary': sketches.vocabulary_size(by=None).sum(),
+                'top emoji': ' '.join(sketches.emoji_frequencies(by=None, top=5)['emoji']),
+            }
+        return pd.DataFrame.from_dict(table, orient='index').rename_axis('chat')
+
+    def save(self, tables: dict) -> Path:
+        """
+        Writes the cross-chat tables as csv to processed/all_chats/.
+        """
+        directory = self.processed / ALL_CHATS
+        directory.mkdir(parents=True, exist_ok=True)
+        for name, table in tables.items():
+            table.to_csv(directory / f'{name}.csv')
+        logger.success(f"Cross-chat tables of {len(tables['summary'])} chats saved to {directory}")
+        return directory
+
+    def plot(self, tables: dict, top: int = 30) -> None:
+        """
+        Draws the cross-chat figures to img/all_chats/: messages per chat and topics per chat, of the largest chats.
+        """
+        config = replace(self.config, img_dir=Path(self.config.img_dir) / ALL_CHATS)
+        config.img_dir.mkdir(parents=True, exist_ok=True)
+        largest = tables['summary'].head(top)
+        BarPlot(config, title_fig="Berichten per chat", ylabel="Aantal berichten", xlabel="Chat",
+                filename="all_chats_messages.png")(largest[['messages']], stacked=False)
+        BarPlot(config, title_fig="Onderwerpen per chat", ylabel="Percentage berichten", xlabel="Chat",
+                filename="all_chats_topics.png", legend_title="Onderwerp")(tables['topics'].loc[largest.index], stacked=True)
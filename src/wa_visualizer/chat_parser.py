@@ -0,0 +1,165 @@
+import re
+from pathlib import Path
+from typing import Iterator
+from loguru import logger
+import pandas as pd
+import pyarrow as pa
+from wa_visualizer.settings import (ChatFormats, Config, chatFormats)
+
+
+class ChatParser:
+    """
+    Streaming parser for native WhatsApp .txt exports.
+
+    The export is read line by line and parsed into Arrow record batches of at most
+    `chunk_size` messages, so memory use depends on the chunk size and not on the size
+    of the chat. Messages spanning several lines are joined, the date layout is detected
+    on the first batch and media placeholders are replaced by a uniform marker.
+
+    Attributes:
+        config (Config): Configuration object with the column names.
+        formats (ChatFormats): Header layouts, date/time formats and media markers.
+        chunk_size (int): Maximum number of messages per record batch.
+        timeformat (str): Detected strptime format, None until the first batch is parsed.
+    """
+    def __init__(self, config: Config, formats: ChatFormats = chatFormats, chunk_size: int = 100_000):
+        self.config = config
+        self.formats = formats
+        self.chunk_size = chunk_size
+        self.timeformat = None
+        self.headers = [re.compile(pattern) for pattern in self.formats.layouts.values()]
+        self.media_pattern = re.compile('|'.join(re.escape(marker) for marker in self.formats.media_markers), re.IGNORECASE)
+        self.schema = pa.schema([
+            (self.config.timestamp_col, pa.timestamp('ns')),
+            (self.config.author_col, pa.string()),
+            (self.config.message_col, pa.string()),
+        ])
+
+    def __call__(self, filepath: Path) -> Iterator[pa.RecordBatch]:
+        return self.iter_batches(filepath)
+
+    #******** help methods *******************
+
+    def match_header(self, line: str):
+        """
+        Match a line against the known header layouts.
+
+        Once a layout matched, it is tried first for the next lines.
+
+        Args:
+            line (str): a single line of the export
+
+        Returns:
+            re.Match: the header match, None for continuation lines
+        """
+        for idx, header in enumerate(self.headers):
+            match = header.match(line)
+            if match:
+                if idx:
+                    # move the detected layout to the front
+                    self.headers.insert(0, self.headers.pop(idx))
+                return match
+        return None
+
+    def detect_timeformat(self, stamps: pd.Series) -> str:
+        """
+        Find the first date/time format combination parsing all timestamps of a batch.
+
+        Args:
+            stamps (pd.Series): timestamp strings as "date time"
+
+        Returns:
+            str: strptime format, falls back to the first combination
+        """
+        for date_format in self.formats.date_formats:
+            for time_format in self.formats.time_formats:
+                timeformat = f"{date_format} {time_format}"
+                if pd.to_datetime(stamps, format=timeformat, errors='coerce').notna().all():
+                    logger.info(f'Detected date layout: {timeformat}')
+                    return timeformat
+        timeformat = f"{self.formats.date_formats[0]} {self.formats.time_formats[0]}"
+        logger.warning(f'Could not detect date layout, using {timeformat}')
+        return timeformat
+
+    def normalize_time(self, time: str) -> str:
+        """
+        Normalize the time part of a header (narrow spaces, a.m./p.m. notation).
+        """
+        time = time.replace('\u202f', ' ').replace('.', '').upper()
+        if time.endswith(('AM', 'PM')) and time[-3] != ' ':
+            time = f"{time[:-2]} {time[-2:]}"
+        return time
+
+    def to_batch(self, stamps: list, authors: list, messages: list) -> pa.RecordBatch:
+        """
+        Convert the collected messages into an Arrow record batch.
+
+        Args:
+            stamps (list): timestamp strings
+            authors (list): author names
+            messages (list): message texts
+
+        Returns:
+            pa.RecordBatch: batch with timestamp, author and message columns
+        """
+        stamps = pd.Series(stamps, dtype=str)
+        if self.timeformat is None:
+            self.timeformat = self.detect_timeformat(stamps)
+        timestamps = pd.to_datetime(stamps, format=self.timeformat, errors='coerce')
+        invalid = timestamps.isna()
+        if invalid.any():
+            logger.warning(f'Dropped {invalid.sum()} messages with unparsable timestamps')
+        valid = ~invalid.to_numpy()
+        return pa.RecordBatch.from_arrays([
+            pa.array(timestamps[valid], type=pa.timestamp('ns')),
+            pa.array(authors, type=pa.string()).filter(pa.array(valid)),
+            pa.array(messages, type=pa.string()).filter(pa.array(valid)),
+        ], schema=self.schema)
+
+    #***************** parsing ***********************
+    def iter_batches(self, filepath: Path) -> Iterator[pa.RecordBatch]:
+        """
+        Stream a WhatsApp .txt export as Arrow record batches.
+
+        A message ends where the next header line starts, so a batch is only flushed
+        when a new message begins and messages are never split across batches.
+        System notices (a header without "author: ") are skipped.
+
+        Args:
+            filepath (Path): path to the .txt export
+
+        Yields:
+            pa.RecordBatch: batches of at most chunk_size messages
+        """
+        stamps, authors, messages = [], [], []
+        current = None  # lines of the message being read
+        skipped = 0
+        with open(filepath, encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.rstrip('\r\n').replace('\u200e', '').lstrip('\ufeff')
+                match = self.match_header(line)
+                if match is None:
+                    # continuation of a multi-line message
+                    if current is not None:
+                        current.append(line)
+                    continue
+                author, sep, text = match.group('rest').partition(': ')
+                if current is not None:
+                    messages[-1] = self.media_pattern.sub(self.formats.media_placeholder, '\n'.join(current))
+                if len(messages) >= self.chunk_size:
+                    yield self.to_batch(stamps, authors, messages)
+                    stamps, authors, messages = [], [], []
+                if not sep:
+                    # system notice without author
+                    skipped += 1
+                    current = None
+                    continue
+                stamps.append(f"{match.group('date')} {self.normalize_time(match.group('time'))}")
+                authors.append(author)
+                messages.append(text)
+                current = [text]
+        if current is not None:
+            messages[-1] = self.media_pattern.sub(self.formats.media_placeholder, '\n'.join(current))
+        if messages:
+            yield self.to_batch(stamps, authors, messages)
+        logger.info(f'Parsed {filepath}, skipped {skipped} system notices')
@@ -0,0 +1,142 @@
+from typing import Iterator
+from loguru import logger
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+from wa_visualizer.settings import (BaseStrings, Config, Folders)
+from wa_visualizer.aggregate_cube import AggregateCube
+from wa_visualizer.data_processing import Preprocessor
+from wa_visualizer.sketches import (SketchSet, SketchStore)
+from wa_visualizer.tracing import traced
+
+
+class ChunkedPreprocessor:
+    """
+    Out-of-core preprocessing: streams the processed store in chunks through the per-message feature stages.
+
+    The processed datafile and its appended parts are read as one dataset, chunk by chunk,
+    with only the columns of the cleaned messages. Every chunk gets all feature columns
+    (see Preprocessor.add_features) and is reduced to aggregate cube cells: counts and sums
+    per author and day and per author, hour, topic and language. The cells of a chunk are merged into the cells
+    so far, so the memory use is bounded by the chunk size and the number of cells, not by
+    the size of the chat. Weeks 1 to 4 are answered from the merged cube.
+
+    The distribution sketches are built chunk by chunk as well and merged the same way.
+
+    Week 5 embeds the verbal messages of at least 20 characters (log length 3); only those
+    messages are kept from every chunk. The messages are not kept for the other weeks.
+
+    The processed data itself is not changed. A stored cube or sketches that match the store
+    (number of messages, first and last timestamp, read from the parquet statistics) are used as they are.
+
+    Attributes:
+        folders (Folders): paths of the processed data.
+        config (Config): Configuration object with the column names.
+        preprocessor (Preprocessor): feature stages, without loaded data.
+        cube (AggregateCube): aggregate cube of the chat.
+        sketches (SketchStore): distribution sketches of the chat.
+        chunk_size (int): number of messages per chunk.
+        filters (ds.Expression): row filter of the processed data, None for all rows.
+    """
+    def __init__(self, folders: Folders, config: Config, strings: BaseStrings, chunk_size: int = 250_000,
+                 filters: ds.Expression = None):
+        self.folders = folders
+        self.config = config
+        self.strings = strings
+        self.preprocessor = Preprocessor(folders, config, strings, load=False)
+        self.cube = AggregateCube(folders, config)
+        self.sketches = SketchStore(folders, config)
+        self.chunk_size = chunk_size
+        self.filters = filters
+
+    def __call__(self, weeks: list) -> Preprocessor:
+        return self.run(weeks)
+
+    #******** processed store *******************
+
+    def dataset(self) -> ds.Dataset:
+        # the datafile and the parts appended by the incremental mode
+        return ds.dataset([str(f) for f in self.preprocessor.data_files()], format='parquet')
+
+    def authors(self, dataset: ds.Dataset) -> list:
+        """
+        All authors of the chat, the people keywords of every chunk; only the author column is read.
+        """
+        authors = pc.unique(dataset.to_table(columns=[self.config.author_col], filter=self.filters)
+                            .column(self.config.author_col).combine_chunks())
+        if pa.types.is_dictionary(authors.type):
+            authors = authors.dictionary_decode()
+        return sorted(author for author in authors.to_pylist() if author is not None)
+
+    def chunks(self, dataset: ds.Dataset) -> Iterator[pd.DataFrame]:
+        """
+        Streams the cleaned messages in chunks, with the compact schema.
+
+        Yields:
+            pd.DataFrame: chunk of at most chunk_size messages
+        """
+        names = [self.config.timestamp_col, self.config.author_col, self.config.message_col, self.config.has_emoji_col]
+        columns = [name for name in names if name in dataset.schema.names]
+        strings = {pa.string(): pd.StringDtype('pyarrow'), pa.large_string(): pd.StringDtype('pyarrow')}
+        for batch in dataset.to_batches(columns=columns, filter=self.filters, batch_size=self.chunk_size):
+            if batch.num_rows:
+                yield self.preprocessor.schema.apply(batch.to_pandas(types_mapper=strings.get))
+
+    #******** chunked preprocessing *******************
+
+    def embedding_subset(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Messages of a chunk embedded in week 5: verbal messages with a log length of at least 3.
+        """
+        verbal = df[self.config.language_col] != self.config.nonverbal_cat
+        return df[verbal.to_numpy() & (df[self.config.log_length_col].to_numpy() >= 3)]
+
+    @traced(category='preprocess')
+    @logger.catch
+    def run(self, weeks: list) -> Preprocessor:
+        """
+        Builds the aggregate cube, the sketches and, for week 5, the messages to embed, chunk by chunk.
+
+        Args:
+            weeks (list): weeks to visualize
+
+        Returns:
+            Preprocessor: preprocessor answering weeks 1 to 4 from the cube, its data holds the week 5 messages
+        """
+        embed = '5' in weeks
+        fingerprint = None if self.filters is not None else self.preprocessor.store_fingerprint()
+        fresh = fingerprint is not None and self.cube.stored_fingerprint() == fingerprint
+        # the sketches of part of the chat are not kept
+        sketched = self.filters is not None or (fingerprint is not None and self.sketches.stored_fingerprint() == fingerprint)
+        cells, subsets, rows = None, [], 0
+        sketches = SketchSet(self.config)
+        if not fresh or not sketched or embed:
+            dataset = self.dataset()
+            authors = self.authors(dataset)
+            for chunk in self.chunks(dataset):
+                if not sketched:
+                    sketches.add(chunk)
+                df = self.preprocessor.add_features(chunk, authors)
+                if not fresh:
+                    update = self.cube.build(df)
+                    cells = update if cells is None else self.cube.merge(cells, update)
+                if embed:
+                    subsets.append(self.embedding_subset(df))
+                rows += len(df)
+                logger.debug(f'Chunk of {len(df)} messages, {rows} messages so far')
+            logger.info(f'Preprocessed {rows} messages in chunks of {self.chunk_size}')
+        if not fresh and cells is not None:
+            if self.filters is None:
+                self.cube.save(cells, fingerprint)
+            else:
+                # the cube of part of the chat is only kept in memory
+                self.cube.cells = cells
+        if not sketched and sketches:
+            self.sketches.save(sketches, fingerprint)
+        data = pd.concat(subsets, ignore_index=True) if subsets else pd.DataFrame()
+        # only part of the data is held, the preprocessor never saves it over the processed data
+        preprocessor = Preprocessor(self.folders, self.config, self.strings, load=False, columns=list(data.columns))
+        preprocessor.data = data
+        preprocessor.cube = self.cube if cells is not None or fresh else None
+        return preprocessor
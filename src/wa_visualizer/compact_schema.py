@@ -0,0 +1,87 @@
+from loguru import logger
+import numpy as np
+import pandas as pd
+from wa_visualizer.settings import StorageSchema
+
+
+class CompactSchema:
+    """
+    Converts the processed data to compact column types.
+
+    Author, language, topic, emoji status and year-week only hold a handful of distinct
+    values and become categoricals (dictionary encoded in parquet); hour, week, age, year
+    and message length fit in narrow integers; the messages become Arrow-backed strings
+    instead of Python objects. Columns that are not in the data are skipped, an integer
+    column with missing values gets the nullable integer type and a column whose values do
+    not fit the narrow type is left as it is.
+
+    Attributes:
+        schema (StorageSchema): column types of the processed data.
+    """
+    def __init__(self, schema: StorageSchema):
+        self.schema = schema
+
+    def __call__(self, df: pd.DataFrame) -> pd.DataFrame:
+        return self.apply(df)
+
+    @staticmethod
+    def memory(df: pd.DataFrame) -> int:
+        """
+        Memory use of the data in bytes, including the contents of object columns.
+        """
+        return int(df.memory_usage(deep=True).sum())
+
+    def integer_type(self, series: pd.Series, dtype: str):
+        """
+        The narrow integer type for a column, or None when the values do not fit.
+        """
+        info = np.iinfo(dtype)
+        values = series.dropna()
+        if len(values) and (values.min() < info.min or values.max() > info.max):
+            logger.warning(f"Column {series.name} does not fit {dtype}, kept as {series.dtype}")
+            return None
+        # nullable integer type (Int8, ...) for columns with missing values
+        return dtype.capitalize() if series.isna().any() else dtype
+
+    def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Converts the columns of the schema in place.
+
+        Args:
+            df (pd.DataFrame): processed data
+
+        Returns:
+            pd.DataFrame: the same data with compact column types
+        """
+        for column in self.schema.categories:
+            if column in df and not isinstance(df[column].dtype, pd.CategoricalDtype):
+                df[column] = df[column].astype('category')
+        for column, dtype in self.schema.integers.items():
+            if column in df and df[column].dtype != dtype:
+                narrow = self.integer_type(df[column], dtype)
+                if narrow is not None:
+                    df[column] = df[column].astype(narrow)
+        for column, dtype in self.schema.floats.items():
+            if column in df and df[column].dtype != dtype:
+                df[column] = df[column].astype(dtype)
+        for column in self.schema.strings:
+            if column in df and df[column].dtype != 'string[pyarrow]':
+                df[column] = df[column].astype('string[pyarrow]')
+        return df
+
+    def compact(self, df: pd.DataFrame, label: str = 'data') -> pd.DataFrame:
+        """
+        Applies the schema and logs the memory use before and after.
+
+        Args:
+            df (pd.DataFrame): processed data
+            label (str, optional): name of the data in the log
+
+        Returns:
+            pd.DataFrame: the same data with compact column types
+        """
+        before = self.memory(df)
+        self.apply(df)
+        after = self.memory(df)
+        logger.info(f"Memory of {label} ({len(df)} messages): {before / 2**20:.1f} MB -> {after / 2**20:.1f} MB")
+        return df
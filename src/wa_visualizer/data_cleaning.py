@@ -2,46 +2,49 @@ import re
 from pathlib import Path
 from loguru import logger
 import pandas as pd
-from wa_visualizer.settings import (BaseRegexes, Folders, Config)
+import pyarrow as pa
+import pyarrow.parquet as pq
+from wa_visualizer.settings import (BaseRegexes, Folders, Config, writeSettings)
 from wa_visualizer.filehandler import FileHandler
+from wa_visualizer.chat_parser import ChatParser
+from wa_visualizer.tracing import traced
+from wa_visualizer.cleaning_engine import CleaningEngine
+from wa_visualizer.search_index import IndexStore
 
 class DataCleaner(FileHandler):
-    def __init__(self, folders: Folders, regexes:BaseRegexes, config:Config, source:str):
-        super().__init__(folders, config, source)
+    def __init__(self, folders: Folders, regexes:BaseRegexes, config:Config, source:str, load:bool=True):
+        super().__init__(folders, config, source, load)
         self.folder = folders
         self.config = config
         self.regexes = regexes
+        self.engine = CleaningEngine(regexes, config)
     
     def __call__(self):
-        self.clean_data()
-        self.save_data()
+        if self.folders.rawtxt is not None:
+            # native export: parse, clean and write chunk by chunk
+            self.clean_stream()
+        else:
+            self.clean_data()
+            self.save_data()
+        # index the cleaned messages for full-text search
+        IndexStore(self.folders, self.config).sync()
 
     #******** help methods *******************
 
     def has_emoji(self, text) -> bool:
         """
-        Detect whether the given text contains any emoji characters.
+        Detect whether the given text contains any emoji sequence.
 
-        This method uses a regular expression to identify a range of emoji characters
-        across various Unicode blocks (extra emoij's patterns added).
+        The text is matched against the full Unicode emoji sequence list, see EmojiMatcher;
+        the trie is built once per process.
 
         Args:
             text (str): The text in which to detect emojis.
 
         Returns:
             bool: True if the text contains at least one emoji, False otherwise.
-        """        
-        emoji_pattern = re.compile("["  # Compile a regex pattern for emoji detection
-            u"\U0001F600-\U0001F64F"  # Emoticons
-            u"\U0001F920-\U0001F9FF"  # Extra missing emoticons
-            u"\U0001F300-\U0001F5FF"  # Symbols & pictographs
-            u"\U0001F680-\U0001F6FF"  # Transport & map symbols
-            u"\U0001F1E0-\U0001F1FF"  # Flags (iOS)
-            u"\U00002702-\U000027B0"  # Dingbats
-            u"\U000024C2-\U0001F251"  # Miscellaneous symbols
-            "]+", flags=re.UNICODE)
-
-        return bool(emoji_pattern.search(text))  # Return True if an emoji is found
+        """
+        return bool(self.engine.has_emoji(pd.Series([text])).iat[0])  # Return True if an emoji is found
 
     @logger.catch
     def find_replace_pattern(self, text:str, pattern:str, replace_str: str='') -> str:
@@ -103,6 +106,7 @@ class DataCleaner(FileHandler):
         return df
 
     #***************** data cleaning steps ***********************
+    @traced(category='clean')
     @logger.catch
     def clean_data(self):
         """
@@ -120,18 +124,59 @@ class DataCleaner(FileHandler):
         Returns:
             None
         """
-        df = self.data.copy()
-        message = self.config.message_col
+        # Update current data
+        self.data = self.clean_chunk(self.data.copy())
+        logger.info('Data has been cleaned')
+
+    def clean_chunk(self, df: pd.DataFrame) -> pd.DataFrame:
+        """
+        Applies the cleaning steps of clean_data to a single DataFrame.
+
+        Args:
+            df (pd.DataFrame): (a chunk of) the raw messages, modified in place
+
+        Returns:
+            pd.DataFrame: the cleaned messages
+        """
         # Delete system messages 
         df = self.delete_system_messages(df, 'glittering-penguin')
         # Merging two users 
         df = self.merge_users(df, 'effervescent-camel', 'funny-bouncing')  
-        # Apply regex patterns removal
-        df[message] = df[message].apply(self.clean_message)
-        empty_messages = df[df[message] == ""].index
-        df.drop(empty_messages, axis=0, inplace=True)
-        # Rerun emoticon detection for missing emojis
-        df[self.config.has_emoji_col] = df[message].apply(self.has_emoji)
-        # Update current data
-        self.data = df
-        logger.info('Data has been cleaned')
+        # Apply regex patterns removal, drop empty messages and rerun emoticon
+        # detection for missing emojis in one vectorized pass
+        return self.engine(df)
+
+    @traced(category='clean')
+    @logger.catch
+    def clean_stream(self, chunk_size: int = 100_000) -> None:
+        """
+        Parses the native .txt export in Arrow record batches and cleans it chunk by chunk.
+
+        Every cleaned chunk is appended to the processed parquet (and, when enabled, csv) files,
+        so peak memory depends on the chunk size and not on the size of the chat.
+
+        Args:
+            chunk_size (int, optional): maximum number of messages per chunk. Defaults to 100_000.
+        """
+        parser = ChatParser(self.config, chunk_size=chunk_size)
+        writer = None
+        total = 0
+        try:
+            for batch in parser(self.folders.rawtxt):
+                df = self.clean_chunk(batch.to_pandas())
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(self.folders.datafile, table.schema, compression=writeSettings.compression,
+                                              compression_level=writeSettings.compression_level)
+                writer.write_table(table, row_group_size=writeSettings.row_group_size)
+                if writeSettings.csv:
+                    df.to_csv(self.folders.csv, index=False, mode='w' if total == 0 else 'a', header=total == 0)
+                total += len(df)
+                logger.info(f'Cleaned chunk of {len(df)} messages ({total} total)')
+        finally:
+            if writer is not None:
+                writer.close()
+        logger.success(f"Data processing completed and saved to:")
+        logger.success(f"- {self.folders.datafile}")
+        if writeSettings.csv:
+            logger.success(f"- {self.folders.csv}")
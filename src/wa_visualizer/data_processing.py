@@ -4,8 +4,19 @@ import datetime
 from loguru import logger
 import pandas as pd
 import numpy as np
-from wa_visualizer.settings import (BaseRegexes, Folders, Config, BaseStrings, keywordsFilter, extraRegexes, basicConfig, Embedding)
+import pyarrow as pa
+from wa_visualizer.settings import (BaseRegexes, Folders, Config, BaseStrings, keywordsFilter, extraRegexes, basicConfig, Embedding, embeddingSettings, mapSettings, writeSettings)
 from wa_visualizer.filehandler import FileHandler
+from wa_visualizer.language_classifier import LanguageClassifier
+from wa_visualizer.topic_tagger import TopicTagger
+from wa_visualizer.stage_cache import (StageCache, cached_stage, file_hash, value_hash)
+from wa_visualizer.embedding_store import EmbeddingStore
+from wa_visualizer.embedding_encoder import BatchEncoder
+from wa_visualizer.embedding_map import EmbeddingMap
+from wa_visualizer.aggregate_cube import AggregateCube
+from wa_visualizer.sketches import SketchStore
+from wa_visualizer.tracing import traced
+from wa_visualizer.time_buckets import TimeBuckets
 
 from sklearn.manifold import TSNE
 
@@ -20,15 +31,100 @@ class Preprocessor(FileHandler):
     Args:
         FileHandler (class): basic data object class
     """
-    def __init__(self, folders: Folders, config:Config, strings :BaseStrings):
-        super().__init__(folders, config)
+    def __init__(self, folders: Folders, config:Config, strings :BaseStrings, load: bool = True,
+                 columns: list = None, filters=None):
+        super().__init__(folders, config, load=load, columns=columns, filters=filters)
         self.folder = folders
         self.config = config
         self.strings = strings
         self.whatsapp_topics={}
+        self.embedding_settings = embeddingSettings
+        self.model_name = embeddingSettings.model_name
+        # stage cache, see enable_cache
+        self.cache = None
+        self.data_hash = None
+        # set by the PipelineScheduler, which saves the merged data of all workers once
+        self.defer_save = False
+        # aggregate cube, see enable_cube
+        self.cube = None
+        # hashed vocabularies are built once
+        self.classifier = LanguageClassifier(config, strings)
+        self.dutch_words = set(self.strings.dutch_stopwords + self.strings.dutch_frequentwords)
+        self.italian_words = set(self.strings.italian_stopwords + self.strings.italian_frequentwords)
         # define dob for this dataset
         self.dob_mapping = {'effervescent-camel': 2002, 'nimble-wombat':1971, 'hilarious-goldfinch':1972, 'spangled-rabbit':2004}
+        # period of the week 2 time series, and from the start of the first lockdown to the end of the second
+        self.period = ('2019-01-01', '2023-01-01')
+        self.lockdown = ('2020-03-09', '2021-01-15')
     
+    def enable_cache(self, cache: StageCache) -> None:
+        """
+        Caches the results of the preprocess_weekN stages, keyed on the content of the loaded data.
+
+        Args:
+            cache (StageCache): on-disk stage cache
+        """
+        self.cache = cache
+        self.data_hash = cache.resolve(file_hash(*self.data_files()))
+        if self.filters is not None:
+            # the stages see only the filtered rows
+            self.data_hash = value_hash([self.data_hash, str(self.filters)])
+
+    @traced(category='cube')
+    def enable_cube(self, cube: AggregateCube) -> None:
+        """
+        Answers the weekly aggregates from an aggregate cube, rebuilt first when it does not match the data.
+
+        With only part of the data loaded the cube is used when it matches the data, but never rebuilt.
+
+        Args:
+            cube (AggregateCube): aggregate cube of this chat
+        """
+        if self.partial:
+            if cube.is_fresh(self.data):
+                self.cube = cube
+            else:
+                logger.info('Aggregate cube does not match the loaded data, computing from the messages')
+            return
+        cube.refresh(self.data, self.add_features)
+        self.cube = cube
+
+    @traced(category='cube')
+    def enable_sketches(self, store: SketchStore) -> None:
+        """
+        Rebuilds the distribution sketches of the chat when they do not match the data.
+
+        The sketches need the author, timestamp and message of every message; with a row filter
+        or without those columns loaded they are left as they are.
+
+        Args:
+            store (SketchStore): sketches of this chat
+        """
+        needed = [self.config.author_col, self.config.timestamp_col, self.config.message_col]
+        if self.filters is not None or not all(column in self.data for column in needed):
+            return
+        store.refresh(self.data)
+
+    def parse_date(self, date: str) -> datetime.date:
+        return datetime.datetime.strptime(date, self.config.timeformat).date()
+
+    def save_data(self) -> None:
+        """
+        Saves the data, unless the pipeline scheduler saves it at the end.
+        """
+        if self.defer_save:
+            logger.debug('Saving deferred to the pipeline scheduler')
+            return
+        super().save_data()
+
+    def saved(self, parts: list) -> None:
+        """
+        With a stage cache, the written file is registered as derived from the loaded data.
+        """
+        super().saved(parts)
+        if self.cache is not None and self.data_hash is not None:
+            self.cache.alias(file_hash(*self.data_files()), self.data_hash)
+
     #def __call__(self):
        #  self.preprocess()
        #  self.save_data()
@@ -115,63 +211,68 @@ class Preprocessor(FileHandler):
     #     """        
     #     df.loc[df[self.config.author_col]==author2, 'author'] = author1
     #     return df
+    @traced(category='preprocess')
     @logger.catch
     def add_communication_type(self) -> None:
         """
-        Defines communication category (IT, NL or Non-Verbal)
+        Defines communication category (IT, NL or Non-Verbal) for all messages at once
         """        
+        self.data[self.config.language_col] = self.classifier(self.data)
 
-        for idx, row in self.data.iterrows():
-            #remove ? and !, make message lower case
-            text=row.message.replace('?', "").replace('!', "").lower()
-            text=text.strip().split(" ") 
-            # Check for non-verbal indicators
-            if '<Media' in row.message or 'http' in row.message or 'www.' in row.message:
-                self.data.at[idx, self.config.language_col] = self.config.nonverbal_cat
-            elif len(text) == 1 and row[self.config.has_emoji_col]:
-                self.data.at[idx, self.config.language_col] = self.config.nonverbal_cat            
-            else:
-                # detect language 
-                self.data.at[idx, self.config.language_col] = self.detect_language(text)
+    @traced(category='preprocess')
     @logger.catch
-    def process_dates(self) -> None:
+    def process_dates(self, df: pd.DataFrame = None) -> None:
         """
-        Adds dates information to the dataframe
+        Adds dates information to the dataframe: the day, the ISO week number and the ISO year-week.
+
+        All columns are derived from integer day and week keys (see TimeBuckets); the
+        year-week labels are made once per week and stored as a categorical.
+
+        Args:
+            df (pd.DataFrame, optional): data to change, defaults to the current data
         """            
-        self.data[self.config.date_col] = self.data[self.config.timestamp_col].dt.date
-        self.data[self.config.isoweek_col] = self.data[self.config.timestamp_col].dt.isocalendar().week
-        self.data[self.config.year_week_col] = self.data[self.config.timestamp_col].dt.strftime("%Y-%W")
+        df = self.data if df is None else df
+        timestamps = df[self.config.timestamp_col]
+        days = TimeBuckets('day').keys(timestamps)
+        weeks = TimeBuckets('week')
+        keys = weeks.keys(timestamps)
+        df[self.config.date_col] = pd.arrays.ArrowExtensionArray(pa.array(days.astype(np.int32), pa.date32()))
+        df[self.config.isoweek_col] = weeks.week_numbers(keys)
+        first = keys.min() if len(keys) else 0
+        labels = weeks.labels(np.arange(first, keys.max() + 1)) if len(keys) else []
+        df[self.config.year_week_col] = pd.Categorical.from_codes(keys - first, categories=labels)
+
     @logger.catch
     def select_dates(self, df, start_date, end_date) -> None:
         if 'date' in df:
-            # Select DataFrame rows between two dates
-            mask = (df['date'] > start_date) & (df['date'] <= end_date)
-            return df.loc[mask]
+            # Select DataFrame rows between two dates, on integer day keys
+            buckets = TimeBuckets('day')
+            start, end = buckets.keys([start_date, end_date])
+            days = buckets.keys(df[self.config.timestamp_col])
+            return df.loc[(days > start) & (days <= end)]
         else:
             logger.info('No date column to select')
             return None
+    @traced(category='preprocess')
     @logger.catch
     def calc_messages(self, df):
         """
         Calculate the number of messages per ISO week.
 
-        This method groups the provided DataFrame by ISO weeks and counts the number
-        of messages for each week. It also creates a complete index of weeks within 
-        the range of timestamps in the dataset, filling in missing weeks with a count of zero.
+        The messages are counted per integer week key (see TimeBuckets) for every week
+        from the first to the last message, so weeks without messages have a count of zero.
+        The weeks get their 'year-week' labels when the figure is drawn.
 
         Args:
             df (pd.DataFrame): The DataFrame containing message data, which includes 
                             a timestamp column.
 
         Returns:
-            pd.Series: A Series indexed by year-week, representing the count of messages 
-                        for each week. Missing weeks are filled with zeros.
-        """
-        p = df.groupby("year-week").count()  # Group by the ISO weeks and count messages
-        min_ts = df[self.config.timestamp_col].min()  # Get the minimum timestamp
-        max_ts = df[self.config.timestamp_col].max()  # Get the maximum timestamp
-        new_index = pd.date_range(start=min_ts, end=max_ts, freq='W', name="year-week").strftime('%Y-%W')  # Create a new index for weeks
-        return p.reindex(new_index, fill_value=0)  # Reindex with new index, filling missing weeks with zero
+            pd.DataFrame: message count in the timestamp column, indexed by week key.
+        """
+        buckets = TimeBuckets('week')
+        counts = buckets.count(buckets.keys(df[self.config.timestamp_col]))
+        return counts.rename(self.config.timestamp_col).rename_axis(self.config.year_week_col).to_frame()
     
     @logger.catch
     def calculate_percentage(self, counts:pd.Series, total_counts:pd.Series)->pd.Series:
@@ -188,6 +289,7 @@ class Preprocessor(FileHandler):
         """
         # Calculates percentages from counts and total
         return (counts.div(total_counts, axis=0) * 100)  # Compute percentage
+    @traced(category='preprocess')
     @logger.catch
     def aggregate_languages(self, data:pd.DataFrame)->pd.DataFrame:
         """
@@ -204,7 +306,7 @@ class Preprocessor(FileHandler):
                         percentages of verbal communication, sorted by the 'Verbal' counts.
         """
         # Grouping by author and language, counting occurrences
-        user_language_counts = data.groupby([self.config.author_col, self.config.language_col]).size().unstack(fill_value=0)
+        user_language_counts = data.groupby([self.config.author_col, self.config.language_col], observed=True).size().unstack(fill_value=0)
 
         # Combine 'NL' and 'IT' language counts into a new 'Verbal' category
         user_language_counts[self.config.verbal_cat] = user_language_counts[['NL', 'IT']].sum(axis=1)
@@ -240,10 +342,10 @@ class Preprocessor(FileHandler):
         guessed_language= "NL"
         for word in text:
             # if word is in dutch string return language NL      
-            if word in self.strings.dutch_stopwords+self.strings.dutch_frequentwords:
+            if word in self.dutch_words:
                 guessed_language = "NL"
             # if word is in Italian string return language IT          
-            if word in self.strings.italian_stopwords+self.strings.italian_frequentwords:
+            if word in self.italian_words:
                 guessed_language = "IT"
         #print(f"guessed_language is {guessed_language}")    
         return guessed_language
@@ -282,48 +384,43 @@ class Preprocessor(FileHandler):
         # Return the filtered DataFrame with only the rows assigned the topic
         return df[df[self.config.topic_col] == topic]
 
+    @traced(category='preprocess')
     def add_topics(self) -> dict:
         """
         Adds topics to the data based on predefined keywords.
 
-        This method filters the DataFrame by keywords associated with each topic, categorizing the data accordingly.
+        All messages are scanned once by a TopicTagger holding the keywords of every topic;
+        a message gets the first matching topic in the order of the keywords dict.
         It also adds the author names to the list of keywords under the 'people' category. 
         Remaining rows are classified as 'other'. The modified DataFrame is saved, and a CSV file is created
         containing the original data with the assigned topics.
 
         Returns:
-            dict: A dictionary containing filtered DataFrames for each topic, including an 'other' category
+            dict: A dictionary containing the hours of the messages for each topic, including an 'other' category
                 for any messages that do not match predefined topics.
         """
-        df = self.data.copy()
-        df[self.config.hour_col] = df[self.config.timestamp_col].dt.hour
-        keywords = self.strings.topic_keywords
+        self.data[self.config.hour_col] = self.data[self.config.timestamp_col].dt.hour
+        keywords = dict(self.strings.topic_keywords)
         # Add author names to the people keywords
         keywords[self.config.people_topic] = self.data.author.unique().tolist() + keywords[self.config.people_topic]
-        
-        # Initialize an empty dictionary to hold filtered DataFrames
-        filtered_dfs = {topic: None for topic in keywords.keys()}
 
-        for topic, words in keywords.items():
-            filtered_dfs[topic] = self.filter_by_keywords(df, words, topic)
-            df = df[df[self.config.topic_col] != topic]  # Remove rows already categorized
-        
-        # Remaining rows are classified as 'other'
-        filtered_dfs[self.config.other_topic] = df
-        df_all = pd.concat(filtered_dfs.values(), ignore_index=True)
-        
-        # save data only if all strings are included
-        if df_all.shape[0] == self.data.shape[0]:
-            self.data = df_all
-            file_topics = self.folders.processed / Path(self.folders.datafile).stem
-            #save to a specific csv
-            df_all.to_csv(f"{file_topics}_with_topics.csv", index=False)
-            self.save_data()
-        else:
-            logger.info('Could not add topics to dataframe')
+        # Tag all messages in one pass
+        tagger = TopicTagger(self.config, keywords, self.config.other_topic)
+        self.data[self.config.topic_col] = tagger(self.data[self.config.message_col])
+
+        topics = self.data[self.config.topic_col]
+        filtered_dfs = {topic: self.data.loc[topics == topic, [self.config.hour_col]]
+                        for topic in [*keywords.keys(), self.config.other_topic]}
+
+        file_topics = self.folders.processed / Path(self.folders.datafile).stem
+        #save to a specific csv, in the background
+        if writeSettings.csv:
+            self.writer.save_csv(self.data.copy(deep=False), Path(f"{file_topics}_with_topics.csv"))
+        self.save_data()
 
         return filtered_dfs
 
+    @traced(category='preprocess')
     def normalizeTopicCounts(self, filtered_dfs:dict)->pd.DataFrame:
         """
         Normalizes topic counts from filtered DataFrames.
@@ -413,7 +510,9 @@ class Preprocessor(FileHandler):
     #     self.save_data()
         
     #***************** preprocessing functions for each visualization ***********************
+    @traced(category='preprocess')
     @logger.catch
+    @cached_stage('language_col')
     def preprocess_week1(self)->pd.DataFrame:
         """
         Preprocesses data for the first visualization.
@@ -428,7 +527,9 @@ class Preprocessor(FileHandler):
         self.add_communication_type()
         return self.aggregate_languages(self.data)
 
+    @traced(category='preprocess')
     @logger.catch
+    @cached_stage('date_col', 'isoweek_col', 'year_week_col')
     def preprocess_week2(self, startdate :str ='2019-01-01', enddate :str ='2023-01-01'):
         """
         Preprocess the dataset for week 2 by selecting data within specific date ranges.
@@ -449,22 +550,17 @@ class Preprocessor(FileHandler):
         self.process_dates()          
 
         # Select dataset for the specified date range (corona time - start period)
-        start_date = datetime.datetime.strptime(startdate, self.config.timeformat).date()
-        end_date = datetime.datetime.strptime(enddate, self.config.timeformat).date()
-        df = self.select_dates(self.data, start_date, end_date)
+        df = self.select_dates(self.data, self.parse_date(startdate), self.parse_date(enddate))
 
-        # Define the start date for the first lockdown
-        start_date = datetime.datetime.strptime('2020-03-09', self.config.timeformat).date()
-        # Define the end date for the second lockdown
-        end_date = datetime.datetime.strptime('2021-01-15', self.config.timeformat).date()
-
-        # Select corona data for the specified lockdown period
-        df_corona = self.select_dates(self.data, start_date, end_date)
+        # Select corona data from the start of the first lockdown to the end of the second lockdown
+        df_corona = self.select_dates(self.data, *map(self.parse_date, self.lockdown))
 
         # Return the DataFrames containing corona data and the full dataset
         return df_corona, df
 
+    @traced(category='preprocess')
     @logger.catch
+    @cached_stage('hour_col', 'topic_col')
     def preprocess_week3(self):
         """
         Preprocess the dataset for week 3 by adding topics and normalizing topic counts.
@@ -485,26 +581,22 @@ class Preprocessor(FileHandler):
 
         # Return the DataFrame with normalized topic counts
         return df_normalized
-    @logger.catch
-    def preprocess_week4(self):
+    @traced(category='preprocess')
+    def add_message_stats(self, df: pd.DataFrame) -> pd.DataFrame:
         """
-        Preprocess the dataset for week 4 by extracting relevant features and calculating statistics.
+        Adds year, age, message length, log length and emoji status columns.
 
-        This method performs several data transformations, including extracting the year from timestamps,
-        calculating ages, message lengths, and categorizing messages based on emoji presence.
+        Args:
+            df (pd.DataFrame): data to change
 
         Returns:
-            pd.DataFrame: A DataFrame containing the average logarithmic message length grouped by age and emoji status.
+            pd.DataFrame: data with the new columns
         """
-        logger.info('Start preprocess week 4')
-        # Create a copy of the original data to avoid modifying it directly
-        df = self.data.copy()
-
         # Extract the year from the timestamp column and create a new year column
         df[self.config.year_col] = df[self.config.timestamp_col].dt.year
 
         # Map authors to their dates of birth using the dob_mapping dictionary
-        df['dob'] = df[self.config.author_col].map(self.dob_mapping)
+        df['dob'] = df[self.config.author_col].astype(object).map(self.dob_mapping)
 
         # Calculate age by subtracting the date of birth from the year
         df[self.config.age_col] = df[self.config.year_col] - df['dob']
@@ -512,8 +604,10 @@ class Preprocessor(FileHandler):
         # Drop the temporary 'dob' column as it is no longer needed
         df.drop(['dob'], inplace=True, axis=1)
 
-        # Add a new column for message length by calculating the length of each message
-        df[self.config.message_length_col] = df[self.config.message_col].str.len()
+        # Add a new column for message length by calculating the length of each message,
+        # loaded without the messages the stored length is used
+        if self.config.message_col in df or self.config.message_length_col not in df:
+            df[self.config.message_length_col] = df[self.config.message_col].str.len()
 
         # Calculate the logarithm of message lengths, handling cases where length is zero
         df[self.config.log_length_col] = df[self.config.message_length_col].apply(lambda x: np.log(x) if x > 0 else 0)
@@ -521,39 +615,92 @@ class Preprocessor(FileHandler):
         # Create a new column to indicate whether messages contain emojis
         df[self.config.emoji_status_col] = df[self.config.has_emoji_col].apply(lambda x: 'With Emoji' if x > 0 else 'Without Emoji')
 
+        return df
+
+    @traced(category='preprocess')
+    def add_features(self, df: pd.DataFrame, authors: list = None) -> pd.DataFrame:
+        """
+        Adds all per-message columns of the weekly preprocessing steps to (a chunk of) the data:
+        communication type, dates, hour, topic, year, age, message length and emoji status.
+
+        Args:
+            df (pd.DataFrame): cleaned messages
+            authors (list, optional): all known authors, used as people keywords. Defaults to the authors in df.
+
+        Returns:
+            pd.DataFrame: messages with all feature columns
+        """
+        df[self.config.language_col] = self.classifier(df)
+        self.process_dates(df)
+        df[self.config.hour_col] = df[self.config.timestamp_col].dt.hour
+        keywords = dict(self.strings.topic_keywords)
+        authors = df[self.config.author_col].unique().tolist() if authors is None else list(authors)
+        keywords[self.config.people_topic] = authors + keywords[self.config.people_topic]
+        tagger = TopicTagger(self.config, keywords, self.config.other_topic)
+        df[self.config.topic_col] = tagger(df[self.config.message_col])
+        return self.add_message_stats(df)
+
+    @traced(category='preprocess')
+    @logger.catch
+    @cached_stage('year_col', 'age_col', 'message_length_col', 'log_length_col', 'emoji_status_col')
+    def preprocess_week4(self):
+        """
+        Preprocess the dataset for week 4 by extracting relevant features and calculating statistics.
+
+        This method performs several data transformations, including extracting the year from timestamps,
+        calculating ages, message lengths, and categorizing messages based on emoji presence.
+
+        Returns:
+            pd.DataFrame: A DataFrame containing the average logarithmic message length grouped by age and emoji status.
+        """
+        logger.info('Start preprocess week 4')
+        # Add year, age, message length and emoji status, in place instead of on a full copy of the data
+        df = self.add_message_stats(self.data)
+
         # Save the modified dataset back to the instance variable
         self.data = df
         self.save_data()  # Save the updated data to persistent storage
 
         # Calculate the average logarithmic message length per age and emoji status
-        avg_log_df = df.groupby([self.config.age_col, self.config.emoji_status_col])[self.config.log_length_col].mean().reset_index()
+        avg_log_df = df.groupby([self.config.age_col, self.config.emoji_status_col], observed=True)[self.config.log_length_col].mean().reset_index()
 
         return avg_log_df  # Return the resulting DataFrame
 
-    def create_embedding(self, subset, model):   
-        metadata = {}
-        text = []
-        for idx, row in subset.iterrows():
-            author = row["author"]
-            message = row["message"]
-            timestamp = row["timestamp"]
-            topic = row["topic"]
-            language = row["language"]
-            age = row["age"]
-            metadata[idx] = {"author": author, "message": message, "timestamp": timestamp, "topic": topic, 
-            "language": language, 'age': age}
-            text.append(message)
+    @traced(category='preprocess')
+    def create_embedding(self, subset, model, store: EmbeddingStore = None):
+        """
+        Creates the embeddings of the messages in the subset, with their metadata.
+
+        Args:
+            subset (pd.DataFrame): messages to embed
+            model: sentence embedding model with an encode method
+            store (EmbeddingStore, optional): persistent store; only messages not yet stored are encoded.
+
+        Returns:
+            Embedding: metadata per message and the vectors
+        """
+        columns = ["author", "message", "timestamp", "topic", "language", "age"]
+        metadata = subset[columns].to_dict('index')
+        text = subset["message"].tolist()
         #embed text
-        vectors = model.encode(text)
+        if store is None:
+            vectors = model.encode(text)
+        else:
+            vectors = store.encode(text, model)
         print(f'Embedding done: {vectors.shape}')
         return Embedding(metadata, vectors)
 
+    @traced(category='preprocess')
     def fit_tsne(self, emb, n_components=2, learning_rate=200, perplexity=30, n_iter=1000):
-        #tsne = TSNE(n_components=2)
-        tsne =TSNE(n_components=2, learning_rate=learning_rate, perplexity=perplexity, n_iter=n_iter)
+        """
+        Fits an exact t-SNE on all vectors, only practical for small subsets; see EmbeddingMap.
+        """
+        tsne = TSNE(n_components=n_components, learning_rate=learning_rate, perplexity=perplexity, max_iter=n_iter)
         X = tsne.fit_transform(emb.vectors)
         return X
 
+    @traced(category='preprocess')
+    @cached_stage()
     def preprocess_week5(self, subset:pd.DataFrame):
         """
         Preprocess the data for week 5 by creating embeddings and applying t-SNE.
@@ -566,12 +713,23 @@ class Preprocessor(FileHandler):
                 - X (np.ndarray): The 2D representation of the data after t-SNE transformation.
                 - emb (np.ndarray): The embeddings generated from the input subset.
         """
-        # Load the pre-trained SentenceTransformer model
-        model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        # Length-bucketed batches, encoded by a pool of workers that each load the model
+        model = BatchEncoder(self.embedding_settings)
+        # Reuse embeddings of earlier runs, keyed by message text and model
+        store = EmbeddingStore(Path(self.folders.datafile).parent / 'embeddings', self.model_name)
         # Create embeddings for the input subset using the loaded model
-        emb = self.create_embedding(subset, model)
-        # Apply t-SNE to the embeddings to reduce dimensionality for visualization
-        X = fit_tsne(emb, learning_rate=300, perplexity=15, n_iter=2000)
+        emb = self.create_embedding(subset, model, store)
+        # Fit t-SNE on a stratified sample once, project all other (and later) messages into the same map;
+        # the map is fitted again when the map settings changed or its sample is not in the messages
+        map_file = store.directory / 'tsne_map.npz'
+        keys = store.hash_texts(subset["message"].tolist())
+        embedding_map = EmbeddingMap.load(map_file, mapSettings) if map_file.exists() else None
+        if embedding_map is None or not embedding_map.matches(keys):
+            if embedding_map is not None:
+                logger.info('The t-SNE map does not match the settings or the messages, fitting a new map')
+            embedding_map = EmbeddingMap(mapSettings).fit(emb.vectors, subset[mapSettings.stratify_col].to_numpy(), keys)
+            embedding_map.save(map_file)
+        X = embedding_map.transform(emb.vectors)
 
         return X, emb
 
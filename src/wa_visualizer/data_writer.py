@@ -0,0 +1,143 @@
+import csv
+import itertools
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from pathlib import Path
+from loguru import logger
+import pandas as pd
+from wa_visualizer.settings import (WriteSettings, writeSettings)
+from wa_visualizer.stage_cache import value_hash
+
+
+class DataWriter:
+    """
+    Writes the processed data in a background thread.
+
+    Saving only queues a write and returns; a single writer thread writes the queued files
+    in order. Every file is written to a temporary file next to it and renamed when it is
+    complete, so readers never see a half written file. A save of a file that is still
+    waiting in the queue replaces the queued data (only the latest version is written), and
+    data with the same content as the last write of a file is not written again.
+
+    Parquet is written with the codec, level and row group size of the WriteSettings; csv
+    is written in chunks of rows.
+
+    The data passed to the writer must not be changed in place afterwards; pass a shallow
+    copy (adding or replacing columns of the original is fine).
+
+    Attributes:
+        settings (WriteSettings): codec, chunk sizes and background mode.
+    """
+    def __init__(self, settings: WriteSettings):
+        self.settings = settings
+        self.written = {}
+        self.appends = itertools.count()
+        self.reset()
+        # a forked child has a copy of the queue but not the writer thread, it starts its own
+        os.register_at_fork(after_in_child=self.reset)
+
+    def reset(self) -> None:
+        """
+        Empties the queue and forgets the writer thread.
+        """
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.futures = []
+        self.executor = None
+
+    #******** formats *******************
+
+    def write_parquet(self, df: pd.DataFrame, filepath: Path) -> None:
+        df.to_parquet(filepath, index=False, engine='pyarrow', compression=self.settings.compression,
+                      compression_level=self.settings.compression_level, row_group_size=self.settings.row_group_size)
+
+    def write_csv(self, df: pd.DataFrame, filepath: Path, mode: str = 'w', header: bool = True) -> None:
+        with open(filepath, mode, newline='', encoding='utf-8') as f:
+            for start in range(0, max(len(df), 1), self.settings.csv_chunksize):
+                df.iloc[start:start + self.settings.csv_chunksize].to_csv(f, index=False, header=header and start == 0)
+
+    #******** queue *******************
+
+    def save_parquet(self, df: pd.DataFrame, filepath: Path, on_done=None) -> None:
+        """
+        Queues an atomic parquet write.
+
+        Args:
+            df (pd.DataFrame): data to write, not changed in place afterwards
+            filepath (Path): target file
+            on_done (callable, optional): called in the writer thread after the file is written
+        """
+        self.submit(Path(filepath), self.write_parquet, df, on_done)
+
+    def save_csv(self, df: pd.DataFrame, filepath: Path, on_done=None) -> None:
+        """
+        Queues an atomic, chunked csv write, see save_parquet.
+        """
+        self.submit(Path(filepath), self.write_csv, df, on_done)
+
+    def append_csv(self, df: pd.DataFrame, filepath: Path) -> None:
+        """
+        Queues appending rows to a csv file (with a header when the file does not exist yet).
+
+        The rows are written in the columns of the existing header; columns the file does not
+        have are left out. Appends are never coalesced and run in the order they were queued.
+        """
+        def append(df, _):
+            header = None
+            if Path(filepath).exists():
+                with open(filepath, newline='', encoding='utf-8') as f:
+                    header = next(csv.reader(f), None)
+            if header:
+                self.write_csv(df.reindex(columns=header), filepath, mode='a', header=False)
+            else:
+                self.write_csv(df, filepath)
+        self.submit(('append', next(self.appends)), append, df, None)
+
+    def submit(self, key, write, df: pd.DataFrame, on_done) -> None:
+        with self.lock:
+            queued = key in self.pending
+            self.pending[key] = (write, df, on_done)
+        if queued:
+            logger.debug(f"Coalesced write of {key}")
+            return
+        if not self.settings.background:
+            self.run(key)
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='writer')
+        self.futures.append(self.executor.submit(self.run, key))
+
+    def run(self, key) -> None:
+        """
+        Writes the latest queued data of a file.
+        """
+        with self.lock:
+            write, df, on_done = self.pending.pop(key)
+        try:
+            if isinstance(key, tuple):
+                write(df, None)
+                return
+            state = value_hash(df)
+            if self.written.get(key) == state and key.exists():
+                logger.debug(f"{key.name} unchanged, not written")
+            else:
+                tmpfile = key.with_name(key.name + '.tmp')
+                write(df, tmpfile)
+                os.replace(tmpfile, key)
+                self.written[key] = state
+            if on_done is not None:
+                on_done()
+        except Exception as e:
+            logger.warning(f'Problem with saving {key}: {e}')
+
+    def flush(self) -> None:
+        """
+        Waits until all queued writes are done.
+        """
+        futures, self.futures = self.futures, []
+        wait(futures)
+
+
+# one writer per process, shared by all file handlers so their writes are coalesced and ordered
+dataWriter = DataWriter(writeSettings)
@@ -0,0 +1,160 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from loguru import logger
+import numpy as np
+from wa_visualizer.settings import EmbeddingSettings
+
+# model of a worker process, loaded once by init_worker
+_worker_model = None
+
+
+def init_worker(model_name: str, threads: int) -> None:
+    """
+    Loads the model in a worker process, with a fixed number of torch threads.
+    """
+    global _worker_model
+    import torch
+    from sentence_transformers import SentenceTransformer
+    torch.set_num_threads(threads)
+    _worker_model = SentenceTransformer(model_name, device='cpu')
+
+
+def encode_batch(job: tuple) -> tuple:
+    """
+    Encodes one batch in a worker process.
+
+    Args:
+        job (tuple): batch number and the texts of the batch
+
+    Returns:
+        tuple: batch number and the vectors of the batch
+    """
+    number, texts = job
+    return number, _worker_model.encode(texts, batch_size=len(texts), convert_to_numpy=True)
+
+
+class BatchEncoder:
+    """
+    Sentence encoder that batches messages of similar length and spreads the batches over CPU workers.
+
+    Messages are bucketed by token length (powers of two) and sorted within a bucket, so a
+    batch is padded to about the length of its own messages instead of the longest message
+    in the chat. The batches are encoded by a pool of worker processes, each with its own
+    copy of the model, and the vectors are written into one preallocated array in the
+    original order. With one worker the batches are encoded in the current process.
+
+    BatchEncoder has the encode method of a SentenceTransformer and can be used as the
+    model of Preprocessor.create_embedding and EmbeddingStore.encode.
+
+    Attributes:
+        settings (EmbeddingSettings): model name, batch size and number of workers.
+        model: model of the current process, loaded on first use.
+    """
+    def __init__(self, settings: EmbeddingSettings, model=None):
+        self.settings = settings
+        self.model = model
+        self.tokenizer = None
+
+    def __repr__(self) -> str:
+        return f"BatchEncoder({self.settings.model_name}, batch_size={self.settings.batch_size}, workers={self.settings.workers})"
+
+    def load_model(self):
+        if self.model is None:
+            from sentence_transformers import SentenceTransformer
+            self.model = SentenceTransformer(self.settings.model_name, device='cpu')
+        return self.model
+
+    #******** batching *******************
+
+    def token_lengths(self, texts: list) -> np.ndarray:
+        """
+        Number of tokens per text, from the model tokenizer when available.
+
+        Without a tokenizer the length is estimated at four characters per token.
+
+        Args:
+            texts (list): message texts
+
+        Returns:
+            np.ndarray: token count per text
+        """
+        if self.tokenizer is None:
+            if self.model is not None and hasattr(self.model, 'tokenizer'):
+                self.tokenizer = self.model.tokenizer
+            else:
+                try:
+                    from transformers import AutoTokenizer
+                    self.tokenizer = AutoTokenizer.from_pretrained(self.settings.model_name)
+                except (ImportError, OSError):
+                    self.tokenizer = False
+        if self.tokenizer:
+            ids = self.tokenizer(texts, add_special_tokens=True, truncation=False)['input_ids']
+            return np.fromiter((len(i) for i in ids), dtype=np.int64, count=len(texts))
+        return np.fromiter((len(text) for text in texts), dtype=np.int64, count=len(texts)) // 4 + 2
+
+    def make_batches(self, lengths: np.ndarray) -> list:
+        """
+        Groups text positions into batches of similar token length.
+
+        Args:
+            lengths (np.ndarray): token count per text
+
+        Returns:
+            list: arrays of text positions, one per batch
+        """
+        order = np.argsort(lengths, kind='stable')
+        buckets = np.ceil(np.log2(np.maximum(lengths[order], 1))).astype(np.int64)
+        # split where the bucket changes and every batch_size positions within a bucket
+        bounds = np.flatnonzero(np.diff(buckets)) + 1
+        batches = []
+        for bucket in np.split(order, bounds):
+            batches.extend(np.split(bucket, np.arange(self.settings.batch_size, len(bucket), self.settings.batch_size)))
+        return batches
+
+    #******** encoding *******************
+
+    def encode(self, texts: list, **kwargs) -> np.ndarray:
+        """
+        Encodes the texts in length-bucketed batches.
+
+        Args:
+            texts (list): message texts
+
+        Returns:
+            np.ndarray: vectors in the order of texts
+        """
+        if not len(texts):
+            return np.empty((0, 0), dtype=np.float32)
+        start = time.perf_counter()
+        batches = self.make_batches(self.token_lengths(texts))
+        jobs = ((number, [texts[i] for i in positions]) for number, positions in enumerate(batches))
+        vectors = None
+        workers = min(self.settings.workers, len(batches))
+        if workers > 1:
+            # a worker that cannot load the model breaks the pool (BrokenProcessPool) instead of
+            # being restarted, as multiprocessing.Pool does
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker,
+                                     initargs=(self.settings.model_name, self.settings.threads_per_worker)) as pool:
+                for number, batch in pool.map(encode_batch, jobs):
+                    vectors = self.write_batch(vectors, len(texts), batches[number], batch)
+        else:
+            model = self.load_model()
+            for number, batch in jobs:
+                vectors = self.write_batch(vectors, len(texts), batches[number],
+                                         model.encode(batch, batch_size=len(batch), convert_to_numpy=True))
+        elapsed = time.perf_counter() - start
+        logger.info(f'Encoded {len(texts)} messages in {len(batches)} batches on {max(workers, 1)} worker(s): '
+                    f'{len(texts) / elapsed:.0f} msgs/s')
+        return vectors
+
+    @staticmethod
+    def write_batch(vectors: np.ndarray, n: int, positions: np.ndarray, batch: np.ndarray) -> np.ndarray:
+        """
+        Writes the vectors of a batch at their positions, allocating the output on the first batch.
+        """
+        if vectors is None:
+            vectors = np.empty((n, batch.shape[1]), dtype=np.float32)
+        vectors[positions] = batch
+        return vectors
@@ -0,0 +1,210 @@
+from dataclasses import asdict
+from pathlib import Path
+from loguru import logger
+import numpy as np
+from scipy import sparse
+from sklearn.decomposition import PCA
+from sklearn.manifold import TSNE
+from sklearn.neighbors import NearestNeighbors
+from wa_visualizer.settings import MapSettings
+from wa_visualizer.stage_cache import value_hash
+
+
+class EmbeddingMap:
+    """
+    Scalable 2D map of sentence embeddings.
+
+    The vectors are reduced with PCA first. t-SNE is fitted on a sample stratified on an
+    attribute of the messages (the author by default), using a k-nearest-neighbour graph as
+    precomputed affinities; the graph comes from pynndescent when it is installed, and from
+    an exact search in the reduced space otherwise. All other messages, and messages added
+    later, are projected into the fitted map at the distance-weighted mean of their nearest
+    fitted neighbours.
+
+    A fitted map can be saved and loaded, so new messages land in the same map. The saved map
+    records the hash of its settings and the keys of the fitted messages; it is only reused
+    while the settings are the same and the fitted messages are still in the data.
+
+    Attributes:
+        settings (MapSettings): PCA, sample and t-SNE settings.
+        n_components (int): dimension of the map.
+        pca (PCA): fitted PCA.
+        reference (np.ndarray): reduced vectors of the fitted sample.
+        positions (np.ndarray): map positions of the fitted sample.
+        sample_keys (np.ndarray): keys of the messages of the fitted sample, None if not given.
+    """
+    def __init__(self, settings: MapSettings, n_components: int = 2, random_state: int = 42):
+        self.settings = settings
+        self.n_components = n_components
+        self.random_state = random_state
+        self.pca = None
+        self.reference = None
+        self.positions = None
+        self.neighbors = None
+        self.sample_keys = None
+        self.stored_hash = None
+
+    def __call__(self, vectors: np.ndarray, strata: np.ndarray = None) -> np.ndarray:
+        return self.fit_transform(vectors, strata)
+
+    def __repr__(self) -> str:
+        fitted = 0 if self.positions is None else len(self.positions)
+        return f"EmbeddingMap(n_components={self.n_components}, fitted={fitted})"
+
+    #******** fitting *******************
+
+    def stratified_sample(self, strata: np.ndarray) -> np.ndarray:
+        """
+        Draws a sample of about sample_size positions, proportional per stratum.
+
+        Every stratum keeps at least one message, so small groups stay visible in the map.
+
+        Args:
+            strata (np.ndarray): stratum label per message
+
+        Returns:
+            np.ndarray: sorted positions of the sampled messages
+        """
+        n = len(strata)
+        if n <= self.settings.sample_size:
+            return np.arange(n)
+        rng = np.random.default_rng(self.random_state)
+        labels, inverse = np.unique(np.asarray(strata, dtype=str), return_inverse=True)
+        fraction = self.settings.sample_size / n
+        sample = []
+        for label in range(len(labels)):
+            members = np.flatnonzero(inverse == label)
+            size = max(1, int(round(len(members) * fraction)))
+            sample.append(rng.choice(members, size=min(size, len(members)), replace=False))
+        return np.sort(np.concatenate(sample))
+
+    def knn_graph(self, reduced: np.ndarray, n_neighbors: int) -> sparse.csr_matrix:
+        """
+        Sparse graph of the squared distances to the nearest neighbours of every point.
+
+        Args:
+            reduced (np.ndarray): PCA reduced vectors
+            n_neighbors (int): number of neighbours per point
+
+        Returns:
+            sparse.csr_matrix: squared euclidean distances, shape (n, n)
+        """
+        try:
+            from pynndescent import NNDescent
+            index = NNDescent(reduced, n_neighbors=n_neighbors + 1, random_state=self.random_state)
+            indices, distances = index.neighbor_graph
+            indices, distances = indices[:, 1:], distances[:, 1:]
+        except ImportError:
+            distances, indices = NearestNeighbors(n_neighbors=n_neighbors).fit(reduced).kneighbors()
+        n = len(reduced)
+        return sparse.csr_matrix(
+            (distances.ravel() ** 2, indices.ravel(), np.arange(0, n * n_neighbors + 1, n_neighbors)),
+            shape=(n, n))
+
+    @logger.catch
+    def fit(self, vectors: np.ndarray, strata: np.ndarray = None, keys: np.ndarray = None) -> 'EmbeddingMap':
+        """
+        Fits PCA and t-SNE on a stratified sample of the vectors.
+
+        Args:
+            vectors (np.ndarray): embeddings, shape (n, dim)
+            strata (np.ndarray, optional): stratum label per vector, one stratum if omitted
+            keys (np.ndarray, optional): key per vector (the text hash), kept for the fitted sample
+
+        Returns:
+            EmbeddingMap: the fitted map
+        """
+        n = len(vectors)
+        strata = np.zeros(n, dtype=int) if strata is None else strata
+        sample = self.stratified_sample(strata)
+        self.sample_keys = None if keys is None else np.asarray(keys, dtype=str)[sample]
+        components = min(self.settings.pca_dims, vectors.shape[1], len(sample))
+        self.pca = PCA(n_components=components, random_state=self.random_state).fit(vectors[sample])
+        self.reference = self.pca.transform(vectors[sample]).astype(np.float32)
+        # t-SNE needs 3 * perplexity + 2 neighbours per point
+        perplexity = min(self.settings.perplexity, (len(sample) - 3) / 3)
+        n_neighbors = min(len(sample) - 1, int(3 * perplexity + 2))
+        graph = self.knn_graph(self.reference, n_neighbors)
+        # same initialisation as init='pca', which is not available for precomputed distances
+        init = self.reference[:, :self.n_components] / np.std(self.reference[:, 0]) * 1e-4
+        tsne = TSNE(n_components=self.n_components, perplexity=perplexity, learning_rate=self.settings.learning_rate,
+                    max_iter=self.settings.max_iter, metric='precomputed', init=init, random_state=self.random_state)
+        self.positions = tsne.fit_transform(graph).astype(np.float32)
+        self.neighbors = NearestNeighbors(n_neighbors=min(self.settings.n_neighbors, len(sample))).fit(self.reference)
+        logger.info(f't-SNE fitted on {len(sample)} of {n} messages ({components} PCA components)')
+        return self
+
+    #******** projection *******************
+
+    def transform(self, vectors: np.ndarray) -> np.ndarray:
+        """
+        Projects vectors into the fitted map.
+
+        A vector lands at the inverse distance weighted mean of its nearest fitted neighbours;
+        vectors that were fitted land on their own position.
+
+        Args:
+            vectors (np.ndarray): embeddings, shape (n, dim)
+
+        Returns:
+            np.ndarray: map positions, shape (n, n_components)
+        """
+        distances, indices = self.neighbors.kneighbors(self.pca.transform(vectors))
+        weights = 1.0 / np.maximum(distances, 1e-9)
+        weights /= weights.sum(axis=1, keepdims=True)
+        return np.einsum('nk,nkc->nc', weights, self.positions[indices]).astype(np.float32)
+
+    def fit_transform(self, vectors: np.ndarray, strata: np.ndarray = None, keys: np.ndarray = None) -> np.ndarray:
+        return self.fit(vectors, strata, keys).transform(vectors)
+
+    #******** persistence *******************
+
+    def settings_hash(self) -> str:
+        return value_hash(asdict(self.settings))
+
+    def matches(self, keys: np.ndarray) -> bool:
+        """
+        Checks whether a loaded map can be reused for the given messages.
+
+        Args:
+            keys (np.ndarray): key per message to project
+
+        Returns:
+            bool: the map was fitted with the current settings on messages that are all in keys
+        """
+        if self.stored_hash != self.settings_hash() or self.sample_keys is None:
+            return False
+        return bool(np.isin(self.sample_keys, np.asarray(keys, dtype=str)).all())
+
+    def save(self, filepath: Path) -> None:
+        """
+        Stores the fitted PCA, the reduced sample, its map positions and keys and the settings hash.
+        """
+        tmpfile = Path(filepath).with_suffix('.tmp.npz')
+        sample_keys = np.array([], dtype=str) if self.sample_keys is None else self.sample_keys
+        np.savez(tmpfile, mean=self.pca.mean_, components=self.pca.components_,
+                 reference=self.reference, positions=self.positions,
+                 settings=np.array(self.settings_hash()), sample_keys=sample_keys)
+        tmpfile.replace(filepath)
+
+    @classmethod
+    def load(cls, filepath: Path, settings: MapSettings) -> 'EmbeddingMap':
+        """
+        Loads a map stored with save, ready to project new vectors.
+        """
+        stored = np.load(filepath)
+        embedding_map = cls(settings, n_components=stored['positions'].shape[1])
+        embedding_map.pca = PCA(n_components=stored['components'].shape[0])
+        embedding_map.pca.mean_ = stored['mean']
+        embedding_map.pca.components_ = stored['components']
+        embedding_map.pca.n_components_ = stored['components'].shape[0]
+        embedding_map.pca.n_features_in_ = stored['components'].shape[1]
+        embedding_map.reference = stored['reference']
+        embedding_map.positions = stored['positions']
+        embedding_map.neighbors = NearestNeighbors(
+            n_neighbors=min(settings.n_neighbors, len(embedding_map.reference))).fit(embedding_map.reference)
+        # maps saved before the settings and sample were recorded never match
+        embedding_map.stored_hash = str(stored['settings']) if 'settings' in stored else None
+        if 'sample_keys' in stored and len(stored['sample_keys']):
+            embedding_map.sample_keys = stored['sample_keys']
+        return embedding_map
@@ -0,0 +1,140 @@
+import hashlib
+import re
+from pathlib import Path
+from loguru import logger
+import numpy as np
+import pandas as pd
+
+
+class EmbeddingStore:
+    """
+    Persistent store of message embeddings, keyed by the hash of the message text and the model name.
+
+    Every model has its own folder with a flat float32 vector file, read as a numpy memmap,
+    and an index (parquet) mapping text hashes to rows of the vector file. New vectors are
+    appended to the end of the vector file, so stored vectors never move. Only the rows
+    that are asked for are read from disk.
+
+    Attributes:
+        directory (Path): folder of the store for this model.
+        model_name (str): name of the embedding model.
+        dim (int): dimension of the vectors, None until the first vectors are added.
+    """
+    def __init__(self, directory: Path, model_name: str):
+        self.model_name = model_name
+        self.directory = Path(directory) / re.sub(r'[^A-Za-z0-9_.-]+', '_', model_name)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.vector_file = self.directory / 'vectors.f32'
+        self.index_file = self.directory / 'index.parq'
+        self.dim_file = self.directory / 'dim'
+        self.dim = int(self.dim_file.read_text()) if self.dim_file.exists() else None
+        self.index = pd.Series(dtype=np.int64)
+        if self.index_file.exists():
+            stored = pd.read_parquet(self.index_file)
+            self.index = pd.Series(stored['row'].to_numpy(), index=stored['hash'].to_numpy())
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __repr__(self) -> str:
+        return f"EmbeddingStore({self.model_name}, vectors={len(self)}, dim={self.dim})"
+
+    @staticmethod
+    def hash_texts(texts: list) -> np.ndarray:
+        """
+        Hashes message texts.
+
+        Args:
+            texts (list): message texts
+
+        Returns:
+            np.ndarray: hex digests
+        """
+        return np.array([hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest() for text in texts], dtype=object)
+
+    def lookup(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Finds the rows of the given text hashes.
+
+        Args:
+            hashes (np.ndarray): text hashes
+
+        Returns:
+            np.ndarray: row per hash, -1 for hashes not in the store
+        """
+        if not len(self.index):
+            return np.full(len(hashes), -1, dtype=np.int64)
+        positions = self.index.index.get_indexer(hashes)
+        return np.where(positions >= 0, self.index.to_numpy()[positions], -1)
+
+    def vectors(self) -> np.memmap:
+        """
+        Memory-maps the whole vector file, nothing is read until rows are accessed.
+        """
+        rows = self.vector_file.stat().st_size // (self.dim * 4)
+        return np.memmap(self.vector_file, dtype=np.float32, mode='r', shape=(rows, self.dim))
+
+    def read(self, rows: np.ndarray) -> np.ndarray:
+        """
+        Reads the given rows from the vector file.
+
+        Args:
+            rows (np.ndarray): rows to read
+
+        Returns:
+            np.ndarray: vectors, shape (len(rows), dim)
+        """
+        return np.asarray(self.vectors()[rows])
+
+    def add(self, hashes: np.ndarray, vectors: np.ndarray) -> None:
+        """
+        Appends new vectors and registers their text hashes.
+
+        Args:
+            hashes (np.ndarray): text hashes, not yet in the store
+            vectors (np.ndarray): vectors, shape (len(hashes), dim)
+        """
+        if not len(hashes):
+            return
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            self.dim_file.write_text(str(self.dim))
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f'Expected vectors of dimension {self.dim}, got {vectors.shape[1]}')
+        # rows follow the file size, vectors written before a failed index update are never reused
+        first = self.vector_file.stat().st_size // (self.dim * 4) if self.vector_file.exists() else 0
+        with open(self.vector_file, 'ab') as f:
+            f.write(vectors.tobytes())
+        new = pd.Series(np.arange(first, first + len(hashes), dtype=np.int64), index=hashes)
+        self.index = pd.concat([self.index, new]) if len(self.index) else new
+        self.save_index()
+        logger.info(f'Stored {len(hashes)} new embeddings ({len(self)} in store)')
+
+    def save_index(self) -> None:
+        tmpfile = self.index_file.with_suffix('.tmp')
+        pd.DataFrame({'hash': self.index.index.to_numpy(), 'row': self.index.to_numpy()}).to_parquet(tmpfile, index=False)
+        tmpfile.replace(self.index_file)
+
+    def encode(self, texts: list, model) -> np.ndarray:
+        """
+        Returns the vectors of the texts, encoding only the texts not yet in the store.
+
+        Args:
+            texts (list): message texts
+            model: sentence embedding model with an encode method
+
+        Returns:
+            np.ndarray: vectors in the order of texts
+        """
+        hashes = self.hash_texts(texts)
+        rows = self.lookup(hashes)
+        missing = rows < 0
+        if missing.any():
+            # encode every unique missing text once
+            new_hashes, first = np.unique(hashes[missing], return_index=True)
+            new_texts = [texts[i] for i in np.flatnonzero(missing)[first]]
+            logger.info(f'Encoding {len(new_texts)} new messages, {int((~missing).sum())} from the store')
+            self.add(new_hashes, model.encode(new_texts))
+            rows = self.lookup(hashes)
+        return self.read(rows)
@@ -0,0 +1,253 @@
+from loguru import logger
+import emoji
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+VARIATION_SELECTOR = '\ufe0f'  # emoji presentation selector, optional in most sequences
+
+
+class EmojiMatcher:
+    """
+    Extracts whole emoji sequences from messages with a trie over the Unicode emoji sequence list.
+
+    The trie holds every sequence of the Unicode emoji data (the emoji package): single code
+    points, keycaps, flags (regional indicator pairs and tag sequences), skin tone modifier
+    sequences and ZWJ sequences such as families and professions. Every sequence counts as
+    one emoji, so 👩🏽‍💻 is one emoji and not a woman, a skin tone and a laptop. The qualified
+    and unqualified forms of a sequence (with and without U+FE0F) count as the same emoji,
+    under its fully qualified form. A single code point with text presentation by default
+    (©, ®, ™, ❤) is only an emoji when U+FE0F follows, so '© 2020' has no emoji.
+
+    All messages are scanned at once: the messages are joined into one flat code point array,
+    every position that can start a sequence follows the trie one step per code point (one
+    numpy step for all open matches), and the longest sequence starting at a position wins.
+    Matches inside a longer match that starts earlier are dropped, left to right, as a reader
+    would split the text.
+
+    Attributes:
+        sequences (list): fully qualified form of every emoji, indexed by emoji id.
+        max_length (int): code points of the longest sequence.
+    """
+    _shared = None
+
+    def __init__(self, sequences=None):
+        self.build_trie(emoji.EMOJI_DATA if sequences is None else sequences)
+
+    @classmethod
+    def shared(cls) -> 'EmojiMatcher':
+        """
+        Matcher over the full emoji list, built once per process.
+        """
+        if cls._shared is None:
+            cls._shared = cls()
+        return cls._shared
+
+    def __call__(self, messages: pd.Series) -> pd.Series:
+        return self.extract(messages)
+
+    #******** trie construction *******************
+
+    def build_trie(self, sequences) -> None:
+        """
+        Builds the trie over the code points of all sequences and the emoji id of every final state.
+
+        Args:
+            sequences (dict or list): emoji sequences, with the emoji data (status) when a dict
+        """
+        status = {sequence: sequences[sequence].get('status') for sequence in sequences} if isinstance(sequences, dict) else {}
+        fully_qualified = emoji.STATUS['fully_qualified']
+        # one emoji id per sequence without variation selectors, named after its fully qualified form
+        canonical = {}
+        for sequence in sorted(sequences, key=lambda sequence: (status.get(sequence) != fully_qualified, sequence)):
+            canonical.setdefault(sequence.replace(VARIATION_SELECTOR, ''), sequence)
+        self.sequences = sorted(canonical.values())
+        ids = {sequence.replace(VARIATION_SELECTOR, ''): idx for idx, sequence in enumerate(self.sequences)}
+
+        codepoints = sorted({ord(char) for sequence in sequences for char in sequence})
+        # code points outside the emoji sequences map to the last symbol, which has no transitions
+        self.lookup = np.full(0x110000, len(codepoints), dtype=np.int16)
+        self.lookup[codepoints] = np.arange(len(codepoints))
+        self.n_symbols = len(codepoints) + 1
+
+        transitions, accept = {}, [-1]
+        for sequence in sequences:
+            if len(sequence) == 1 and status.get(sequence) == emoji.STATUS['unqualified']:
+                # text presentation by default (©, ™, ❤): only an emoji when followed by the variation selector
+                continue
+            state = 0
+            for char in sequence:
+                key = (state, int(self.lookup[ord(char)]))
+                if key not in transitions:
+                    transitions[key] = len(accept)
+                    accept.append(-1)
+                state = transitions[key]
+            accept[state] = ids[sequence.replace(VARIATION_SELECTOR, '')]
+        self.accept = np.array(accept, dtype=np.int32)
+        # sparse transitions: sorted state * n_symbols + symbol keys, looked up with searchsorted
+        keys = np.array([state * self.n_symbols + symbol for state, symbol in transitions], dtype=np.int64)
+        order = np.argsort(keys)
+        self.keys = keys[order]
+        self.targets = np.array(list(transitions.values()), dtype=np.int32)[order]
+        self.root = np.full(self.n_symbols, -1, dtype=np.int32)
+        for (state, symbol), target in transitions.items():
+            if state == 0:
+                self.root[symbol] = target
+        self.max_length = max((len(sequence) for sequence in sequences), default=0)
+        # keycaps start with a digit, # or *, but their second code point is above this threshold
+        self.start_threshold = min((max(map(ord, sequence[:2])) for sequence in sequences), default=0)
+        logger.debug(f'Emoji trie: {len(self.sequences)} emoji, {len(accept)} states, {self.n_symbols} symbols')
+
+    def step(self, states: np.ndarray, symbols: np.ndarray) -> np.ndarray:
+        # next state of every open match, -1 when the trie has no transition
+        query = states.astype(np.int64) * self.n_symbols + symbols
+        idx = np.minimum(np.searchsorted(self.keys, query), len(self.keys) - 1)
+        return np.where(self.keys[idx] == query, self.targets[idx], -1)
+
+    #******** matching *******************
+
+    def encode(self, messages: pd.Series) -> tuple:
+        """
+        Decodes the messages into one flat code point array, straight from the Arrow string buffer.
+
+        Returns:
+            tuple: flat code point array and the start offset of every message, with the total length at the end
+        """
+        text = pa.array(messages, type=pa.large_string(), from_pandas=True)
+        if isinstance(text, pa.ChunkedArray):
+            text = text.combine_chunks()
+        text = text.fill_null('')
+        offsets = np.frombuffer(text.buffers()[1], dtype=np.int64)[text.offset:text.offset + len(text) + 1]
+        data = text.buffers()[2].to_pybytes()[offsets[0]:offsets[-1]] if len(text) else b''
+        codepoints = np.frombuffer(data.decode('utf-8').encode('utf-32-le'), dtype=np.uint32)
+        lengths = pc.utf8_length(text).to_numpy(zero_copy_only=False).astype(np.int64)
+        return codepoints, np.concatenate([[0], np.cumsum(lengths)])
+
+    def find(self, messages: pd.Series) -> tuple:
+        """
+        Finds all emoji sequences in all messages in one pass.
+
+        Args:
+            messages (pd.Series): message texts
+
+        Returns:
+            tuple: position of the message and emoji id of every match, in text order
+        """
+        codepoints, starts = self.encode(messages)
+        # a sequence has a code point of at least start_threshold among its first two
+        high = codepoints >= self.start_threshold
+        high[:-1] |= high[1:]
+        positions = np.flatnonzero(high)
+        positions = positions[self.root[self.lookup[codepoints[positions]]] >= 0]
+        # matches end at the end of their message
+        limits = starts[np.searchsorted(starts, positions, side='right')]
+        states = self.root[self.lookup[codepoints[positions]]]
+        ids = self.accept[states]
+        lengths = (ids >= 0).astype(np.int64)
+        # extend the open matches one code point at a time, remember the longest complete sequence
+        open_ = np.arange(len(positions))
+        for depth in range(1, self.max_length):
+            inside = positions[open_] + depth < limits[open_]
+            open_, states = open_[inside], states[inside]
+            states = self.step(states, self.lookup[codepoints[positions[open_] + depth]])
+            alive = states >= 0
+            open_, states = open_[alive], states[alive]
+            if not len(open_):
+                break
+            complete = self.accept[states] >= 0
+            ids[open_[complete]] = self.accept[states[complete]]
+            lengths[open_[complete]] = depth + 1
+        found = lengths > 0
+        positions, ids, ends = positions[found], ids[found], positions[found] + lengths[found]
+        keep = self.first_matches(positions, ends)
+        rows = np.searchsorted(starts, positions[keep], side='right') - 1
+        return rows, ids[keep]
+
+    @staticmethod
+    def first_matches(positions: np.ndarray, ends: np.ndarray) -> np.ndarray:
+        """
+        Drops the matches inside an earlier kept match, left to right.
+
+        A match is kept when it starts after the end of all kept matches before it. Matches
+        only overlap within one emoji sequence, so a few rounds settle every chain.
+        """
+        keep = np.ones(len(positions), dtype=bool)
+        while True:
+            kept_ends = np.where(keep, ends, 0)
+            reach = np.concatenate([[0], np.maximum.accumulate(kept_ends)[:-1]]) if len(ends) else kept_ends
+            settled = positions >= reach
+            if np.array_equal(settled, keep):
+                return keep
+            keep = settled
+
+    def has_emoji(self, messages: pd.Series) -> pd.Series:
+        """
+        Detects emoji sequences in all messages at once.
+
+        Args:
+            messages (pd.Series): message texts
+
+        Returns:
+            pd.Series: True for messages with at least one emoji
+        """
+        rows, _ = self.find(messages)
+        found = np.bincount(rows, minlength=len(messages)) > 0
+        return pd.Series(found, index=messages.index, name=messages.name)
+
+    def extract(self, messages: pd.Series) -> pd.Series:
+        """
+        The emoji sequences of every message, in text order.
+
+        Args:
+            messages (pd.Series): message texts
+
+        Returns:
+            pd.Series: list of emoji per message, empty for messages without emoji
+        """
+        rows, ids = self.find(messages)
+        sequences = np.array(self.sequences, dtype=object)[ids]
+        bounds = np.searchsorted(rows, np.arange(len(messages) + 1))
+        emoji_lists = [list(sequences[bounds[row]:bounds[row + 1]]) for row in range(len(messages))]
+        return pd.Series(emoji_lists, index=messages.index, name=messages.name, dtype=object)
+
+    def count(self, messages: pd.Series, groups: np.ndarray = None) -> pd.DataFrame:
+        """
+        Counts the emoji sequences per group of messages.
+
+        Args:
+            messages (pd.Series): message texts
+            groups (np.ndarray, optional): group code of every message, one group when omitted
+
+        Returns:
+            pd.DataFrame: group, emoji and count of every emoji used in a group
+        """
+        rows, ids = self.find(messages)
+        groups = np.zeros(len(messages), dtype=np.int64) if groups is None else np.asarray(groups, dtype=np.int64)
+        pairs, counts = np.unique(groups[rows] * len(self.sequences) + ids, return_counts=True)
+        return pd.DataFrame({'group': pairs // len(self.sequences),
+                             'emoji': np.array(self.sequences, dtype=object)[pairs % len(self.sequences)],
+                             'count': counts})
+
+    def frequencies(self, df: pd.DataFrame, message_col: str, by: list, top: int = None) -> pd.DataFrame:
+        """
+        Emoji frequency table of the messages, per author, period or any other columns.
+
+        Args:
+            df (pd.DataFrame): messages
+            message_col (str): column with the message texts
+            by (list): columns to group by, for example the author and the year
+            top (int, optional): only the most used emoji of every group
+
+        Returns:
+            pd.DataFrame: the group columns, emoji and count, most used first within a group
+        """
+        # groups are numbered in order of appearance, as the distinct keys
+        codes = df.groupby(by, sort=False, dropna=False).ngroup().to_numpy()
+        keys = df[by].drop_duplicates().reset_index(drop=True)
+        counts = self.count(df[message_col], codes)
+        table = pd.concat([keys.iloc[counts['group']].reset_index(drop=True), counts[['emoji', 'count']]], axis=1)
+        table = table.sort_values([*by, 'count'], ascending=[True] * len(by) + [False], kind='stable')
+        if top is not None:
+            table = table.groupby(by, sort=False).head(top)
+        return table.reset_index(drop=True)
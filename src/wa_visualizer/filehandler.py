@@ -1,7 +1,16 @@
+import datetime
+import os
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from loguru import logger
 from pathlib import Path
-from wa_visualizer.settings import (Config, Folders)
+from wa_visualizer.settings import (Config, Folders, storageSchema, writeSettings)
+from wa_visualizer.compact_schema import CompactSchema
+from wa_visualizer.data_writer import dataWriter
+from wa_visualizer.tracing import traced
 
 class FileHandler():
     """
@@ -10,6 +19,10 @@ class FileHandler():
     Attributes:
         data (pd.DataFrame): The DataFrame containing the loaded data.
         datafile (Path): The path to the data file.
+        schema (CompactSchema): compact column types of the processed data, applied on load and save.
+        writer (DataWriter): background writer of the processed data, shared by all file handlers.
+        columns (list): columns loaded from the processed data, None for all columns.
+        filters (ds.Expression): row filter of the processed data, None for all rows.
 
     Args:
         folders (Folders): An instance of the Folders class containing paths for data storage.
@@ -18,7 +31,8 @@ class FileHandler():
     data: pd.DataFrame
     datafile: Path
 
-    def __init__(self, folders: Folders, config: Config, clean :bool = False):
+    def __init__(self, folders: Folders, config: Config, clean :bool = False, load :bool = True,
+                 columns: list = None, filters: ds.Expression = None):
         """
         Initializes the FileHandler with folder paths and configuration settings.
 
@@ -26,42 +40,231 @@ class FileHandler():
             folders (Folders): An instance of the Folders class.
             config (Config): An instance of the Config class.
             clean (Bool): if set tot True, cleaning step is required. Default is False.
+            load (Bool): if set to False, no data is loaded (chunked processing). Default is True.
+            columns (list, optional): only load these columns of the processed data. Default is all columns.
+            filters (ds.Expression, optional): only load the processed rows matching the filter, see row_filter.
         """
         self.folders = folders
+        self.parts = self.folders.derived('parts')
+        self.schema = CompactSchema(storageSchema)
+        self.writer = dataWriter
+        self.columns = columns
+        self.filters = filters
 
-        if clean:
+        if not load:
+            self.data = None
+        elif clean and self.folders.rawtxt is not None:
+            # native .txt exports are streamed in chunks by the cleaner
+            self.data = None
+        elif clean:
             # if cleaning required, load data from raw folder
             self.data = self.load_data(self.folders.rawdatafile)
         else:
             # load data from processed folder
-            self.data = self.load_data(self.folders.datafile)
+            self.data = self.load_data(self.folders.datafile, columns, filters)
         self.config = config
 
-    def load_data(self, filepath) -> pd.DataFrame:
+    @staticmethod
+    def row_filter(config: Config, start: datetime.date = None, end: datetime.date = None,
+                   authors: list = None) -> ds.Expression:
+        """
+        Builds a row filter of the processed data on a date range and authors.
+
+        Args:
+            config (Config): Configuration object with the column names.
+            start (datetime.date, optional): first day of the messages
+            end (datetime.date, optional): last day of the messages
+            authors (list, optional): authors of the messages
+
+        Returns:
+            ds.Expression: the filter, None when no condition is given
+        """
+        conditions = []
+        if start is not None:
+            conditions.append(ds.field(config.timestamp_col) >= pa.scalar(pd.Timestamp(start).as_unit('ns')))
+        if end is not None:
+            # the whole last day
+            conditions.append(ds.field(config.timestamp_col) < pa.scalar(pd.Timestamp(end).as_unit('ns') + pd.Timedelta(days=1)))
+        if authors:
+            conditions.append(ds.field(config.author_col).isin(list(authors)))
+        if not conditions:
+            return None
+        expression = conditions[0]
+        for condition in conditions[1:]:
+            expression = expression & condition
+        return expression
+
+    @property
+    def partial(self) -> bool:
+        """
+        Only some columns or rows of the processed data are loaded.
+        """
+        return self.columns is not None or self.filters is not None
+
+    def read_dataset(self, filepath: Path, columns: list = None, filters: ds.Expression = None) -> pd.DataFrame:
+        """
+        Reads a parquet file as a dataset: only the given columns are read, and row groups
+        whose statistics do not match the filter are skipped.
+
+        Args:
+            filepath (Path): parquet file
+            columns (list, optional): columns to read, columns missing from the file are ignored
+            filters (ds.Expression, optional): row filter
+
+        Returns:
+            pd.DataFrame: the selected columns and rows
+        """
+        dataset = ds.dataset(filepath, format='parquet')
+        if columns is not None:
+            columns = [column for column in columns if column in dataset.schema.names]
+        # text stays in Arrow memory instead of becoming Python strings
+        strings = {pa.string(): pd.StringDtype('pyarrow'), pa.large_string(): pd.StringDtype('pyarrow')}
+        return dataset.to_table(columns=columns, filter=filters).to_pandas(types_mapper=strings.get)
+
+    @traced(category='io')
+    def load_data(self, filepath, columns: list = None, filters: ds.Expression = None) -> pd.DataFrame:
         """
         Loads processed data from early steps from a parquet file into a DataFrame.
 
+        For the processed datafile, parts appended by the incremental mode are included,
+        only the requested columns and rows are read (see read_dataset) and the compact
+        schema is applied (files written before the schema existed are converted).
+
+        Args:
+            filepath (Path): file to load
+            columns (list, optional): columns of the processed data to load. Default is all columns.
+            filters (ds.Expression, optional): row filter of the processed data. Default is all rows.
+
         Returns:
             pd.DataFrame: The DataFrame containing the loaded processed data.
-            folder (str): folder to load the data from, current is default.
         """
-        return pd.read_parquet(filepath)
+        if Path(filepath) != Path(self.folders.datafile):
+            return pd.read_parquet(filepath)
+        # saves of this process may still be in the background writer
+        self.writer.flush()
+        frames = [self.read_dataset(f, columns, filters) for f in self.data_files()]
+        # parts with different categories are concatenated as objects, the schema converts them back
+        df = frames[0] if len(frames) == 1 else pd.concat(frames, ignore_index=True)
+        if columns is not None or filters is not None:
+            logger.info(f"Loaded {len(df)} messages, columns: {', '.join(df.columns)}")
+        return self.schema.compact(df, Path(filepath).name)
+
+    def data_files(self) -> list:
+        """
+        Lists the files of the processed store: the datafile and the appended parts.
+
+        Returns:
+            list: existing parquet files, in order
+        """
+        files = [Path(self.folders.datafile)] if Path(self.folders.datafile).exists() else []
+        if self.parts.exists():
+            files += sorted(self.parts.glob('part-*.parq'))
+        return files
+
+    def store_fingerprint(self) -> dict:
+        """
+        Number of messages and first and last timestamp of the processed store, from the parquet metadata.
+
+        Files without timestamp statistics are read for their timestamp column.
+
+        Returns:
+            dict: fingerprint as AggregateCube.fingerprint, None for an empty store
+        """
+        rows, first, last = 0, None, None
+        for f in self.data_files():
+            metadata = pq.ParquetFile(f).metadata
+            column = metadata.schema.names.index(self.config.timestamp_col)
+            for index in range(metadata.num_row_groups):
+                statistics = metadata.row_group(index).column(column).statistics
+                if statistics is None or not statistics.has_min_max:
+                    low, high = pc.min_max(pq.read_table(f, columns=[self.config.timestamp_col])
+                                           .column(self.config.timestamp_col)).values()
+                    low, high = low.as_py(), high.as_py()
+                else:
+                    low, high = statistics.min, statistics.max
+                if low is not None:
+                    first = low if first is None else min(first, low)
+                    last = high if last is None else max(last, high)
+            rows += metadata.num_rows
+        if first is None:
+            return None
+        return {'rows': int(rows), 'first': pd.Timestamp(first).isoformat(), 'last': pd.Timestamp(last).isoformat()}
+
+    @traced(category='io')
+    def append_data(self, df: pd.DataFrame) -> Path:
+        """
+        Appends new processed messages to the processed store without rewriting it.
+
+        The messages are written as a new parquet part next to the datafile and, when the csv
+        export is enabled, appended to the csv in the background.
+
+        Args:
+            df (pd.DataFrame): new processed messages
+
+        Returns:
+            Path: the written part file
+        """
+        self.parts.mkdir(parents=True, exist_ok=True)
+        # numbered after the last part: the writer may be removing saved parts, so counting them could reuse a name
+        number = max((int(part.stem.split('-')[1]) for part in self.parts.glob('part-*.parq')), default=-1) + 1
+        part = self.parts / f"part-{number:05d}.parq"
+        self.schema.apply(df)
+        # written to a temporary file first, so readers of the store never see a partial part
+        tmpfile = part.with_name(part.name + '.tmp')
+        self.writer.write_parquet(df, tmpfile)
+        os.replace(tmpfile, part)
+        if writeSettings.csv:
+            self.writer.append_csv(df.copy(deep=False), self.folders.csv)
+        logger.info(f'Appended {len(df)} messages to {part}')
+        return part
+
+    def compact_parts(self, parts: list = None) -> None:
+        """
+        Removes the appended parts, after the full data has been saved to the datafile.
+
+        Args:
+            parts (list, optional): the parts included in the saved data. Defaults to all parts.
+        """
+        if self.parts.exists():
+            for part in self.parts.glob('part-*.parq') if parts is None else parts:
+                part.unlink(missing_ok=True)
+            if not any(self.parts.iterdir()):
+                self.parts.rmdir()
+
+    def saved(self, parts: list) -> None:
+        """
+        Called by the writer when the datafile is written.
 
-    
+        Args:
+            parts (list): the appended parts included in the saved data
+        """
+        # the datafile now holds the appended parts as well
+        self.compact_parts(parts)
+        logger.success(f"Data processing completed and saved to:")
+        logger.success(f"- {self.folders.datafile}")
 
+    @traced(category='io')
     def save_data(self) -> None:
         """
-        Saves the current DataFrame to CSV and parquet formats.
+        Saves the current DataFrame to parquet and, when enabled, to CSV.
 
-        This method attempts to save the DataFrame and logs the outcome. 
+        The data is converted to the compact schema first, so columns added by the
+        preprocessing steps are stored (and kept in memory) with compact types. The files
+        are written by the background writer (see DataWriter): this method returns right
+        away, repeated saves are coalesced and every file is replaced atomically.
         If an error occurs during the saving process, a warning is logged.
         """
+        if self.partial:
+            logger.warning('Only part of the processed data is loaded, the data is not saved')
+            return
         try:
-            self.data.to_csv(self.folders.csv, index=False)
-            self.data.to_parquet(self.folders.datafile, index=False)
-            logger.success(f"Data processing completed and saved to:")
-            logger.success(f"- {self.folders.datafile}")
-            logger.success(f"- {self.folders.csv}")
+            self.schema.compact(self.data, Path(self.folders.datafile).name)
+            # the writer gets its own column set, later stages add columns to self.data
+            snapshot = self.data.copy(deep=False)
+            parts = sorted(self.parts.glob('part-*.parq')) if self.parts.exists() else []
+            if writeSettings.csv:
+                self.writer.save_csv(snapshot, self.folders.csv)
+            self.writer.save_parquet(snapshot, self.folders.datafile, on_done=lambda: self.saved(parts))
         except Exception as e:
             logger.warning(f'Problem with saving: {e}')
 
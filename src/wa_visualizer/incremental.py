@@ -0,0 +1,167 @@
+import json
+from typing import Iterator
+from loguru import logger
+import pandas as pd
+import pyarrow.parquet as pq
+from wa_visualizer.settings import (BaseRegexes, BaseStrings, Config, Folders)
+from wa_visualizer.aggregate_cube import AggregateCube
+from wa_visualizer.chat_parser import ChatParser
+from wa_visualizer.data_cleaning import DataCleaner
+from wa_visualizer.data_processing import Preprocessor
+from wa_visualizer.sketches import SketchStore
+from wa_visualizer.search_index import IndexStore
+from wa_visualizer.tracing import traced
+
+
+class IncrementalProcessor:
+    """
+    Append-only processing of new messages with a timestamp watermark.
+
+    The watermark file next to the processed datafile records, per chat, the latest processed
+    timestamp and how many raw messages carry exactly that timestamp (WhatsApp timestamps
+    have minute resolution, so new messages can share the last minute). On every run only
+    the raw messages after the watermark are cleaned, get all feature columns and are appended
+    to the processed store. The aggregate cube (counts and sums per cell), the distribution
+    sketches and the search index are updated with the new messages instead of being recomputed
+    from the whole chat.
+
+    The raw export is expected in chronological order, as WhatsApp writes it.
+
+    Attributes:
+        folders (Folders): paths of the raw and processed data.
+        config (Config): Configuration object with the column names.
+        cube (AggregateCube): aggregate cube of the chat.
+        sketches (SketchStore): distribution sketches of the chat.
+        search (IndexStore): full-text search index of the chat.
+    """
+    def __init__(self, folders: Folders, regexes: BaseRegexes, config: Config, strings: BaseStrings, chunk_size: int = 100_000):
+        self.folders = folders
+        self.config = config
+        self.chunk_size = chunk_size
+        self.cleaner = DataCleaner(folders, regexes, config, True, load=False)
+        self.preprocessor = Preprocessor(folders, config, strings, load=False)
+        self.watermark_file = self.folders.derived('watermark.json')
+        self.cube = AggregateCube(folders, config)
+        self.sketches = SketchStore(folders, config)
+        self.search = IndexStore(folders, config)
+
+    def __call__(self) -> int:
+        return self.update()
+
+    #******** watermark *******************
+
+    def read_watermark(self) -> dict:
+        """
+        Reads the watermark of this chat, an empty watermark if the chat was never processed.
+
+        A chat processed by a full run has a processed store but no watermark file; its watermark
+        is seeded from the store, see seed_watermark.
+
+        Returns:
+            dict: timestamp (str or None), seen (int) and authors (list)
+        """
+        if not self.watermark_file.exists():
+            return self.seed_watermark() or {'timestamp': None, 'seen': 0, 'authors': []}
+        with open(self.watermark_file) as f:
+            return json.load(f)
+
+    def seed_watermark(self) -> dict:
+        """
+        Watermark of a processed store without a watermark file, written by a full run.
+
+        The store holds all messages up to its latest timestamp. The watermark counts raw messages,
+        so the raw messages with exactly that timestamp count as seen, also those the cleaning
+        removed (system messages, empty messages).
+
+        Returns:
+            dict: watermark as read_watermark, None if there is no processed store
+        """
+        # saves of this process may still be in the background writer
+        self.preprocessor.writer.flush()
+        fingerprint = self.preprocessor.store_fingerprint()
+        if fingerprint is None:
+            return None
+        last = pd.Timestamp(fingerprint['last'])
+        store = self.preprocessor.load_data(self.folders.datafile, columns=[self.config.timestamp_col, self.config.author_col])
+        seen = sum(int((raw[self.config.timestamp_col] == last).sum()) for raw in self.iter_raw())
+        authors = sorted(str(author) for author in store[self.config.author_col].dropna().unique())
+        logger.info(f'No watermark, seeded from the processed store: {fingerprint["rows"]} messages up to {last}')
+        return {'timestamp': last.isoformat(), 'seen': seen, 'authors': authors}
+
+    def write_watermark(self, timestamp: pd.Timestamp, seen: int, authors: set) -> None:
+        """
+        Writes the watermark after a chunk has been appended.
+
+        Args:
+            timestamp (pd.Timestamp): latest processed raw timestamp
+            seen (int): number of raw messages with exactly this timestamp
+            authors (set): all authors seen so far
+        """
+        watermark = {'timestamp': timestamp.isoformat(), 'seen': int(seen), 'authors': sorted(authors)}
+        with open(self.watermark_file, 'w') as f:
+            json.dump(watermark, f, indent=2)
+
+    #******** raw data *******************
+
+    def iter_raw(self) -> Iterator[pd.DataFrame]:
+        """
+        Streams the raw messages in chunks, from the native .txt export or the raw parquet.
+
+        Yields:
+            pd.DataFrame: chunk of raw messages
+        """
+        if self.folders.rawtxt is not None:
+            for batch in ChatParser(self.config, chunk_size=self.chunk_size)(self.folders.rawtxt):
+                yield batch.to_pandas()
+        else:
+            for batch in pq.ParquetFile(self.folders.rawdatafile).iter_batches(batch_size=self.chunk_size):
+                yield batch.to_pandas()
+
+    #***************** incremental update ***********************
+    @traced(category='clean')
+    @logger.catch
+    def update(self) -> int:
+        """
+        Cleans, tags and appends the raw messages after the watermark.
+
+        Returns:
+            int: number of appended messages
+        """
+        watermark = self.read_watermark()
+        authors = set(watermark['authors'])
+        mark = pd.Timestamp(watermark['timestamp']) if watermark['timestamp'] else None
+        skip = watermark['seen']  # raw messages at the watermark already processed
+        latest, seen = None, 0  # new watermark, tracked over all raw messages
+        appended = 0
+        for raw in self.iter_raw():
+            timestamps = raw[self.config.timestamp_col]
+            chunk_max = timestamps.max()
+            if latest is None or chunk_max > latest:
+                latest, seen = chunk_max, 0
+            seen += int((timestamps == latest).sum()) if chunk_max == latest else 0
+            # select the messages after the watermark
+            if mark is not None:
+                at_mark = (timestamps == mark).to_numpy()
+                already = at_mark & (at_mark.cumsum() <= skip)
+                skip -= int(at_mark.sum())
+                raw = raw[(timestamps >= mark).to_numpy() & ~already]
+            if raw.empty:
+                continue
+            df = self.cleaner.clean_chunk(raw.copy())
+            if df.empty:
+                # only system or empty messages
+                continue
+            authors |= set(df[self.config.author_col].unique())
+            df = self.preprocessor.add_features(df, sorted(authors))
+            self.preprocessor.append_data(df)
+            self.cube.update(df)
+            self.sketches.update(df)
+            self.write_watermark(latest, seen, authors)
+            appended += len(df)
+        if latest is not None:
+            self.write_watermark(latest, seen, authors)
+        if appended:
+            # a segment with the appended rows
+            self.search.sync()
+        logger.info(f'Incremental update: {appended} new messages, watermark {latest}')
+        return appended
@@ -0,0 +1,97 @@
+from loguru import logger
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from wa_visualizer.settings import (Config, BaseStrings)
+
+
+class LanguageClassifier:
+    """
+    Batch classifier for the communication type (NL, IT or non-verbal) of messages.
+
+    The Dutch and Italian word lists are merged once into a single hashed vocabulary
+    (word -> language, Italian wins for words in both lists). A whole column is labelled
+    with vectorized Arrow string kernels: messages are split into words, all words are
+    looked up at once and the language of the last known word of every message is kept,
+    which gives the same labels as Preprocessor.detect_language.
+
+    Attributes:
+        config (Config): Configuration object with the column names and categories.
+        strings (BaseStrings): stopwords and frequent words per language.
+        vocabulary (pd.Series): language label indexed by word.
+    """
+    def __init__(self, config: Config, strings: BaseStrings, default_language: str = "NL"):
+        self.config = config
+        self.strings = strings
+        self.default_language = default_language
+        self.vocabulary = self.build_vocabulary()
+        self.words = pa.array(self.vocabulary.index, type=pa.string())
+        self.languages = self.vocabulary.to_numpy(dtype=object)
+
+    def __call__(self, df: pd.DataFrame) -> pd.Series:
+        return self.classify(df)
+
+    def build_vocabulary(self) -> pd.Series:
+        """
+        Builds the hashed word -> language lookup table.
+
+        Returns:
+            pd.Series: language label indexed by (unique) word
+        """
+        vocabulary = dict.fromkeys(self.strings.dutch_stopwords + self.strings.dutch_frequentwords, "NL")
+        # Italian is checked last in detect_language, so it wins for shared words
+        vocabulary.update(dict.fromkeys(self.strings.italian_stopwords + self.strings.italian_frequentwords, "IT"))
+        return pd.Series(vocabulary)
+
+    def detect_languages(self, words: pa.ListArray) -> np.ndarray:
+        """
+        Votes the language of every message from its words.
+
+        Args:
+            words (pa.ListArray): lists of words per message
+
+        Returns:
+            np.ndarray: guessed language per message
+        """
+        labels = np.full(len(words), self.default_language, dtype=object)
+        flat = pc.list_flatten(words)
+        parents = pc.list_parent_indices(words).to_numpy()
+        # hashed lookup of all words at once
+        positions = pc.index_in(flat, value_set=self.words).to_numpy(zero_copy_only=False)
+        known = ~np.isnan(positions)
+        parents = parents[known]
+        if not len(parents):
+            return labels
+        votes = self.languages[positions[known].astype(np.int64)]
+        # the last known word of every message decides the language
+        last = np.append(parents[1:] != parents[:-1], True)
+        labels[parents[last]] = votes[last]
+        return labels
+
+    @logger.catch
+    def classify(self, df: pd.DataFrame) -> pd.Series:
+        """
+        Labels all messages as verbal (NL or IT) or non-verbal.
+
+        Media, urls and single-word messages with emoji are non-verbal.
+
+        Args:
+            df (pd.DataFrame): messages with message and has_emoji columns
+
+        Returns:
+            pd.Series: communication type per message, same index as df
+        """
+        messages = pa.array(df[self.config.message_col], type=pa.string(), from_pandas=True)
+        has_emoji = df[self.config.has_emoji_col].fillna(False).to_numpy(dtype=bool)
+        # remove ? and !, make message lower case
+        text = pc.replace_substring(pc.replace_substring(messages, '?', ''), '!', '')
+        words = pc.split_pattern(pc.utf8_trim_whitespace(pc.utf8_lower(text)), ' ')
+        # non-verbal indicators
+        nonverbal = np.zeros(len(messages), dtype=bool)
+        for indicator in ('<Media', 'http', 'www.'):
+            nonverbal |= pc.match_substring(messages, indicator).fill_null(False).to_numpy(zero_copy_only=False)
+        nonverbal |= (pc.list_value_length(words).fill_null(0).to_numpy(zero_copy_only=False) == 1) & has_emoji
+        labels = self.detect_languages(words)
+        labels[nonverbal] = self.config.nonverbal_cat
+        return pd.Series(labels, index=df.index, name=self.config.language_col)
@@ -0,0 +1,305 @@
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from dataclasses import dataclass
+from loguru import logger
+import pandas as pd
+from wa_visualizer.settings import renderSettings
+from wa_visualizer.data_processing import Preprocessor
+from wa_visualizer.renderer import FigureStore
+from wa_visualizer.tracing import tracer
+from wa_visualizer.visual_1_3 import BarPlotVisualizer
+from wa_visualizer.visual_2 import TimeSeriesPlotVisualizer
+from wa_visualizer.visual_4 import RelationshipsPlotVisualizer
+from wa_visualizer.visual_5 import TSNEPlotVisualizer
+
+
+@dataclass(frozen=True)
+class Stage:
+    """
+    A week of the visualization pipeline.
+
+    Attributes:
+        week (str): week number.
+        visualizer (type): visualizer class of the week.
+        prepare (str): method of the visualizer returning the data of the figure.
+        plot (str): method of the visualizer drawing the figure from the prepared data.
+        preprocess (str): preprocessing method of the Preprocessor.
+        columns (tuple): names of the Config attributes of the columns the week adds to the data.
+        depends (tuple): weeks whose columns this week reads.
+        reads (tuple): names of the Config attributes of the stored columns the week reads, None for all columns.
+    """
+    week: str
+    visualizer: type
+    prepare: str
+    plot: str
+    preprocess: str
+    columns: tuple
+    depends: tuple = ()
+    reads: tuple = None
+
+
+STAGES = {stage.week: stage for stage in (
+    Stage('1', BarPlotVisualizer, 'prepare_week1', 'plot_week1', 'preprocess_week1', ('language_col',),
+          reads=('author_col', 'message_col', 'has_emoji_col')),
+    Stage('2', TimeSeriesPlotVisualizer, 'prepare_week2', 'plot_week2', 'preprocess_week2',
+          ('date_col', 'isoweek_col', 'year_week_col'), reads=('timestamp_col',)),
+    Stage('3', BarPlotVisualizer, 'prepare_week3', 'plot_week3', 'preprocess_week3', ('hour_col', 'topic_col'),
+          reads=('timestamp_col', 'author_col', 'message_col')),
+    Stage('4', RelationshipsPlotVisualizer, 'prepare_week4', 'plot_week4', 'preprocess_week4',
+          ('year_col', 'age_col', 'message_length_col', 'log_length_col', 'emoji_status_col'),
+          reads=('timestamp_col', 'author_col', 'has_emoji_col', 'message_length_col')),
+    # reads the language (1), topic (3), age and message length (4) columns
+    Stage('5', TSNEPlotVisualizer, 'prepare_week5', 'plot_week5', None, (), depends=('1', '3', '4')),
+)}
+
+# preprocessor of the worker processes, inherited from the parent when the pool forks
+_preprocessor = None
+
+
+def projection(config, weeks: list, stored: list) -> list:
+    """
+    Stored columns the weeks read, so only those are loaded.
+
+    Args:
+        config (Config): Configuration object with the column names
+        weeks (list): requested weeks
+        stored (list): columns of the processed datafile
+
+    Returns:
+        list: the columns to load, None when all columns are needed
+    """
+    # the timestamp identifies the data for the aggregate cube
+    names = {config.timestamp_col}
+    for week in weeks:
+        stage = STAGES[week]
+        if stage.reads is None or stage.depends:
+            return None
+        names |= {getattr(config, column) for column in stage.reads}
+    if not names <= set(stored):
+        return None
+    return [name for name in stored if name in names]
+
+
+def has_columns(preprocessor: Preprocessor, week: str) -> bool:
+    """
+    Checks whether the data has all columns a week adds.
+    """
+    stage = STAGES[week]
+    return all(getattr(preprocessor.config, column) in preprocessor.data for column in stage.columns)
+
+
+def run_stage(preprocessor: Preprocessor, week: str, visualize: bool, inputs: pd.DataFrame,
+              figures: FigureStore = None, draw: bool = True, need_columns: bool = False) -> pd.DataFrame:
+    """
+    Runs one week on a preprocessor.
+
+    Args:
+        preprocessor (Preprocessor): preprocessor with the loaded data
+        week (str): week number
+        visualize (bool): prepare the figure data, otherwise only add the columns of the week
+        inputs (pd.DataFrame): columns of the weeks this week depends on
+        figures (FigureStore, optional): store for the prepared figure data
+        draw (bool, optional): draw the figure right away, otherwise the FigureRenderer draws it later
+        need_columns (bool, optional): other weeks read the columns of this week; figures answered
+            from the aggregate cube do not add them
+
+    Returns:
+        pd.DataFrame: the columns the week added to the data
+    """
+    stage = STAGES[week]
+    with tracer.span(f"week {week}", 'pipeline', rows_in=len(preprocessor.data), visualize=visualize) as span:
+        for column in inputs.columns:
+            preprocessor.data[column] = inputs[column].to_numpy()
+        if visualize:
+            logger.info(f"Visualizing plot for week {week}")
+            visualizer = stage.visualizer(preprocessor)
+            prepared = getattr(visualizer, stage.prepare)()
+            if figures is not None:
+                figures.save(week, prepared)
+            if draw:
+                getattr(visualizer, stage.plot)(prepared)
+        if (not visualize or need_columns) and not has_columns(preprocessor, week):
+            getattr(preprocessor, stage.preprocess)()
+        names = [getattr(preprocessor.config, column) for column in stage.columns]
+        added = preprocessor.data[[name for name in names if name in preprocessor.data]]
+        if span is not None:
+            span.rows_out = len(added)
+        return added
+
+
+def run_worker_stage(week: str, visualize: bool, inputs: pd.DataFrame, figures: FigureStore, need_columns: bool) -> tuple:
+    # workers only prepare the figure data, the FigureRenderer draws the figures
+    columns = run_stage(_preprocessor, week, visualize, inputs, figures, draw=False, need_columns=need_columns)
+    # files the stage saves (for example the topics csv) are written before the worker returns
+    _preprocessor.writer.flush()
+    # the spans of the worker go back to the trace of the parent
+    return columns, tracer.drain()
+
+
+class PipelineScheduler:
+    """
+    Runs the weeks of the visualization pipeline as a dependency graph.
+
+    Every week declares the columns it adds to the data and the weeks whose columns it reads.
+    Weeks without open dependencies run concurrently in a process pool; the workers are forked
+    from this process and share its single load of the data read-only (copy on write). A
+    worker returns only the columns its week added; they are merged into the data here and
+    passed to the weeks that depend on them. The workers do not save the data, the merged
+    data is saved once at the end.
+
+    Dependencies of a requested week that were not requested themselves only run their
+    preprocessing step, and only when their columns are not in the data yet.
+
+    Without fork (or with one worker) the weeks run one after another in this process and,
+    unless rendering is headless, draw their figures right away. Otherwise the prepared
+    figure data is stored and the figures are left to the FigureRenderer.
+
+    A week that fails is logged and does not stop the other weeks: only the weeks that depend
+    on it are skipped, and the columns of the weeks that finished are still saved.
+
+    Attributes:
+        preprocessor (Preprocessor): preprocessor with the loaded data.
+        workers (int): maximum number of worker processes.
+        figures (FigureStore): store for the prepared figure data.
+        failed (set): weeks of the last run that failed or depend on a failed week.
+    """
+    def __init__(self, preprocessor: Preprocessor, workers: int = None, figures: FigureStore = None):
+        self.preprocessor = preprocessor
+        self.workers = workers or os.cpu_count() or 1
+        self.figures = figures
+        self.config = preprocessor.config
+        self.failed = set()
+
+    def __call__(self, weeks: list) -> list:
+        # None when the pipeline failed, the error is logged by run
+        return self.run(weeks)
+
+    #******** planning *******************
+
+    def needed(self, planned: dict) -> set:
+        """
+        Planned weeks whose columns are read by other planned weeks.
+        """
+        return {dependency for week in planned for dependency in STAGES[week].depends if dependency in planned}
+
+    def plan(self, weeks: list) -> dict:
+        """
+        Selects the weeks to run.
+
+        Args:
+            weeks (list): requested weeks
+
+        Returns:
+            dict: week -> True to create the plot, False to only preprocess; in dependency order
+        """
+        planned = {}
+
+        def visit(week, visualize):
+            for dependency in STAGES[week].depends:
+                if dependency not in weeks and not has_columns(self.preprocessor, dependency):
+                    visit(dependency, False)
+            planned[week] = planned.get(week, False) or visualize
+
+        for week in weeks:
+            visit(week, True)
+        return planned
+
+    def inputs(self, week: str, planned: dict) -> pd.DataFrame:
+        """
+        Columns a week reads from the weeks it depends on.
+        """
+        names = [getattr(self.config, column) for dependency in STAGES[week].depends if dependency in planned
+                 for column in STAGES[dependency].columns]
+        return self.preprocessor.data[[name for name in names if name in self.preprocessor.data]]
+
+    def fail(self, week: str, planned: dict, error: Exception = None) -> None:
+        """
+        Marks a failed week and the planned weeks that depend on it as failed.
+        """
+        if error is not None:
+            logger.opt(exception=error).error(f"Week {week} failed")
+        self.failed.add(week)
+        for other in planned:
+            if other not in self.failed and week in STAGES[other].depends:
+                logger.warning(f"Week {other} skipped, it depends on week {week}")
+                self.fail(other, planned)
+
+    #******** execution *******************
+
+    @logger.catch
+    def run(self, weeks: list) -> list:
+        """
+        Runs the requested weeks and their dependencies.
+
+        Args:
+            weeks (list): requested weeks
+
+        Returns:
+            list: weeks whose figures still have to be rendered; the failed weeks are in failed
+        """
+        self.failed = set()
+        planned = self.plan(weeks)
+        workers = min(self.workers, len(planned))
+        if workers <= 1 or 'fork' not in multiprocessing.get_all_start_methods():
+            draw = not renderSettings.headless or self.figures is None
+            needed = self.needed(planned)
+            for week, visualize in planned.items():
+                if week in self.failed:
+                    continue
+                try:
+                    run_stage(self.preprocessor, week, visualize, self.inputs(week, {}), self.figures, draw, week in needed)
+                except Exception as error:
+                    self.fail(week, planned, error)
+            if draw:
+                return []
+        else:
+            self.run_parallel(planned, workers)
+        return [week for week, visualize in planned.items() if visualize and week not in self.failed]
+
+    def run_parallel(self, planned: dict, workers: int) -> None:
+        """
+        Runs the planned weeks in a forked process pool, in dependency order.
+
+        Args:
+            planned (dict): week -> create the plot
+            workers (int): number of worker processes
+        """
+        global _preprocessor
+        # no writes in flight while forking, the workers do not save
+        self.preprocessor.writer.flush()
+        _preprocessor = self.preprocessor
+        self.preprocessor.defer_save = True
+        done, running, added = set(), {}, False
+        needed = self.needed(planned)
+        try:
+            with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('fork')) as pool:
+                while len(done) + len(self.failed) < len(planned):
+                    for week, visualize in planned.items():
+                        ready = all(d in done or d not in planned for d in STAGES[week].depends)
+                        waiting = week not in done and week not in self.failed and week not in running.values()
+                        if waiting and ready:
+                            future = pool.submit(run_worker_stage, week, visualize, self.inputs(week, planned), self.figures,
+                                                 week in needed)
+                            running[future] = week
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        week = running.pop(future)
+                        try:
+                            columns, events = future.result()
+                        except Exception as error:
+                            # the weeks that depend on it are not run, the others go on
+                            self.fail(week, planned, error)
+                            continue
+                        # merge the new columns, so dependent weeks and the saved data see them
+                        tracer.merge(events)
+                        for column in columns.columns:
+                            self.preprocessor.data[column] = columns[column].to_numpy()
+                        added |= len(columns.columns) > 0
+                        done.add(week)
+                        logger.info(f"Week {week} done")
+        finally:
+            self.preprocessor.defer_save = False
+            _preprocessor = None
+        if added:
+            self.preprocessor.save_data()
@@ -0,0 +1,149 @@
+import os
+import sys
+from pathlib import Path
+from loguru import logger
+import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
+from wa_visualizer.settings import (Config, Folders, QuerySettings, querySettings)
+from wa_visualizer.filehandler import FileHandler
+from wa_visualizer.data_writer import dataWriter
+
+
+class QueryEngine:
+    """
+    In-process analytical SQL over the processed chat (DuckDB).
+
+    The processed parquet files are registered as views, they are not loaded into pandas:
+
+    - messages: the processed datafile and the parts appended by the incremental mode
+    - cube: the aggregate cube (see AggregateCube), when it has been built
+
+    Queries run on several threads and spill to a folder next to the datafile when they do
+    not fit in the memory limit. Results are streamed as Arrow record batches.
+
+    Attributes:
+        folders (Folders): paths of the processed data.
+        config (Config): Configuration object with the column names.
+        settings (QuerySettings): threads, memory limit and batch size.
+    """
+    def __init__(self, folders: Folders, config: Config, settings: QuerySettings = querySettings):
+        self.folders = folders
+        self.config = config
+        self.settings = settings
+        self.connection = None
+
+    def __enter__(self) -> "QueryEngine":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    #******** connection *******************
+
+    def tables(self) -> dict:
+        """
+        Parquet files of every view.
+
+        Returns:
+            dict: view name -> list of parquet files
+        """
+        tables = {'messages': FileHandler(self.folders, self.config, load=False).data_files()}
+        cube = self.folders.derived('cube.parq')
+        if cube.exists():
+            tables['cube'] = [cube]
+        return {name: files for name, files in tables.items() if files}
+
+    @staticmethod
+    def quote(value) -> str:
+        return "'" + str(value).replace("'", "''") + "'"
+
+    def connect(self):
+        """
+        Opens the in-memory database and registers the views, once.
+
+        Returns:
+            duckdb.DuckDBPyConnection: the connection
+        """
+        if self.connection is not None:
+            return self.connection
+        import duckdb
+        # saves of this process may still be in the background writer
+        dataWriter.flush()
+        connection = duckdb.connect(database=':memory:')
+        connection.execute(f"SET threads TO {int(self.settings.threads or os.cpu_count() or 1)}")
+        if self.settings.memory_limit:
+            connection.execute(f"SET memory_limit = {self.quote(self.settings.memory_limit)}")
+        connection.execute(f"SET temp_directory = {self.quote(self.folders.derived('duckdb'))}")
+        for name, files in self.tables().items():
+            sources = ', '.join(self.quote(f) for f in files)
+            connection.execute(f"CREATE VIEW {name} AS SELECT * FROM read_parquet([{sources}], union_by_name = true)")
+            logger.debug(f"Registered view {name} over {len(files)} file(s)")
+        self.connection = connection
+        return connection
+
+    def close(self) -> None:
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    #******** queries *******************
+
+    def reader(self, sql: str, params: list = None) -> pa.RecordBatchReader:
+        """
+        Runs a query and returns a reader of the result, in batches of settings.batch_size rows.
+
+        Args:
+            sql (str): SQL query on the registered views
+            params (list, optional): values of the ? placeholders of the query
+
+        Returns:
+            pa.RecordBatchReader: streamed result
+        """
+        result = self.connect().execute(sql, params or [])
+        return result.fetch_record_batch(self.settings.batch_size)
+
+    def stream(self, sql: str, params: list = None):
+        """
+        Yields the result of a query as Arrow record batches, see reader.
+        """
+        yield from self.reader(sql, params)
+
+    def to_pandas(self, sql: str, params: list = None) -> pd.DataFrame:
+        """
+        Runs a query and returns the whole result as a DataFrame, for small (aggregated) results.
+        """
+        return self.reader(sql, params).read_all().to_pandas()
+
+    def export(self, sql: str, output: Path = None, fmt: str = 'csv', params: list = None) -> int:
+        """
+        Streams the result of a query to a csv or parquet file, or as csv to stdout.
+
+        Args:
+            sql (str): SQL query on the registered views
+            output (Path, optional): output file, stdout when not given
+            fmt (str, optional): 'csv' or 'parquet'
+            params (list, optional): values of the ? placeholders of the query
+
+        Returns:
+            int: number of rows written
+        """
+        reader = self.reader(sql, params)
+        if fmt == 'parquet' and output is None:
+            raise ValueError('Parquet results need an output file')
+        sink = sys.stdout.buffer if output is None else open(output, 'wb')
+        writer = pq.ParquetWriter(sink, reader.schema) if fmt == 'parquet' else pacsv.CSVWriter(sink, reader.schema)
+        rows = 0
+        try:
+            for batch in reader:
+                writer.write_batch(batch)
+                rows += batch.num_rows
+        finally:
+            writer.close()
+            if output is not None:
+                sink.close()
+            else:
+                sink.flush()
+        logger.info(f"Query returned {rows} rows")
+        return rows
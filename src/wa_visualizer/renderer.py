@@ -0,0 +1,137 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from loguru import logger
+import pandas as pd
+from wa_visualizer.settings import (BaseStrings, Config, Folders, renderSettings)
+from wa_visualizer.tracing import tracer
+
+
+class FigureStore:
+    """
+    Stores the prepared data of every figure (the aggregates a plot method draws), one file per week.
+
+    The pipeline writes the prepared data; the renderer reads it, so figures can be rendered
+    again (for example in other formats) without preprocessing the chat.
+
+    Attributes:
+        directory (Path): folder with the prepared figure data.
+    """
+    def __init__(self, directory: Path):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def path(self, week: str) -> Path:
+        return self.directory / f"week{week}.pkl"
+
+    def save(self, week: str, prepared) -> None:
+        tmpfile = self.path(week).with_suffix('.tmp')
+        pd.to_pickle(prepared, tmpfile)
+        tmpfile.replace(self.path(week))
+
+    def load(self, week: str):
+        return pd.read_pickle(self.path(week))
+
+    def __contains__(self, week: str) -> bool:
+        return self.path(week).exists()
+
+
+def render_figure(folders: Folders, config: Config, strings: BaseStrings, store: FigureStore,
+                  week: str, visualizer: type, plot: str, formats: tuple) -> tuple:
+    """
+    Draws one figure headless from its prepared data and saves it in the given formats.
+
+    Args:
+        folders (Folders): paths of the data, for the visualizer's preprocessor
+        config (Config): Configuration object with the column names and colors
+        strings (BaseStrings): keywords of the preprocessor
+        store (FigureStore): prepared figure data
+        week (str): week number
+        visualizer (type): visualizer class of the week
+        plot (str): plot method of the visualizer
+        formats (tuple): output formats
+
+    Returns:
+        tuple: week and formats of the rendered figure, and the trace events of the rendering
+    """
+    import matplotlib.pyplot as plt
+    from wa_visualizer.data_processing import Preprocessor
+    plt.switch_backend('Agg')
+    headless, previous = renderSettings.headless, renderSettings.formats
+    renderSettings.headless, renderSettings.formats = True, tuple(formats)
+    try:
+        with tracer.span(f"render week {week}", 'render', formats=','.join(formats)):
+            # the plot methods only need the config, the data is not loaded
+            getattr(visualizer(Preprocessor(folders, config, strings, load=False)), plot)(store.load(week))
+    finally:
+        renderSettings.headless, renderSettings.formats = headless, previous
+    return week, formats, tracer.drain()
+
+
+class FigureRenderer:
+    """
+    Renders figures headless on the Agg backend, concurrently in a pool of worker processes.
+
+    Every (figure, output format) pair is a job of its own, so all weeks and formats are
+    rendered at the same time. The figures are drawn on explicit Figure objects and
+    show() is never called. With one worker the figures are rendered in this process.
+
+    Attributes:
+        folders (Folders): paths of the data.
+        config (Config): Configuration object with the column names and colors.
+        strings (BaseStrings): keywords of the preprocessor.
+        store (FigureStore): prepared figure data.
+        workers (int): maximum number of worker processes.
+    """
+    def __init__(self, folders: Folders, config: Config, strings: BaseStrings, store: FigureStore, workers: int = None):
+        self.folders = folders
+        self.config = config
+        self.strings = strings
+        self.store = store
+        self.workers = workers or renderSettings.workers or os.cpu_count() or 1
+
+    def __call__(self, stages: list) -> list:
+        return self.render(stages)
+
+    def render(self, stages: list) -> list:
+        """
+        Renders the figures of the given stages in all output formats.
+
+        A figure that fails is logged and does not stop the other figures.
+
+        Args:
+            stages (list): pipeline stages with week, visualizer and plot attributes
+
+        Returns:
+            list: weeks of which a figure was not rendered
+        """
+        available = [stage for stage in stages if stage.week in self.store]
+        failed = [stage.week for stage in stages if stage.week not in self.store]
+        for week in failed:
+            logger.warning(f"No prepared data for week {week}, run the pipeline for this week first")
+        formats = tuple(renderSettings.formats)
+        args = (self.folders, self.config, self.strings, self.store)
+        workers = min(self.workers, len(available) * len(formats))
+        if workers <= 1:
+            for stage in available:
+                try:
+                    *_, events = render_figure(*args, stage.week, stage.visualizer, stage.plot, formats)
+                except Exception:
+                    logger.exception(f"Rendering week {stage.week} failed")
+                    failed.append(stage.week)
+                    continue
+                tracer.merge(events)
+            return failed
+        with ProcessPoolExecutor(workers) as pool:
+            futures = {pool.submit(render_figure, *args, stage.week, stage.visualizer, stage.plot, (extension,)): stage.week
+                       for stage in available for extension in formats}
+            for future in as_completed(futures):
+                try:
+                    week, rendered, events = future.result()
+                except Exception:
+                    logger.exception(f"Rendering week {futures[future]} failed")
+                    failed.append(futures[future])
+                    continue
+                tracer.merge(events)
+                logger.info(f"Rendered week {week} ({', '.join(rendered)})")
+        return list(dict.fromkeys(failed))
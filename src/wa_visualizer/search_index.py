@@ -0,0 +1,399 @@
+import json
+from pathlib import Path
+from loguru import logger
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from wa_visualizer.settings import (Config, Folders, SearchSettings, basicConfig, extraRegexes, searchSettings)
+from wa_visualizer.aggregate_cube import AggregateCube
+from wa_visualizer.filehandler import FileHandler
+from wa_visualizer.stage_cache import StageCache
+from wa_visualizer.tracing import traced
+
+MANIFEST = 'manifest.json'
+
+
+def distinct(values: np.ndarray) -> np.ndarray:
+    """
+    Sorted distinct values; sorting is much faster than the hash table of np.unique for large integer arrays.
+    """
+    values = np.sort(values)
+    return values[np.concatenate([[True], values[1:] != values[:-1]])] if len(values) else values
+
+
+class SearchIndex:
+    """
+    Inverted full-text index of the processed messages: every token points to the sorted row ids of its messages.
+
+    The messages are split into lower case tokens (letters and digits, see SearchSettings). An
+    index segment holds the distinct tokens of a range of rows in sorted order, with one compact
+    uint32 posting array of row ids per token, and the author and timestamp of every row as
+    facets. The row id of a message is its position in the processed store (the datafile
+    followed by the parts of the incremental mode), so the segments of later rows only add
+    larger row ids and the postings of a token over all segments stay sorted.
+
+    A token is looked up with a binary search in the sorted tokens of every segment and a prefix
+    (pizz*) is a range of them; multi-term queries intersect (or unite) the sorted postings. Facet
+    filters on the authors and a date range select from the resulting rows.
+
+    Attributes:
+        config (Config): Configuration object with the column names.
+        settings (SearchSettings): tokenizer of the messages.
+        segments (list): per segment the tokens, the posting offsets and the row ids.
+        authors (list): author names, indexed by the author code of the facets.
+        author_codes (np.ndarray): author code of every row.
+        timestamps (np.ndarray): timestamp of every row, datetime64[ns].
+    """
+    def __init__(self, config: Config = basicConfig, settings: SearchSettings = searchSettings):
+        self.config = config
+        self.settings = settings
+        self.segments = []
+        self.authors = []
+        self.author_codes = np.array([], dtype=np.int32)
+        self.timestamps = np.array([], dtype='datetime64[ns]')
+
+    def __repr__(self) -> str:
+        return f"SearchIndex(rows={len(self)}, segments={len(self.segments)})"
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    #******** building *******************
+
+    def tokenize(self, text: pa.Array) -> pa.ListArray:
+        """
+        Lower case tokens of every text.
+        """
+        return pc.split_pattern_regex(pc.utf8_lower(text), self.settings.token_separator)
+
+    def build_segment(self, table: pa.Table, base: int) -> tuple:
+        """
+        Index segment of a chunk of messages.
+
+        Args:
+            table (pa.Table): messages with the timestamp, author and message columns, in store order
+            base (int): row id of the first message
+
+        Returns:
+            tuple: postings table (token, rows) and facets table (author, timestamp)
+        """
+        text = table.column(self.config.message_col).cast(pa.large_string()).combine_chunks().fill_null('')
+        words = self.tokenize(text)
+        flat, parents = pc.list_flatten(words), pc.list_parent_indices(words)
+        keep = pc.greater_equal(pc.utf8_length(flat), self.settings.min_token_length)
+        encoded = pc.dictionary_encode(flat.filter(keep))
+        parents = parents.filter(keep).to_numpy(zero_copy_only=False).astype(np.int64)
+        # rank of every distinct token in sorted order
+        order = pc.sort_indices(encoded.dictionary).to_numpy()
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        codes = rank[encoded.indices.to_numpy(zero_copy_only=False)]
+        # distinct (token, row) pairs, sorted on token and then row
+        pairs = distinct(codes * len(text) + parents)
+        tokens, rows = pairs // max(len(text), 1), pairs % max(len(text), 1) + base
+        offsets = np.searchsorted(tokens, np.arange(len(order) + 1)).astype(np.int32)
+        postings = pa.table({'token': encoded.dictionary.take(pa.array(order)).cast(pa.string()),
+                             'rows': pa.ListArray.from_arrays(pa.array(offsets), pa.array(rows.astype(np.uint32)))})
+        facets = pa.table({'author': table.column(self.config.author_col).cast(pa.string()),
+                           'timestamp': table.column(self.config.timestamp_col).cast(pa.timestamp('ns'))})
+        return postings, facets
+
+    def add_segment(self, postings: pa.Table, facets: pa.Table) -> 'SearchIndex':
+        """
+        Adds a segment of the rows after the rows of the index.
+        """
+        rows = postings.column('rows').combine_chunks()
+        tokens = postings.column('token').combine_chunks()
+        self.segments.append({'tokens': tokens, 'terms': np.array(tokens.to_pylist(), dtype=object),
+                              'offsets': rows.offsets.to_numpy().astype(np.int64),
+                              'rows': rows.values.to_numpy().astype(np.uint32)})
+        labels, authors = pd.factorize(facets.column('author').to_numpy(zero_copy_only=False), use_na_sentinel=False)
+        for author in authors:
+            if author not in self.authors:
+                self.authors.append(author)
+        codes = np.array([self.authors.index(author) for author in authors], dtype=np.int32)
+        self.author_codes = np.concatenate([self.author_codes, codes[labels]])
+        self.timestamps = np.concatenate([self.timestamps,
+                                          facets.column('timestamp').to_numpy().astype('datetime64[ns]')])
+        return self
+
+    def merged(self) -> pa.Table:
+        """
+        The postings of all segments as one segment, for compaction.
+        """
+        tokens = pa.concat_arrays([segment['tokens'].cast(pa.large_string()) for segment in self.segments])
+        encoded = pc.dictionary_encode(tokens)
+        order = pc.sort_indices(encoded.dictionary).to_numpy()
+        rank = np.empty(len(order), dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        lengths = np.concatenate([np.diff(segment['offsets']) for segment in self.segments])
+        codes = np.repeat(rank[encoded.indices.to_numpy(zero_copy_only=False)], lengths)
+        rows = np.concatenate([segment['rows'] for segment in self.segments])
+        # a stable sort keeps the segments in row order within a token
+        position = np.argsort(codes, kind='stable')
+        offsets = np.searchsorted(codes[position], np.arange(len(order) + 1)).astype(np.int32)
+        return pa.table({'token': encoded.dictionary.take(pa.array(order)).cast(pa.string()),
+                         'rows': pa.ListArray.from_arrays(pa.array(offsets), pa.array(rows[position]))})
+
+    def facets(self) -> pa.Table:
+        return pa.table({'author': pa.array(np.array(self.authors, dtype=object)[self.author_codes], pa.string()),
+                         'timestamp': pa.array(self.timestamps, pa.timestamp('ns'))})
+
+    #******** queries *******************
+
+    @staticmethod
+    def gather(segment: dict, terms: np.ndarray) -> np.ndarray:
+        # row ids of the postings of some tokens of a segment, sorted per token
+        starts, ends = segment['offsets'][terms], segment['offsets'][terms + 1]
+        lengths = ends - starts
+        shift = np.repeat(starts - np.concatenate([[0], np.cumsum(lengths)[:-1]]), lengths)
+        return segment['rows'][np.arange(lengths.sum()) + shift]
+
+    def postings(self, token: str, prefix: bool = False) -> np.ndarray:
+        """
+        Sorted row ids of the messages with a token, or with a token starting with it (prefix=True).
+        """
+        found = []
+        for segment in self.segments:
+            low = np.searchsorted(segment['terms'], token, side='left')
+            high = np.searchsorted(segment['terms'], token + '\U0010ffff' if prefix else token, side='right')
+            rows = segment['rows'][segment['offsets'][low]:segment['offsets'][high]]
+            # the rows of several tokens of a prefix are sorted per token
+            found.append(distinct(rows) if prefix and high - low > 1 else rows)
+        return np.concatenate(found).astype(np.int64) if found else np.array([], dtype=np.int64)
+
+    def query_tokens(self, terms: list) -> list:
+        # tokens of every query term, as the messages are tokenized
+        return [[token for token in tokens if len(token) >= self.settings.min_token_length]
+                for tokens in self.tokenize(pa.array(terms, pa.large_string())).to_pylist()]
+
+    def search(self, query: str, authors: list = None, start=None, end=None, match_all: bool = True) -> np.ndarray:
+        """
+        Row ids of the messages matching a query.
+
+        The query is a list of terms separated by spaces; a term ending with * matches all tokens
+        starting with it. A term that splits into several tokens (e-mail) needs all of them.
+
+        Args:
+            query (str): search terms, for example 'pizza vanavond*'
+            authors (list, optional): only messages of these authors
+            start (optional): only messages from this date or timestamp on
+            end (optional): only messages up to and including this date
+            match_all (bool, optional): messages with all terms (default) or with any term
+
+        Returns:
+            np.ndarray: sorted row ids
+        """
+        result = None
+        terms = query.split()
+        for term, tokens in zip(terms, self.query_tokens([term.rstrip('*') for term in terms])):
+            if not tokens:
+                continue
+            rows = None
+            for position, token in enumerate(tokens):
+                found = self.postings(token, prefix=term.endswith('*') and position == len(tokens) - 1)
+                rows = found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+            if result is None:
+                result = rows
+            else:
+                result = np.intersect1d(result, rows, assume_unique=True) if match_all else distinct(np.concatenate([result, rows]))
+        if result is None:
+            return np.array([], dtype=np.int64)
+        return self.filter(result, authors, start, end)
+
+    def filter(self, rows: np.ndarray, authors: list = None, start=None, end=None) -> np.ndarray:
+        """
+        Selects the rows of some authors and of a date range with the facets.
+        """
+        if authors:
+            codes = [code for code, author in enumerate(self.authors) if author in set(authors)]
+            rows = rows[np.isin(self.author_codes[rows], codes)]
+        if start is not None:
+            rows = rows[self.timestamps[rows] >= np.datetime64(pd.Timestamp(start), 'ns')]
+        if end is not None:
+            # up to and including the end date
+            rows = rows[self.timestamps[rows] < np.datetime64(pd.Timestamp(end) + pd.Timedelta(days=1), 'ns')]
+        return rows
+
+    def facet_counts(self, rows: np.ndarray, by: str = 'author') -> pd.Series:
+        """
+        Number of matching messages per author, year, month or day.
+        """
+        if by == 'author':
+            counts = np.bincount(self.author_codes[rows], minlength=len(self.authors))
+            return pd.Series(counts, index=pd.Index(self.authors, name='author'), name='messages')
+        periods = pd.DatetimeIndex(self.timestamps[rows]).to_period({'year': 'Y', 'month': 'M', 'day': 'D'}[by])
+        return pd.Series(1, index=periods.rename(by), name='messages').groupby(level=0).sum()
+
+    #******** storage *******************
+
+    @classmethod
+    def read(cls, directory: Path, config: Config = basicConfig, settings: SearchSettings = searchSettings) -> 'SearchIndex':
+        """
+        Reads a stored index, see IndexStore.
+        """
+        directory = Path(directory)
+        with open(directory / MANIFEST) as f:
+            manifest = json.load(f)
+        index = cls(config, settings)
+        for name in manifest['segments']:
+            index.add_segment(pq.read_table(directory / f'{name}.postings.parq', memory_map=True),
+                              pq.read_table(directory / f'{name}.facets.parq', memory_map=True))
+        return index
+
+
+class IndexStore:
+    """
+    The search index of a chat, stored as index segments in the folder <datafile>_index next to the processed datafile.
+
+    The manifest lists the segments and records the number of messages and the first and last
+    timestamp they were built from (see AggregateCube.fingerprint) and the hash of the tokenizer
+    and cleaning settings; an index built with other settings is rebuilt. The index is brought up to
+    date with the processed store by sync: when the store only has new messages at the end
+    (the incremental mode) a segment with the new rows is added, otherwise the index is rebuilt,
+    one segment per chunk of messages. When there are more than max_segments segments they are
+    merged into one.
+
+    Attributes:
+        folders (Folders): paths of the processed data.
+        config (Config): Configuration object with the column names.
+        settings (SearchSettings): tokenizer, chunk size and number of segments.
+        settings_hash (str): hash of the settings and cleaning patterns, see StageCache.hash_settings.
+        directory (Path): folder of the index.
+        index (SearchIndex): the stored index, loaded on first use.
+    """
+    def __init__(self, folders: Folders, config: Config, settings: SearchSettings = searchSettings):
+        self.folders = folders
+        self.config = config
+        self.settings = settings
+        self.settings_hash = StageCache.hash_settings((config, extraRegexes, settings))
+        self.store = FileHandler(folders, config, load=False)
+        self.directory = folders.derived('index')
+        self.index = None
+
+    def __repr__(self) -> str:
+        return f"IndexStore({self.directory.name})"
+
+    def read_manifest(self) -> dict:
+        if not (self.directory / MANIFEST).exists():
+            return {'fingerprint': None, 'settings': None, 'segments': []}
+        with open(self.directory / MANIFEST) as f:
+            return json.load(f)
+
+    def write_manifest(self, fingerprint: dict, segments: list) -> None:
+        tmpfile = self.directory / f'{MANIFEST}.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump({'fingerprint': fingerprint, 'settings': self.settings_hash, 'segments': segments}, f, indent=2)
+        tmpfile.replace(self.directory / MANIFEST)
+
+    def stored_fingerprint(self) -> dict:
+        manifest = self.read_manifest()
+        return manifest['fingerprint'] if manifest.get('settings') == self.settings_hash else None
+
+    def is_fresh(self, df: pd.DataFrame) -> bool:
+        """
+        Checks that the stored index was built from these messages.
+        """
+        return len(df) > 0 and self.stored_fingerprint() == AggregateCube.fingerprint(df, self.config.timestamp_col)
+
+    def load(self) -> SearchIndex:
+        if self.index is None:
+            self.index = SearchIndex.read(self.directory, self.config, self.settings)
+        return self.index
+
+    def write_segment(self, name: str, postings: pa.Table, facets: pa.Table) -> None:
+        pq.write_table(postings, self.directory / f'{name}.postings.parq')
+        pq.write_table(facets, self.directory / f'{name}.facets.parq')
+
+    def remove_segments(self, segments: list) -> None:
+        for name in segments:
+            for kind in ('postings', 'facets'):
+                (self.directory / f'{name}.{kind}.parq').unlink(missing_ok=True)
+
+    def batches(self, start: int):
+        """
+        Streams the messages of the processed store from row id start on, in chunks.
+
+        Yields:
+            tuple: row id of the first message and the chunk as pa.Table
+        """
+        columns = [self.config.timestamp_col, self.config.author_col, self.config.message_col]
+        offset = 0
+        for f in self.store.data_files():
+            parquet = pq.ParquetFile(f)
+            rows = parquet.metadata.num_rows
+            if offset + rows <= start:
+                # files before the new rows are skipped without reading them
+                offset += rows
+                continue
+            for batch in parquet.iter_batches(batch_size=self.settings.chunk_size, columns=columns):
+                skip = max(start - offset, 0)
+                offset += batch.num_rows
+                if skip < batch.num_rows:
+                    yield offset - batch.num_rows + skip, pa.Table.from_batches([batch.slice(skip)])
+
+    @traced(category='index')
+    @logger.catch
+    def sync(self) -> None:
+        """
+        Brings the index up to date with the processed store: adds the new rows or rebuilds it.
+        """
+        # saves of this process may still be in the background writer
+        self.store.writer.flush()
+        current = self.store.store_fingerprint()
+        manifest = self.read_manifest()
+        stored = self.stored_fingerprint()
+        if current is None or stored == current:
+            return
+        appended = (stored is not None and stored['rows'] < current['rows']
+                    and stored['first'] == current['first'] and stored['last'] <= current['last'])
+        self.directory.mkdir(parents=True, exist_ok=True)
+        segments = manifest['segments'] if appended else []
+        if not appended:
+            self.remove_segments(manifest['segments'])
+        start = stored['rows'] if appended else 0
+        builder = SearchIndex(self.config, self.settings)
+        number = max([int(name.split('-')[1]) for name in manifest['segments']], default=-1) + 1
+        for base, table in self.batches(start):
+            name = f'segment-{number:05d}'
+            self.write_segment(name, *builder.build_segment(table, base))
+            segments.append(name)
+            number += 1
+        self.write_manifest(current, segments)
+        self.index = None
+        logger.info(f"Search index: {'added' if appended else 'indexed'} {current['rows'] - start} messages, "
+                    f"{len(segments)} segments")
+        if len(segments) > self.settings.max_segments:
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        Merges all segments into one.
+        """
+        manifest = self.read_manifest()
+        index = self.load()
+        number = max(int(name.split('-')[1]) for name in manifest['segments']) + 1
+        name = f'segment-{number:05d}'
+        self.write_segment(name, index.merged(), index.facets())
+        self.write_manifest(manifest['fingerprint'], [name])
+        self.remove_segments(manifest['segments'])
+        self.index = None
+        logger.info(f"Search index: merged {len(manifest['segments'])} segments")
+
+    def messages(self, rows: np.ndarray, columns: list = None) -> pd.DataFrame:
+        """
+        The messages of row ids, read from the processed store.
+
+        Args:
+            rows (np.ndarray): row ids, see SearchIndex.search
+            columns (list, optional): columns to read, defaults to the timestamp, author and message
+
+        Returns:
+            pd.DataFrame: the messages, in the order of the row ids
+        """
+        columns = columns or [self.config.timestamp_col, self.config.author_col, self.config.message_col]
+        dataset = ds.dataset([str(f) for f in self.store.data_files()], format='parquet')
+        return dataset.take(pa.array(rows, pa.int64()), columns=columns).to_pandas()
@@ -102,6 +102,7 @@ class Folders:
         rawdatafile (Path): Path to the source data file.
         csvraw: (Path): Path to the source csv file.
         csv (Path): Path to output CSV file.
+        rawtxt (Path, optional): Path to a native WhatsApp .txt export, streamed in chunks when set.
         
     """
     raw: Path
@@ -110,11 +111,199 @@ class Folders:
     datafile: Path
     rawdatafile: Path # source datafile
     csvraw : Path
+    rawtxt: Path = None # native .txt export
+
+    def derived(self, name: str) -> Path:
+        """
+        Path of a file or folder derived from the processed datafile, e.g. '<datafile>_watermark.json'.
+        """
+        return Path(self.datafile).parent / f"{Path(self.datafile).stem}_{name}"
 
     def __repr__(self):
         return (f"Folders(raw={self.raw}, processed={self.processed},"
                 f"datafile={self.datafile}, rawdatafile={self.rawdatafile}," 
-                f"csv={self.csv}, csvraw={self.csvraw}")
+                f"csv={self.csv}, csvraw={self.csvraw}, rawtxt={self.rawtxt}")
+
+@dataclass
+class ChatFormats:
+    """
+    A class to hold the layouts of native WhatsApp .txt exports.
+
+    Attributes:
+        layouts (dict): Regex patterns for a message header line, with the groups date, time and rest.
+        date_formats (list): Candidate strptime formats for the date part, tried in order.
+        time_formats (list): Candidate strptime formats for the time part, tried in order.
+        media_markers (list): Placeholders written by WhatsApp for omitted media.
+        media_placeholder (str): Uniform marker replacing every media placeholder.
+    """
+    layouts: dict
+    date_formats: list
+    time_formats: list
+    media_markers: list
+    media_placeholder: str
+
+
+@dataclass
+class EmbeddingSettings:
+    """
+    A class to hold the settings of the sentence embedding step.
+
+    Attributes:
+        model_name (str): Name of the SentenceTransformer model.
+        batch_size (int): Maximum number of messages per encoding batch.
+        workers (int): Number of CPU worker processes, 1 encodes in the current process.
+        threads_per_worker (int): Number of torch threads per worker.
+    """
+    model_name: str
+    batch_size: int
+    workers: int
+    threads_per_worker: int
+
+
+@dataclass
+class MapSettings:
+    """
+    A class to hold the settings of the 2D map of the sentence embeddings.
+
+    Attributes:
+        pca_dims (int): Number of PCA components before t-SNE.
+        sample_size (int): Maximum number of messages t-SNE is fitted on.
+        stratify_col (str): Column the sample is stratified on.
+        perplexity (float): t-SNE perplexity.
+        learning_rate (float): t-SNE learning rate.
+        max_iter (int): Number of t-SNE iterations.
+        n_neighbors (int): Number of fitted neighbours used to project the other messages.
+    """
+    pca_dims: int
+    sample_size: int
+    stratify_col: str
+    perplexity: float
+    learning_rate: float
+    max_iter: int
+    n_neighbors: int
+
+
+@dataclass
+class RenderSettings:
+    """
+    A class to hold the settings of the figure rendering.
+
+    Attributes:
+        formats (tuple): Output formats of every figure (file extensions).
+        headless (bool): Render on the Agg backend without opening windows (batch mode).
+        workers (int): Number of render worker processes, None for the number of cores.
+        dpi (int): Resolution of raster formats.
+    """
+    formats: tuple
+    headless: bool
+    workers: int
+    dpi: int
+
+
+@dataclass
+class StorageSchema:
+    """
+    A class to hold the compact column types of the processed data.
+
+    Attributes:
+        categories (list): Low-cardinality text columns, stored as categoricals (dictionary encoded in parquet).
+        integers (dict): Integer columns and their narrowest numpy type.
+        floats (dict): Float columns and their numpy type.
+        strings (list): Free text columns, stored as Arrow-backed strings.
+    """
+    categories: list
+    integers: dict
+    floats: dict
+    strings: list
+
+
+@dataclass
+class WriteSettings:
+    """
+    A class to hold the settings of writing the processed data.
+
+    Attributes:
+        csv (bool): Also export the processed data as csv.
+        csv_chunksize (int): Number of rows per chunk of the csv export.
+        compression (str): Parquet compression codec.
+        compression_level (int): Level of the compression codec, None for the codec default.
+        row_group_size (int): Number of rows per parquet row group.
+        background (bool): Write in a background thread, so saving returns immediately.
+    """
+    csv: bool
+    csv_chunksize: int
+    compression: str
+    compression_level: int
+    row_group_size: int
+    background: bool
+
+
+@dataclass
+class QuerySettings:
+    """
+    A class to hold the settings of the SQL query layer.
+
+    Attributes:
+        threads (int): Number of query threads, None for the number of cores.
+        memory_limit (str): Memory limit of a query (for example '4GB'); larger intermediate results spill to disk.
+            None for the engine default.
+        batch_size (int): Number of rows per streamed result batch.
+    """
+    threads: int
+    memory_limit: str
+    batch_size: int
+
+
+@dataclass
+class TraceSettings:
+    """
+    A class to hold the settings of the stage tracing (visualizer --profile).
+
+    Attributes:
+        enabled (bool): Record a span for every traced stage.
+        tracemalloc (bool): Also record the peak Python heap of every span; slows down the run considerably.
+        sample_interval (float): Seconds between two samples of the resident memory.
+        trace_file (Path): Output file of the Chrome trace (chrome://tracing, Perfetto).
+    """
+    enabled: bool
+    tracemalloc: bool
+    sample_interval: float
+    trace_file: Path
+
+
+@dataclass
+class SketchSettings:
+    """
+    A class to hold the settings of the distribution sketches.
+
+    Attributes:
+        compression (int): t-digest compression; about this many centroids are kept, more is more accurate.
+        precision (int): HyperLogLog precision p, 2**p registers of one byte; the relative error is about 1.04 / 2**(p/2).
+        word_separator (str): Regex (RE2) of the text between two words of the vocabulary.
+        min_word_length (int): Shorter words are not counted in the vocabulary.
+    """
+    compression: int
+    precision: int
+    word_separator: str
+    min_word_length: int
+
+
+@dataclass
+class SearchSettings:
+    """
+    A class to hold the settings of the full-text search index.
+
+    Attributes:
+        token_separator (str): Regex (RE2) of the text between two tokens of a message.
+        min_token_length (int): Shorter tokens are not indexed.
+        chunk_size (int): Number of messages indexed at once, one index segment per chunk.
+        max_segments (int): Above this number of segments they are merged into one.
+    """
+    token_separator: str
+    min_token_length: int
+    chunk_size: int
+    max_segments: int
+
 
 @dataclass
 class Embedding:
@@ -201,4 +390,95 @@ extraRegexes = BaseRegexes(patterns={
             "return_newline": r'[\r\n?]', # returns en new lines
             "username_pattern" : r"^@[a-zA-Z0-9._]+",
             "@telefoonummer": r"@\d{10,13}"
-        } )    
+        } )
+
+
+embeddingSettings = EmbeddingSettings(
+            model_name = 'sentence-transformers/all-MiniLM-L6-v2',
+            batch_size = 64,
+            workers = 4,
+            threads_per_worker = 1,
+        )
+
+mapSettings = MapSettings(
+            pca_dims = 50,
+            sample_size = 10_000,
+            stratify_col = 'author',
+            perplexity = 15,
+            learning_rate = 300,
+            max_iter = 2000,
+            n_neighbors = 10,
+        )
+
+storageSchema = StorageSchema(
+            categories = [basicConfig.author_col, basicConfig.language_col, basicConfig.topic_col,
+                          basicConfig.emoji_status_col, basicConfig.year_week_col],
+            integers = {
+                basicConfig.hour_col: 'int8',
+                basicConfig.isoweek_col: 'int8',
+                basicConfig.age_col: 'int8',
+                basicConfig.year_col: 'int16',
+                basicConfig.message_length_col: 'int32',
+            },
+            floats = {basicConfig.log_length_col: 'float32'},
+            strings = [basicConfig.message_col],
+        )
+
+writeSettings = WriteSettings(
+            csv = True,
+            csv_chunksize = 100_000,
+            compression = 'zstd',
+            compression_level = 3,
+            row_group_size = 256_000,
+            background = True,
+        )
+
+querySettings = QuerySettings(
+            threads = None,
+            memory_limit = None,
+            batch_size = 100_000,
+        )
+
+traceSettings = TraceSettings(
+            enabled = False,
+            tracemalloc = False,
+            sample_interval = 0.02,
+            trace_file = Path('logs/trace.json'),
+        )
+
+sketchSettings = SketchSettings(
+            compression = 100,
+            precision = 12,
+            word_separator = r"[^\p{L}]+",
+            min_word_length = 2,
+        )
+
+searchSettings = SearchSettings(
+            token_separator = r"[^\p{L}\p{N}]+",
+            min_token_length = 1,
+            chunk_size = 250_000,
+            max_segments = 8,
+        )
+
+renderSettings = RenderSettings(
+            formats = ('png',),
+            headless = False,
+            workers = None,
+            dpi = 100,
+        )
+
+chatFormats = ChatFormats(
+            layouts = {
+                # 09-03-2020 14:05 - author: message (Android)
+                "android": r"^(?P<date>\d{1,2}[-/.]\d{1,2}[-/.]\d{2,4}),? (?P<time>\d{1,2}:\d{2}(?::\d{2})?(?: ?[AaPp]\.?[Mm]\.?)?) - (?P<rest>.*)$",
+                # [09-03-2020 14:05:12] author: message (iOS)
+                "ios": r"^\[(?P<date>\d{1,2}[-/.]\d{1,2}[-/.]\d{2,4}),? (?P<time>\d{1,2}:\d{2}(?::\d{2})?(?: ?[AaPp]\.?[Mm]\.?)?)\] (?P<rest>.*)$",
+            },
+            date_formats = ["%d-%m-%Y", "%d-%m-%y", "%d/%m/%Y", "%d/%m/%y", "%m/%d/%y", "%m/%d/%Y", "%d.%m.%y", "%d.%m.%Y"],
+            time_formats = ["%H:%M", "%H:%M:%S", "%I:%M %p", "%I:%M:%S %p"],
+            media_markers = ["<Media omitted>", "<Media weggelaten>", "<Media omessi>", "<Media ausgeschlossen>",
+                             "image omitted", "video omitted", "audio omitted", "sticker omitted", "GIF omitted",
+                             "afbeelding weggelaten", "video weggelaten", "audio weggelaten", "sticker weggelaten",
+                             "immagine omessa", "video omesso", "audio omesso"],
+            media_placeholder = "<Media omitted>",
+        )
@@ -0,0 +1,537 @@
+import json
+from pathlib import Path
+from loguru import logger
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from wa_visualizer.settings import (Config, Folders, SketchSettings, basicConfig, extraRegexes, sketchSettings)
+from wa_visualizer.aggregate_cube import AggregateCube
+from wa_visualizer.emoji_engine import EmojiMatcher
+from wa_visualizer.stage_cache import StageCache
+
+SKETCH_METADATA = b'wa_visualizer.sketches'
+# stored sketch sets of an older layout are rebuilt
+SKETCH_VERSION = 2
+# distributions kept in t-digests: message length in characters, reply latency in seconds
+MEASURES = ('message_length', 'latency')
+
+
+class TDigest:
+    """
+    Mergeable sketch of a distribution, for quantiles (the merging t-digest of Dunning).
+
+    The values are summarized in centroids: a mean and the number of values. The k1 scale
+    function bounds the size of a centroid by its position in the distribution, so centroids
+    near the median hold many values and those in the tails few, which keeps the extreme
+    quantiles accurate. Adding values and merging digests both sort the centroids and merge
+    neighbours in one vectorized pass; at most about compression centroids remain. The
+    smallest and largest value are kept exactly.
+
+    Attributes:
+        compression (int): bound on the number of centroids.
+        means (np.ndarray): centroid means, ascending.
+        weights (np.ndarray): number of values of every centroid.
+        minimum (float): smallest value.
+        maximum (float): largest value.
+    """
+    def __init__(self, compression: int = 100, means: np.ndarray = None, weights: np.ndarray = None,
+                 minimum: float = np.inf, maximum: float = -np.inf):
+        self.compression = compression
+        self.means = np.array([], dtype=float) if means is None else np.asarray(means, dtype=float)
+        self.weights = np.array([], dtype=float) if weights is None else np.asarray(weights, dtype=float)
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def __repr__(self) -> str:
+        return f"TDigest(count={self.count}, centroids={len(self.means)})"
+
+    @property
+    def count(self) -> int:
+        return int(self.weights.sum())
+
+    def add(self, values) -> 'TDigest':
+        """
+        Adds values (missing values are skipped).
+        """
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if len(values):
+            self.minimum = min(self.minimum, values.min())
+            self.maximum = max(self.maximum, values.max())
+            self.compress(np.concatenate([self.means, values]), np.concatenate([self.weights, np.ones(len(values))]))
+        return self
+
+    def merge(self, other: 'TDigest') -> 'TDigest':
+        """
+        Adds the centroids of another digest.
+        """
+        if other.count:
+            self.minimum = min(self.minimum, other.minimum)
+            self.maximum = max(self.maximum, other.maximum)
+            self.compress(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+        return self
+
+    def compress(self, means: np.ndarray, weights: np.ndarray) -> None:
+        order = np.argsort(means, kind='stable')
+        means, weights = means[order], weights[order]
+        cumulative = np.cumsum(weights)
+        # quantile of the middle of every centroid, on the k1 scale one unit per output centroid
+        q = (cumulative - weights / 2) / cumulative[-1]
+        k = self.compression / np.pi * np.arcsin(np.clip(2 * q - 1, -1, 1))
+        groups = np.floor(k - k[0]).astype(np.int64)
+        sums = np.bincount(groups, weights)
+        kept = sums > 0
+        self.means = (np.bincount(groups, weights * means)[kept] / sums[kept])
+        self.weights = sums[kept]
+
+    #******** queries *******************
+
+    def points(self) -> tuple:
+        # cumulative counts at the centroid middles, with the exact extremes at both ends
+        cumulative = np.cumsum(self.weights)
+        positions = np.concatenate([[0.0], cumulative - self.weights / 2, [cumulative[-1]]])
+        return positions, np.concatenate([[self.minimum], self.means, [self.maximum]])
+
+    def quantile(self, q) -> np.ndarray:
+        """
+        Estimated quantiles (0 to 1), NaN for an empty digest.
+        """
+        q = np.atleast_1d(np.asarray(q, dtype=float))
+        if not self.count:
+            return np.full(len(q), np.nan)
+        positions, values = self.points()
+        return np.interp(q * positions[-1], positions, values)
+
+    def cdf(self, x) -> np.ndarray:
+        """
+        Estimated fraction of the values up to x.
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=float))
+        if not self.count:
+            return np.full(len(x), np.nan)
+        positions, values = self.points()
+        return np.interp(x, values, positions) / positions[-1]
+
+    #******** storage *******************
+
+    def to_bytes(self) -> bytes:
+        header = [self.compression, self.minimum, self.maximum]
+        return np.concatenate([header, self.means, self.weights]).astype(np.float64).tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'TDigest':
+        values = np.frombuffer(data, dtype=np.float64)
+        compression, minimum, maximum = values[:3]
+        means, weights = np.split(values[3:], 2)
+        return cls(int(compression), means.copy(), weights.copy(), minimum, maximum)
+
+
+class HyperLogLog:
+    """
+    Mergeable sketch of the number of distinct values (HyperLogLog, Flajolet et al.).
+
+    Every value is hashed to 64 bits; the first p bits select one of 2**p registers, which
+    keeps the longest run of leading zeros of the remaining bits. Merging takes the maximum
+    per register. The estimate has a relative error of about 1.04 / sqrt(2**p); small counts
+    are estimated from the number of empty registers (linear counting).
+
+    Attributes:
+        precision (int): number of index bits p.
+        registers (np.ndarray): 2**p registers of one byte.
+    """
+    def __init__(self, precision: int = 12, registers: np.ndarray = None):
+        self.precision = precision
+        self.registers = np.zeros(1 << precision, dtype=np.uint8) if registers is None else registers
+
+    def __repr__(self) -> str:
+        return f"HyperLogLog(precision={self.precision}, count={self.count()})"
+
+    @staticmethod
+    def hash(values) -> np.ndarray:
+        """
+        64-bit hashes of values, the same in every process and run.
+        """
+        return pd.util.hash_array(np.asarray(values, dtype=object))
+
+    def add_hashes(self, hashes: np.ndarray) -> 'HyperLogLog':
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        bits = 64 - self.precision
+        index = (hashes >> np.uint64(bits)).astype(np.int64)
+        rest = hashes & np.uint64((1 << bits) - 1)
+        # position of the first 1 bit of the remaining bits, rest lies in [2**(exponent - 1), 2**exponent)
+        _, exponent = np.frexp(rest.astype(np.float64))
+        rank = np.where(rest > 0, bits - exponent + 1, bits + 1).astype(np.uint8)
+        np.maximum.at(self.registers, index, rank)
+        return self
+
+    def add(self, values) -> 'HyperLogLog':
+        return self.add_hashes(self.hash(values))
+
+    def merge(self, other: 'HyperLogLog') -> 'HyperLogLog':
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self) -> int:
+        """
+        Estimated number of distinct values.
+        """
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.exp2(-self.registers.astype(float)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * np.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self) -> bytes:
+        return self.registers.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'HyperLogLog':
+        registers = np.frombuffer(data, dtype=np.uint8).copy()
+        return cls(int(np.log2(len(registers))), registers)
+
+
+class SketchSet:
+    """
+    Distribution sketches of a chat per author and year.
+
+    The message length and the reply latency (seconds since the previous message, for a
+    message that answers another author) are kept in t-digests, the vocabulary (distinct
+    lower case words) in HyperLogLog sketches. Next to the sketches, the emoji frequencies
+    are exact counts of the emoji sequences (see EmojiMatcher). Sketch sets of chunks,
+    incremental updates or different chats are merged sketch by sketch; quantiles, box plot
+    statistics, histograms, vocabulary sizes and emoji frequencies are answered from kilobytes
+    of sketches.
+
+    Attributes:
+        config (Config): Configuration object with the column names.
+        settings (SketchSettings): compression, precision and the word separator.
+        digests (dict): (measure, author, year) -> TDigest
+        vocabulary (dict): (author, year) -> HyperLogLog
+        emoji (dict): (author, year) -> {emoji sequence: count}
+        last (dict): timestamp and author of the last added message, for the latency of the next chunk.
+    """
+    def __init__(self, config: Config = basicConfig, settings: SketchSettings = sketchSettings):
+        self.config = config
+        self.settings = settings
+        self.digests = {}
+        self.vocabulary = {}
+        self.emoji = {}
+        self.last = None
+
+    def __repr__(self) -> str:
+        return f"SketchSet(digests={len(self.digests)}, vocabulary={len(self.vocabulary)}, emoji={len(self.emoji)})"
+
+    def __bool__(self) -> bool:
+        return bool(self.digests or self.vocabulary or self.emoji)
+
+    #******** building *******************
+
+    def latency(self, timestamps: np.ndarray, authors: np.ndarray) -> np.ndarray:
+        """
+        Seconds since the previous message for messages answering another author, NaN otherwise.
+        """
+        previous_time = np.empty(len(timestamps), dtype=np.int64)
+        previous_author = np.empty(len(authors), dtype=object)
+        previous_time[1:], previous_author[1:] = timestamps[:-1], authors[:-1]
+        if self.last is not None:
+            previous_time[0] = pd.Timestamp(self.last['timestamp']).value
+            previous_author[0] = self.last['author']
+        else:
+            previous_author[0] = None
+        seconds = (timestamps - previous_time) / 1e9
+        reply = (previous_author != authors) & pd.notna(previous_author) & (seconds >= 0)
+        return np.where(reply, seconds, np.nan)
+
+    def words(self, messages: pd.Series, groups: np.ndarray) -> tuple:
+        """
+        Hashes of the distinct words per group of the messages.
+
+        Returns:
+            tuple: group of every (group, word) pair and the hash of its word
+        """
+        text = pa.array(messages, type=pa.large_string())
+        if isinstance(text, pa.ChunkedArray):
+            text = text.combine_chunks()
+        words = pc.split_pattern_regex(pc.utf8_lower(text), self.settings.word_separator)
+        flat, parents = pc.list_flatten(words), pc.list_parent_indices(words)
+        keep = pc.greater_equal(pc.utf8_length(flat), self.settings.min_word_length)
+        encoded = pc.dictionary_encode(flat.filter(keep))
+        codes = encoded.indices.to_numpy(zero_copy_only=False).astype(np.int64)
+        pairs = np.unique(groups[parents.filter(keep).to_numpy(zero_copy_only=False)] * len(encoded.dictionary) + codes)
+        # the distinct words of the chunk are hashed once
+        hashes = HyperLogLog.hash(encoded.dictionary.to_numpy(zero_copy_only=False))
+        return pairs // max(len(encoded.dictionary), 1), hashes[pairs % max(len(encoded.dictionary), 1)]
+
+    def add(self, df: pd.DataFrame) -> 'SketchSet':
+        """
+        Adds messages in chronological order: the author, timestamp and message (or message length) columns.
+        """
+        if df.empty:
+            return self
+        config = self.config
+        authors = df[config.author_col].astype(object).to_numpy()
+        timestamps = df[config.timestamp_col].to_numpy(dtype='datetime64[ns]').view(np.int64)
+        years = df[config.timestamp_col].dt.year.to_numpy()
+        groups, keys = pd.MultiIndex.from_arrays([authors, years]).factorize()
+        if config.message_col in df:
+            lengths = df[config.message_col].str.len().to_numpy(dtype=float, na_value=np.nan)
+        else:
+            lengths = df[config.message_length_col].to_numpy(dtype=float)
+        measures = {'message_length': lengths, 'latency': self.latency(timestamps, authors)}
+        order = np.argsort(groups, kind='stable')
+        bounds = np.searchsorted(groups[order], np.arange(len(keys) + 1))
+        for group, (author, year) in enumerate(keys):
+            rows = order[bounds[group]:bounds[group + 1]]
+            for measure, values in measures.items():
+                digest = self.digests.setdefault((measure, author, int(year)), TDigest(self.settings.compression))
+                digest.add(values[rows])
+        if config.message_col in df:
+            word_groups, hashes = self.words(df[config.message_col], groups)
+            for group, (author, year) in enumerate(keys):
+                sketch = self.vocabulary.setdefault((author, int(year)), HyperLogLog(self.settings.precision))
+                sketch.add_hashes(hashes[word_groups == group])
+            counts = EmojiMatcher.shared().count(df[config.message_col], groups)
+            for group, sequence, count in counts.itertuples(index=False):
+                author, year = keys[group]
+                frequencies = self.emoji.setdefault((author, int(year)), {})
+                frequencies[sequence] = frequencies.get(sequence, 0) + int(count)
+        self.last = {'timestamp': pd.Timestamp(timestamps[-1]).isoformat(), 'author': authors[-1]}
+        return self
+
+    def merge(self, other: 'SketchSet') -> 'SketchSet':
+        """
+        Adds the sketches of another set, of a later chunk or of another chat.
+        """
+        for key, digest in other.digests.items():
+            self.digests.setdefault(key, TDigest(digest.compression)).merge(digest)
+        for key, sketch in other.vocabulary.items():
+            self.vocabulary.setdefault(key, HyperLogLog(sketch.precision)).merge(sketch)
+        for key, counts in other.emoji.items():
+            frequencies = self.emoji.setdefault(key, {})
+            for sequence, count in counts.items():
+                frequencies[sequence] = frequencies.get(sequence, 0) + count
+        self.last = other.last or self.last
+        return self
+
+    #******** queries *******************
+
+    def groups(self, keys, by: str) -> dict:
+        # author, year or None (all) of every key
+        position = {'author': 0, 'year': 1, None: None}[by]
+        grouped = {}
+        for key in keys:
+            grouped.setdefault('all' if position is None else key[position], []).append(key)
+        return dict(sorted(grouped.items(), key=lambda item: str(item[0])))
+
+    def digest(self, measure: str, by: str = 'author') -> dict:
+        """
+        Merged t-digests of a measure per author, per year or of all messages (by=None).
+        """
+        keys = [key[1:] for key in self.digests if key[0] == measure]
+        merged = {}
+        for group, members in self.groups(keys, by).items():
+            merged[group] = TDigest(self.settings.compression)
+            for key in members:
+                merged[group].merge(self.digests[(measure, *key)])
+        return merged
+
+    def quantiles(self, measure: str, q=(0.25, 0.5, 0.75), by: str = 'author') -> pd.DataFrame:
+        """
+        Estimated quantiles of a measure.
+
+        Args:
+            measure (str): 'message_length' or 'latency'
+            q (list, optional): quantiles between 0 and 1
+            by (str, optional): 'author', 'year' or None for all messages
+
+        Returns:
+            pd.DataFrame: the number of values and a column per quantile, a row per group
+        """
+        digests = self.digest(measure, by)
+        rows = {group: [digest.count, *digest.quantile(q)] for group, digest in digests.items()}
+        return pd.DataFrame.from_dict(rows, orient='index', columns=['count', *q]).rename_axis(by or 'all')
+
+    def box_stats(self, measure: str, by: str = 'author') -> list:
+        """
+        Box plot statistics per group from the digests, as used by Axes.bxp.
+        """
+        stats = []
+        for group, digest in self.digest(measure, by).items():
+            if not digest.count:
+                continue
+            q1, median, q3 = digest.quantile([0.25, 0.5, 0.75])
+            iqr = q3 - q1
+            stats.append({"label": str(group), "q1": q1, "med": median, "q3": q3,
+                          "whislo": max(digest.minimum, q1 - 1.5 * iqr), "whishi": min(digest.maximum, q3 + 1.5 * iqr)})
+        return stats
+
+    def histogram(self, measure: str, bins: int = 100) -> tuple:
+        """
+        Estimated histogram of a measure over all messages, between its 1st and 99th percentile.
+
+        Returns:
+            tuple: bin edges and the estimated count per bin
+        """
+        digest = self.digest(measure, None).get('all', TDigest())
+        if not digest.count:
+            return np.array([]), np.array([])
+        low, high = digest.quantile([0.01, 0.99])
+        edges = np.linspace(low, high, bins + 1)
+        return edges, np.diff(digest.cdf(edges)) * digest.count
+
+    def vocabulary_size(self, by: str = 'author') -> pd.Series:
+        """
+        Estimated number of distinct words per author, per year or in all messages (by=None).
+        """
+        sizes = {}
+        for group, members in self.groups(self.vocabulary, by).items():
+            sketch = HyperLogLog(self.settings.precision)
+            for key in members:
+                sketch.merge(self.vocabulary[key])
+            sizes[group] = sketch.count()
+        return pd.Series(sizes, name='vocabulary', dtype=np.int64).rename_axis(by or 'all')
+
+    def emoji_frequencies(self, by: str = 'author', top: int = 10) -> pd.DataFrame:
+        """
+        Most used emoji per author, per year or in all messages (by=None).
+
+        Args:
+            by (str, optional): 'author', 'year' or None for all messages
+            top (int, optional): number of emoji per group, None for all
+
+        Returns:
+            pd.DataFrame: group, emoji, count and percentage of the emoji of the group, most used first
+        """
+        rows = []
+        for group, members in self.groups(self.emoji, by).items():
+            counts = {}
+            for key in members:
+                for sequence, count in self.emoji[key].items():
+                    counts[sequence] = counts.get(sequence, 0) + count
+            total = sum(counts.values())
+            ranked = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+            rows += [(group, sequence, count, 100 * count / total) for sequence, count in ranked[:top]]
+        return pd.DataFrame(rows, columns=[by or 'all', 'emoji', 'count', 'percentage'])
+
+    #******** storage *******************
+
+    def to_table(self) -> pa.Table:
+        rows = [('tdigest', measure, author, year, digest.to_bytes()) for (measure, author, year), digest in self.digests.items()]
+        rows += [('hll', 'vocabulary', author, year, sketch.to_bytes()) for (author, year), sketch in self.vocabulary.items()]
+        # one row per emoji, the count in the data
+        rows += [('emoji', sequence, author, year, np.int64(count).tobytes())
+                 for (author, year), counts in self.emoji.items() for sequence, count in counts.items()]
+        kind, measure, author, year, data = zip(*rows) if rows else ([], [], [], [], [])
+        return pa.table({'kind': pa.array(kind, pa.string()), 'measure': pa.array(measure, pa.string()),
+                         'author': pa.array(author, pa.string()), 'year': pa.array(year, pa.int16()),
+                         'data': pa.array(data, pa.binary())})
+
+    @classmethod
+    def from_table(cls, table: pa.Table, config: Config = basicConfig, settings: SketchSettings = sketchSettings) -> 'SketchSet':
+        sketches = cls(config, settings)
+        for kind, measure, author, year, data in zip(*(table.column(name).to_pylist() for name in
+                                                       ('kind', 'measure', 'author', 'year', 'data'))):
+            if kind == 'tdigest':
+                sketches.digests[(measure, author, year)] = TDigest.from_bytes(data)
+            elif kind == 'emoji':
+                sketches.emoji.setdefault((author, year), {})[measure] = int(np.frombuffer(data, dtype=np.int64)[0])
+            else:
+                sketches.vocabulary[(author, year)] = HyperLogLog.from_bytes(data)
+        return sketches
+
+    @classmethod
+    def read(cls, path: Path, config: Config = basicConfig, settings: SketchSettings = sketchSettings) -> 'SketchSet':
+        """
+        Reads a stored sketch set, see SketchStore.
+        """
+        table = pq.read_table(path)
+        sketches = cls.from_table(table, config, settings)
+        metadata = json.loads((table.schema.metadata or {}).get(SKETCH_METADATA, b'{}'))
+        sketches.last = metadata.get('last')
+        return sketches
+
+
+class SketchStore:
+    """
+    The sketch set of a chat, stored as parquet next to the processed datafile.
+
+    Like the aggregate cube, the parquet metadata records the number of messages and the
+    first and last timestamp the sketches were built from and the hash of their settings, to
+    detect sketches that no longer match the data; the incremental mode adds new messages to
+    the stored sketches.
+
+    Attributes:
+        folders (Folders): paths of the processed data.
+        config (Config): Configuration object with the column names.
+        settings (SketchSettings): compression, precision and the word separator.
+        settings_hash (str): hash of the settings and cleaning patterns, see StageCache.hash_settings.
+        path (Path): parquet file of the sketches.
+        sketches (SketchSet): the stored sketches, loaded on first use.
+    """
+    def __init__(self, folders: Folders, config: Config, settings: SketchSettings = sketchSettings):
+        self.folders = folders
+        self.config = config
+        self.settings = settings
+        # sketches of messages cleaned with other patterns, or with another compression or precision, are stale
+        self.settings_hash = StageCache.hash_settings((config, extraRegexes, settings))
+        self.path = folders.derived('sketches.parq')
+        self.sketches = None
+
+    def __repr__(self) -> str:
+        return f"SketchStore({self.path.name})"
+
+    def save(self, sketches: SketchSet, fingerprint: dict) -> None:
+        table = sketches.to_table()
+        metadata = dict(table.schema.metadata or {})
+        metadata[SKETCH_METADATA] = json.dumps({'fingerprint': fingerprint, 'last': sketches.last,
+                                                'version': SKETCH_VERSION, 'settings': self.settings_hash}).encode()
+        tmpfile = self.path.with_suffix('.tmp')
+        pq.write_table(table.replace_schema_metadata(metadata), tmpfile)
+        tmpfile.replace(self.path)
+        self.sketches = sketches
+        logger.info(f'Sketches: {len(sketches.digests)} digests, {len(sketches.vocabulary)} vocabularies '
+                    f'and {len(sketches.emoji)} emoji tables '
+                    f'for {fingerprint["rows"]} messages, {self.path.stat().st_size / 1e3:.0f} kB')
+
+    def load(self) -> SketchSet:
+        if self.sketches is None:
+            self.sketches = SketchSet.read(self.path, self.config, self.settings)
+        return self.sketches
+
+    def stored_fingerprint(self) -> dict:
+        if not self.path.exists():
+            return None
+        metadata = pq.read_schema(self.path).metadata or {}
+        stored = json.loads(metadata[SKETCH_METADATA]) if SKETCH_METADATA in metadata else {}
+        fresh = stored.get('version') == SKETCH_VERSION and stored.get('settings') == self.settings_hash
+        return stored.get('fingerprint') if fresh else None
+
+    def is_fresh(self, df: pd.DataFrame) -> bool:
+        """
+        Checks that the stored sketches were built from these messages.
+        """
+        return len(df) > 0 and self.stored_fingerprint() == AggregateCube.fingerprint(df, self.config.timestamp_col)
+
+    def update(self, df: pd.DataFrame) -> None:
+        """
+        Adds new processed messages to the stored sketches.
+        """
+        previous = self.stored_fingerprint()
+        sketches = self.load() if previous is not None else SketchSet(self.config, self.settings)
+        sketches.add(df)
+        self.save(sketches, AggregateCube.fingerprint(df, self.config.timestamp_col, previous))
+
+    def refresh(self, df: pd.DataFrame) -> None:
+        """
+        Rebuilds the sketches when they do not match the data.
+
+        Args:
+            df (pd.DataFrame): all processed messages, in chronological order
+        """
+        if self.is_fresh(df):
+            return
+        self.save(SketchSet(self.config, self.settings).add(df), AggregateCube.fingerprint(df, self.config.timestamp_col))
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+from dataclasses import asdict
+from functools import wraps
+from pathlib import Path
+from loguru import logger
+import numpy as np
+import pandas as pd
+
+# bump when the preprocessing code changes the output of a stage
+CACHE_VERSION = 1
+# plot settings that do not change any stage output
+PLOT_FIELDS = ('img_dir', 'basic_color', 'color_palette', 'basic_color_highlight', 'color_vertical_line')
+
+
+def file_hash(*filepaths) -> str:
+    """
+    Content hash of one or more files, read in blocks.
+
+    Args:
+        filepaths (Path): files to hash, in order
+
+    Returns:
+        str: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for filepath in filepaths:
+        with open(filepath, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def value_hash(value) -> str:
+    """
+    Hash of a stage argument or setting; DataFrames and arrays are hashed by content.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(pd.util.hash_pandas_object(value, index=True).to_numpy().tobytes())
+        digest.update(repr(list(value.columns) if isinstance(value, pd.DataFrame) else value.name).encode())
+    elif isinstance(value, np.ndarray):
+        digest.update(np.ascontiguousarray(value).tobytes())
+    else:
+        digest.update(json.dumps(value, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class StageCache:
+    """
+    Content-addressed on-disk cache for the results of the preprocessing stages.
+
+    An entry is keyed on the content hash of the input data, a hash of the settings that
+    influence the stages (Config without the plot colors, BaseStrings, BaseRegexes and
+    the dates of birth), the stage name and its arguments. Entries are pickled files;
+    when the cache grows beyond max_bytes the least recently used entries are removed.
+
+    Saving the data with derived columns changes the datafile; the new file hash is
+    registered as an alias of the hash it was derived from, so the next run still hits.
+
+    Attributes:
+        directory (Path): folder with the cache entries.
+        max_bytes (int): size limit of the cache folder.
+        settings_hash (str): hash of the relevant settings.
+    """
+    def __init__(self, directory: Path, settings: tuple, max_bytes: int = 2 * 1024**3):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.settings_hash = self.hash_settings(settings)
+        self.aliases_file = self.directory / 'aliases.json'
+        self.aliases = json.loads(self.aliases_file.read_text()) if self.aliases_file.exists() else {}
+
+    @staticmethod
+    def hash_settings(settings: tuple) -> str:
+        """
+        Hashes the settings dataclasses and dicts that influence the stage outputs.
+        """
+        values = [CACHE_VERSION]
+        for setting in settings:
+            setting = asdict(setting) if hasattr(setting, '__dataclass_fields__') else setting
+            values.append({k: v for k, v in setting.items() if k not in PLOT_FIELDS})
+        return value_hash(values)
+
+    #******** data lineage *******************
+
+    def resolve(self, data_hash: str) -> str:
+        """
+        Returns the hash of the data a file was derived from, or the hash itself.
+        """
+        return self.aliases.get(data_hash, data_hash)
+
+    def alias(self, data_hash: str, source_hash: str) -> None:
+        """
+        Registers a saved datafile as derived from the data with source_hash.
+        """
+        root = self.resolve(source_hash)
+        if data_hash != root:
+            self.aliases[data_hash] = root
+            self.aliases_file.write_text(json.dumps(self.aliases, indent=2))
+
+    #******** entries *******************
+
+    def key(self, data_hash: str, stage: str, args: tuple, kwargs: dict) -> str:
+        arguments = [value_hash(arg) for arg in args] + [f"{k}={value_hash(v)}" for k, v in sorted(kwargs.items())]
+        return value_hash([data_hash, self.settings_hash, stage, arguments])
+
+    def get(self, key: str):
+        """
+        Loads a cache entry and marks it as recently used.
+
+        Returns:
+            The cached object, None on a miss.
+        """
+        filepath = self.directory / f"{key}.pkl"
+        if not filepath.exists():
+            return None
+        os.utime(filepath)
+        return pd.read_pickle(filepath)
+
+    def put(self, key: str, value) -> None:
+        """
+        Stores a cache entry and evicts the least recently used entries above max_bytes.
+        """
+        filepath = self.directory / f"{key}.pkl"
+        tmpfile = filepath.with_suffix('.tmp')
+        pd.to_pickle(value, tmpfile)
+        tmpfile.replace(filepath)
+        self.evict()
+
+    def evict(self) -> None:
+        entries = sorted(self.directory.glob('*.pkl'), key=lambda f: f.stat().st_mtime)
+        total = sum(f.stat().st_size for f in entries)
+        while entries and total > self.max_bytes:
+            oldest = entries.pop(0)
+            total -= oldest.stat().st_size
+            oldest.unlink()
+            logger.info(f'Evicted cache entry {oldest.name}')
+
+
+def cached_stage(*columns):
+    """
+    Decorator caching the output of a Preprocessor stage in its StageCache.
+
+    Stages also add columns to self.data; these columns are cached with the output and
+    restored on a hit, so later stages see the same data as after a full run.
+
+    Args:
+        columns (str): names of the Config attributes of the columns the stage adds.
+    """
+    def decorator(stage):
+        @wraps(stage)
+        def wrapper(self, *args, **kwargs):
+            cache = getattr(self, 'cache', None)
+            if cache is None or self.data_hash is None:
+                return stage(self, *args, **kwargs)
+            key = cache.key(self.data_hash, stage.__name__, args, kwargs)
+            entry = cache.get(key)
+            if entry is not None:
+                logger.info(f'{stage.__name__}: loaded from cache')
+                output, added = entry
+                for column in added.columns:
+                    self.data[column] = added[column].to_numpy()
+                return output
+            output = stage(self, *args, **kwargs)
+            names = [getattr(self.config, column) for column in columns]
+            cache.put(key, (output, self.data[[name for name in names if name in self.data]]))
+            return output
+        return wrapper
+    return decorator
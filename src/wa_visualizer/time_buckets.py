@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+
+NS_PER_HOUR = 3_600 * 10**9
+NS_PER_DAY = 24 * NS_PER_HOUR
+# 1970-01-01 is a Thursday, day -3 is the Monday of ISO week key 0
+WEEK_OFFSET = 3
+
+
+class TimeBuckets:
+    """
+    Integer time buckets computed from the int64 epoch (nanoseconds) of the timestamps.
+
+    A bucket key is a plain integer: hours, days, ISO weeks (Monday to Sunday) or months
+    since the epoch. Keys are computed with integer arithmetic, messages are counted per
+    key with bincount over the range of keys, so weeks without messages get a zero count
+    without building a calendar, and consecutive keys are consecutive buckets. Labels
+    (e.g. '2020-13' for ISO week 13 of 2020) are only made for the buckets of a result,
+    when it is drawn.
+
+    Attributes:
+        unit (str): 'hour', 'day', 'week' or 'month'.
+    """
+    UNITS = ('hour', 'day', 'week', 'month')
+    FORMATS = {'hour': '%Y-%m-%d %H:00', 'day': '%Y-%m-%d', 'month': '%Y-%m'}
+
+    def __init__(self, unit: str = 'week'):
+        if unit not in self.UNITS:
+            raise ValueError(f"Unknown time unit {unit}, use one of {', '.join(self.UNITS)}")
+        self.unit = unit
+
+    def __repr__(self) -> str:
+        return f"TimeBuckets({self.unit})"
+
+    #******** keys *******************
+
+    @staticmethod
+    def epoch(timestamps) -> np.ndarray:
+        """
+        Nanoseconds since the epoch of timestamps (Series, Index or array).
+        """
+        return np.asarray(timestamps, dtype='datetime64[ns]').view(np.int64)
+
+    def keys(self, timestamps) -> np.ndarray:
+        """
+        Bucket key of every timestamp.
+
+        Args:
+            timestamps: Series, Index or array of timestamps without missing values
+
+        Returns:
+            np.ndarray: int64 keys
+        """
+        ns = self.epoch(timestamps)
+        if self.unit == 'hour':
+            return ns // NS_PER_HOUR
+        days = ns // NS_PER_DAY
+        if self.unit == 'day':
+            return days
+        if self.unit == 'week':
+            return (days + WEEK_OFFSET) // 7
+        return ns.astype('datetime64[ns]').astype('datetime64[M]').view(np.int64)
+
+    def starts(self, keys) -> pd.DatetimeIndex:
+        """
+        First moment of every bucket.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if self.unit == 'hour':
+            return pd.DatetimeIndex(keys * NS_PER_HOUR)
+        if self.unit == 'day':
+            return pd.DatetimeIndex(keys * NS_PER_DAY)
+        if self.unit == 'week':
+            return pd.DatetimeIndex((keys * 7 - WEEK_OFFSET) * NS_PER_DAY)
+        return pd.DatetimeIndex(keys.astype('datetime64[M]').astype('datetime64[ns]'))
+
+    def labels(self, keys) -> pd.Index:
+        """
+        Readable labels of bucket keys, for drawing; ISO year and week for weeks ('2020-13').
+        """
+        starts = self.starts(keys)
+        if self.unit == 'week':
+            iso = starts.isocalendar()
+            return pd.Index([f"{year}-{week:02d}" for year, week in zip(iso['year'], iso['week'])])
+        return pd.Index(starts.strftime(self.FORMATS[self.unit]))
+
+    def week_numbers(self, keys: np.ndarray) -> np.ndarray:
+        """
+        ISO week number of every week key, looked up per distinct week.
+        """
+        if len(keys) == 0:
+            return np.array([], dtype=np.int8)
+        low = keys.min()
+        numbers = self.starts(np.arange(low, keys.max() + 1)).isocalendar()['week'].to_numpy(dtype=np.int8)
+        return numbers[keys - low]
+
+    #******** counting *******************
+
+    def count(self, keys, weights=None, first: int = None, last: int = None) -> pd.Series:
+        """
+        Counts (or sums the weights) per bucket, for every bucket from first to last.
+
+        Args:
+            keys: bucket keys
+            weights (optional): value per key, counted as 1 when not given
+            first (int, optional): first bucket of the result, defaults to the smallest key
+            last (int, optional): last bucket of the result, defaults to the largest key
+
+        Returns:
+            pd.Series: count per bucket key, zero for buckets without keys
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        if len(keys) == 0 and (first is None or last is None):
+            return pd.Series([], index=pd.Index([], dtype=np.int64, name=self.unit), dtype=np.int64)
+        first = keys.min() if first is None else first
+        last = keys.max() if last is None else last
+        inside = (keys >= first) & (keys <= last)
+        counts = np.bincount(keys[inside] - first, minlength=last - first + 1,
+                             weights=None if weights is None else np.asarray(weights)[inside])
+        index = pd.RangeIndex(first, last + 1, name=self.unit)
+        return pd.Series(counts.astype(np.int64) if weights is None else counts, index=index)
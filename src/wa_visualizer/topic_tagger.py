@@ -0,0 +1,197 @@
+from collections import deque
+from loguru import logger
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+from wa_visualizer.settings import Config
+
+BOUNDARY = r'\b'
+
+
+class TopicTagger:
+    """
+    Multi-keyword topic tagger based on an Aho-Corasick automaton.
+
+    All keywords of all topics are compiled into one automaton over a small alphabet:
+    every character used in a keyword is a symbol of its own, all other characters fall
+    in a generic word or non-word symbol. Keywords are matched case-insensitive as
+    literal substrings; a leading or trailing \\b is expanded into the symbols that form
+    a word boundary, so entries like r'\\beten\\b' are supported.
+
+    Every message is scanned once. All messages advance through the automaton at the
+    same time (one numpy step per character position), and every automaton state carries
+    a bitmask of the topics it completes. A message gets the first topic in precedence
+    order (the order of the keyword dict) that matched, or the default topic.
+
+    Attributes:
+        config (Config): Configuration object with the column names.
+        topics (list): topic names in precedence order.
+        default_topic (str): topic for messages without any keyword.
+    """
+    def __init__(self, config: Config, keywords: dict, default_topic: str):
+        self.config = config
+        self.topics = list(keywords.keys())
+        self.default_topic = default_topic
+        self.build_alphabet(keywords)
+        self.build_automaton(keywords)
+
+    def __call__(self, messages: pd.Series) -> pd.Series:
+        return self.tag(messages)
+
+    #******** automaton construction *******************
+
+    @staticmethod
+    def is_word(char: str) -> bool:
+        return char.isalnum() or char == '_'
+
+    def build_alphabet(self, keywords: dict) -> None:
+        """
+        Assigns a symbol to every keyword character and to the generic word/non-word classes.
+
+        Args:
+            keywords (dict): keyword lists per topic
+        """
+        chars = sorted({char for words in keywords.values() for word in words
+                        for char in word.lower().replace(BOUNDARY, '')})
+        self.symbols = {char: idx for idx, char in enumerate(chars)}
+        self.word_symbol = len(chars)
+        self.nonword_symbol = len(chars) + 1
+        self.n_symbols = len(chars) + 2
+        self.word_symbols = [self.symbols[c] for c in chars if self.is_word(c)] + [self.word_symbol]
+        self.nonword_symbols = [self.symbols[c] for c in chars if not self.is_word(c)] + [self.nonword_symbol]
+
+    def expand(self, keyword: str) -> list:
+        """
+        Translates a keyword into the symbol sequences it matches.
+
+        Args:
+            keyword (str): literal keyword, optionally with a leading/trailing \\b
+
+        Returns:
+            list: list of symbol sequences
+        """
+        word = keyword.lower()
+        head = word.startswith(BOUNDARY)
+        tail = word.endswith(BOUNDARY) and len(word) > len(BOUNDARY)
+        word = word[len(BOUNDARY) if head else None:-len(BOUNDARY) if tail else None]
+        if not word:
+            raise ValueError(f'Empty topic keyword: {keyword!r}')
+        core = [self.symbols[char] for char in word]
+        # a boundary sits between a word and a non-word character
+        prefixes = [[]]
+        if head:
+            prefixes = [[s] for s in (self.nonword_symbols if self.is_word(word[0]) else self.word_symbols)]
+        suffixes = [[]]
+        if tail:
+            suffixes = [[s] for s in (self.nonword_symbols if self.is_word(word[-1]) else self.word_symbols)]
+        return [prefix + core + suffix for prefix in prefixes for suffix in suffixes]
+
+    def build_automaton(self, keywords: dict) -> None:
+        """
+        Builds the dense goto table and the topic bitmask per state.
+
+        Args:
+            keywords (dict): keyword lists per topic, in precedence order
+        """
+        children = [{}]
+        output = [0]
+        for bit, words in enumerate(keywords.values()):
+            for keyword in words:
+                for sequence in self.expand(keyword):
+                    state = 0
+                    for symbol in sequence:
+                        if symbol not in children[state]:
+                            children[state][symbol] = len(children)
+                            children.append({})
+                            output.append(0)
+                        state = children[state][symbol]
+                    output[state] |= 1 << bit
+
+        goto = np.zeros((len(children), self.n_symbols), dtype=np.int32)
+        fail = np.zeros(len(children), dtype=np.int32)
+        queue = deque()
+        for symbol, child in children[0].items():
+            goto[0, symbol] = child
+            queue.append(child)
+        # breadth first: fail links and the completed goto table
+        while queue:
+            state = queue.popleft()
+            output[state] |= output[fail[state]]
+            goto[state] = goto[fail[state]]
+            for symbol, child in children[state].items():
+                fail[child] = goto[fail[state], symbol]
+                goto[state, symbol] = child
+                queue.append(child)
+        self.goto = goto
+        self.output = np.array(output, dtype=np.int64)
+        logger.info(f'Topic automaton: {len(children)} states, {self.n_symbols} symbols')
+
+    #******** tagging *******************
+
+    def encode(self, messages: pd.Series) -> tuple:
+        """
+        Encodes the lower case messages as one flat symbol array.
+
+        Every message is surrounded by a non-word separator, so boundaries at the start and
+        end of a message behave like \\b.
+
+        Args:
+            messages (pd.Series): message texts
+
+        Returns:
+            tuple: flat symbol array, start offset and scan length per message
+        """
+        lowered = pc.utf8_lower(pa.array(messages, type=pa.string(), from_pandas=True)).fill_null('')
+        lengths = pc.utf8_length(lowered).to_numpy().astype(np.int64) + 2
+        joined = '\x00' + '\x00'.join(lowered.to_pylist()) + '\x00'
+        codepoints = np.frombuffer(joined.encode('utf-32-le'), dtype=np.uint32)
+        unique, inverse = np.unique(codepoints, return_inverse=True)
+        lookup = np.array([self.symbols.get(chr(cp), self.word_symbol if self.is_word(chr(cp)) else self.nonword_symbol)
+                           for cp in unique], dtype=np.int32)
+        starts = np.concatenate([[0], np.cumsum(lengths - 1)[:-1]])
+        return lookup[inverse], starts, lengths
+
+    def match(self, messages: pd.Series) -> np.ndarray:
+        """
+        Runs all messages through the automaton.
+
+        Args:
+            messages (pd.Series): message texts
+
+        Returns:
+            np.ndarray: bitmask of matched topics per message
+        """
+        symbols, starts, lengths = self.encode(messages)
+        # longest messages first, so the active messages are always a prefix
+        order = np.argsort(-lengths, kind='stable')
+        starts, lengths = starts[order], lengths[order]
+        states = np.zeros(len(order), dtype=np.int32)
+        matched = np.zeros(len(order), dtype=np.int64)
+        active = len(order)
+        for position in range(int(lengths[0]) if len(order) else 0):
+            while active and lengths[active - 1] <= position:
+                active -= 1
+            states[:active] = self.goto[states[:active], symbols[starts[:active] + position]]
+            matched[:active] |= self.output[states[:active]]
+        result = np.empty_like(matched)
+        result[order] = matched
+        return result
+
+    @logger.catch
+    def tag(self, messages: pd.Series) -> pd.Series:
+        """
+        Assigns the first matching topic in precedence order to every message.
+
+        Args:
+            messages (pd.Series): message texts
+
+        Returns:
+            pd.Series: topic per message, same index as messages
+        """
+        matched = self.match(messages)
+        topics = np.full(len(matched), self.default_topic, dtype=object)
+        # walk the topics from lowest to highest precedence, so the first topic wins
+        for bit in reversed(range(len(self.topics))):
+            topics[(matched >> bit) & 1 == 1] = self.topics[bit]
+        return pd.Series(topics, index=messages.index, name=self.config.topic_col)
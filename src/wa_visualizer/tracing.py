@@ -0,0 +1,308 @@
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from functools import wraps
+from pathlib import Path
+from loguru import logger
+import pandas as pd
+from wa_visualizer.settings import (TraceSettings, traceSettings)
+
+PAGE_SIZE = resource.getpagesize()
+
+
+def resident_memory() -> float:
+    """
+    Resident memory of this process in MB.
+
+    Reads /proc/self/statm; elsewhere the maximum resident memory so far (getrusage) is used.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * PAGE_SIZE / 1e6
+    except OSError:
+        # kilobytes on Linux, bytes on macOS
+        scale = 1e6 if sys.platform == 'darwin' else 1e3
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+
+
+def count_rows(value) -> int:
+    """
+    Number of rows of a DataFrame (or Series), None for other values.
+    """
+    return len(value) if isinstance(value, (pd.DataFrame, pd.Series)) else None
+
+
+class Span:
+    """
+    An open span: a stage that is running.
+
+    Attributes:
+        name (str): name of the stage.
+        category (str): kind of stage, e.g. 'clean', 'preprocess' or 'visualize'.
+        rows_in (int): rows of the data when the stage started.
+        rows_out (int): rows of the output, set when the stage is done.
+        args (dict): extra values shown in the trace.
+    """
+    def __init__(self, name: str, category: str, rows_in: int = None, **args):
+        self.name = name
+        self.category = category
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.args = args
+        self.start = time.perf_counter_ns()
+        self.cpu = time.process_time()
+        self.rss_start = resident_memory()
+        self.rss_peak = self.rss_start
+        self.heap_start = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else 0
+        self.heap_peak = 0
+
+
+class Tracer:
+    """
+    Records spans of the pipeline stages and exports them as a Chrome trace.
+
+    Every span records the wall time, the CPU time of the process, the resident memory at the
+    start and its peak (sampled in a background thread), the peak Python heap (tracemalloc,
+    optional) and the rows of the data going in and out. Spans nest: a stage called by
+    another stage is a child span of it.
+
+    Spans of forked worker processes are recorded in the worker; the worker returns them
+    with its result (see drain) and they are added to the trace of this process (see merge),
+    with the process id of the worker.
+
+    When tracing is disabled, span and traced do nothing.
+
+    Attributes:
+        settings (TraceSettings): enabled, tracemalloc, sample interval and trace file.
+        events (list): recorded Chrome trace events.
+    """
+    def __init__(self, settings: TraceSettings):
+        self.settings = settings
+        self.events = []
+        self.open = []
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.sampler = None
+        self.origin = time.perf_counter_ns()
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self.after_fork)
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings.enabled
+
+    def start(self) -> None:
+        """
+        Enables tracing; the trace starts now.
+        """
+        self.settings.enabled = True
+        self.events = []
+        self.origin = time.perf_counter_ns()
+        if self.settings.tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.start_sampler()
+
+    def stop(self) -> None:
+        self.settings.enabled = False
+        self.stopped.set()
+        if self.sampler is not None:
+            self.sampler.join()
+            self.sampler = None
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def after_fork(self) -> None:
+        # the sampler thread and the spans of the parent do not exist in a forked child
+        self.lock = threading.Lock()
+        self.events = []
+        self.open = []
+        self.sampler = None
+        if self.enabled:
+            self.start_sampler()
+
+    #******** memory sampling *******************
+
+    def start_sampler(self) -> None:
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self.sample, name='trace-sampler', daemon=True)
+        self.sampler.start()
+
+    def sample(self) -> None:
+        """
+        Samples the resident memory: updates the peak of the open spans and records a counter event.
+        """
+        while not self.stopped.wait(self.settings.sample_interval):
+            rss = resident_memory()
+            with self.lock:
+                for span in self.open:
+                    span.rss_peak = max(span.rss_peak, rss)
+                self.events.append({'name': 'memory', 'ph': 'C', 'ts': self.timestamp(time.perf_counter_ns()),
+                                    'pid': os.getpid(), 'args': {'rss MB': round(rss, 1)}})
+
+    #******** spans *******************
+
+    def timestamp(self, ns: int) -> float:
+        # microseconds since the start of the trace
+        return (ns - self.origin) / 1000
+
+    @contextmanager
+    def span(self, name: str, category: str = 'stage', rows_in: int = None, **args):
+        """
+        Records a span around the block; set rows_out on the yielded span to record the output size.
+
+        Args:
+            name (str): name of the span
+            category (str, optional): kind of stage
+            rows_in (int, optional): rows of the input
+            args: extra values shown in the trace
+
+        Yields:
+            Span: the open span, None when tracing is disabled
+        """
+        if not self.enabled:
+            yield None
+            return
+        span = Span(name, category, rows_in, **args)
+        with self.lock:
+            self.open.append(span)
+        try:
+            yield span
+        finally:
+            self.close(span)
+
+    def close(self, span: Span) -> None:
+        end = time.perf_counter_ns()
+        rss = resident_memory()
+        with self.lock:
+            self.open.remove(span)
+            parent = self.open[-1] if self.open else None
+        span.rss_peak = max(span.rss_peak, rss)
+        heap = None
+        if tracemalloc.is_tracing():
+            # the peak of a child span is passed to its parent before the peak is reset
+            peak = max(tracemalloc.get_traced_memory()[1], span.heap_peak)
+            heap = (peak - span.heap_start) / 1e6
+            if parent is not None:
+                parent.heap_peak = max(parent.heap_peak, peak)
+            tracemalloc.reset_peak()
+        args = {
+            'cpu s': round(time.process_time() - span.cpu, 4),
+            'rss start MB': round(span.rss_start, 1),
+            'rss peak MB': round(span.rss_peak, 1),
+            'heap peak MB': None if heap is None else round(heap, 1),
+            'rows in': span.rows_in,
+            'rows out': span.rows_out,
+            **span.args,
+        }
+        event = {'name': span.name, 'cat': span.category, 'ph': 'X', 'ts': self.timestamp(span.start),
+                 'dur': (end - span.start) / 1000, 'pid': os.getpid(), 'tid': threading.get_ident(),
+                 'args': {key: value for key, value in args.items() if value is not None}}
+        with self.lock:
+            self.events.append(event)
+
+    #******** worker processes *******************
+
+    def drain(self) -> list:
+        """
+        Returns and removes the recorded events, to send them from a worker to the parent.
+        """
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+    def merge(self, events: list) -> None:
+        """
+        Adds the events recorded by a worker process.
+        """
+        with self.lock:
+            self.events.extend(events)
+
+    #******** output *******************
+
+    def summary(self) -> pd.DataFrame:
+        """
+        Totals per stage, the slowest first.
+
+        Returns:
+            pd.DataFrame: calls, wall and CPU seconds, highest peak memory and rows of every stage
+        """
+        spans = [event for event in self.events if event['ph'] == 'X']
+        if not spans:
+            return pd.DataFrame()
+        df = pd.DataFrame([{'stage': event['name'], 'calls': 1, 'wall s': event['dur'] / 1e6,
+                            'cpu s': event['args'].get('cpu s'), 'rss peak MB': event['args'].get('rss peak MB'),
+                            'heap peak MB': event['args'].get('heap peak MB'),
+                            'rows in': event['args'].get('rows in'), 'rows out': event['args'].get('rows out')}
+                           for event in spans])
+        summary = df.groupby('stage', sort=False).agg({'calls': 'sum', 'wall s': 'sum', 'cpu s': 'sum',
+                                                       'rss peak MB': 'max', 'heap peak MB': 'max',
+                                                       'rows in': 'max', 'rows out': 'max'})
+        summary[['rows in', 'rows out']] = summary[['rows in', 'rows out']].astype('Int64')
+        return summary.dropna(axis=1, how='all').sort_values('wall s', ascending=False)
+
+    def export(self, filepath: Path = None) -> Path:
+        """
+        Writes the recorded events as a Chrome trace (JSON object format).
+
+        Args:
+            filepath (Path, optional): output file, defaults to settings.trace_file
+
+        Returns:
+            Path: the written file
+        """
+        filepath = Path(filepath or self.settings.trace_file)
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            events = sorted(self.events, key=lambda event: event['ts'])
+        with open(filepath, 'w', encoding='utf-8') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        logger.info(f"Trace with {len(events)} events written to {filepath}")
+        return filepath
+
+    def report(self) -> None:
+        """
+        Stops tracing, logs the summary table and writes the Chrome trace.
+        """
+        self.stop()
+        summary = self.summary()
+        if not summary.empty:
+            logger.info("Stage profile:\n" + summary.to_string(float_format=lambda value: f"{value:.3f}"))
+        self.export()
+
+
+# one tracer per process, its spans are collected from the forked workers
+tracer = Tracer(traceSettings)
+
+
+def traced(name: str = None, category: str = 'stage'):
+    """
+    Decorator recording a span for every call of a stage method, see Tracer.
+
+    The rows in are the rows of the first DataFrame argument or else of self.data; the rows
+    out are the rows of the returned DataFrame or else of self.data after the call.
+
+    Args:
+        name (str, optional): name of the span, defaults to the qualified name of the method.
+        category (str, optional): kind of stage.
+    """
+    def decorator(stage):
+        label = name or stage.__qualname__
+
+        @wraps(stage)
+        def wrapper(self, *args, **kwargs):
+            if not tracer.enabled:
+                return stage(self, *args, **kwargs)
+            frame = next((arg for arg in args if isinstance(arg, pd.DataFrame)), getattr(self, 'data', None))
+            with tracer.span(label, category, rows_in=count_rows(frame)) as span:
+                output = stage(self, *args, **kwargs)
+                span.rows_out = count_rows(output)
+                if span.rows_out is None:
+                    span.rows_out = count_rows(getattr(self, 'data', None))
+            return output
+        return wrapper
+    return decorator
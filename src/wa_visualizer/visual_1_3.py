@@ -7,6 +7,7 @@ import matplotlib.pyplot as plt
 from wa_visualizer.settings import Config
 from wa_visualizer.basic_plots import BasicPlot
 from wa_visualizer.data_processing import Preprocessor
+from wa_visualizer.tracing import traced
 from loguru import logger
 
 class BarPlot(BasicPlot):
@@ -49,14 +50,15 @@ class BarPlot(BasicPlot):
             stacked (bool, optional): If True, bars will be stacked. Defaults to False.
         """
         # Plotting
-        ax = data.plot(kind='bar', stacked=stacked, figsize=(10, 8), color=self.custom_colors)
+        _, ax = self.new_figure(figsize=(10, 8))
+        data.plot(kind='bar', stacked=stacked, color=self.custom_colors, ax=ax)
 
         
-        plt.title(self.title_fig)
-        plt.ylabel(self.ylabel)
-        plt.xlabel(self.xlabel)
-        plt.xticks(rotation=45)
-        plt.legend(title=self.legend_title, bbox_to_anchor=(1.05, 1), loc='upper left')
+        ax.set_title(self.title_fig)
+        ax.set_ylabel(self.ylabel)
+        ax.set_xlabel(self.xlabel)
+        ax.tick_params(axis='x', labelrotation=45)
+        ax.legend(title=self.legend_title, bbox_to_anchor=(1.05, 1), loc='upper left')
 
 
 class BarPlotVisualizer(Preprocessor):
@@ -74,6 +76,22 @@ class BarPlotVisualizer(Preprocessor):
         """
         Creates a bar plot visualization for week 1 data.
         """
+        self.plot_week1(self.prepare_week1())
+
+    @traced(category='visualize')
+    def prepare_week1(self) -> pd.DataFrame:
+        """
+        Returns the aggregated language data plotted in week 1.
+        """
+        if self.preprocessor.cube is not None:
+            return self.preprocessor.cube.aggregate_languages(self.config.verbal_cat)
+        return self.preprocessor.preprocess_week1()
+
+    @traced(category='visualize')
+    def plot_week1(self, processed_data: pd.DataFrame):
+        """
+        Draws the week 1 bar plot from the prepared data.
+        """
         plot = BarPlot(
             title_fig="Woorden spreken luider dan beelden",
             ylabel="% van berichten",
@@ -82,13 +100,28 @@ class BarPlotVisualizer(Preprocessor):
             config=self.config
         )
         plot.custom_colors = ["lightgray", 'salmon']
-        processed_data = self.preprocessor.preprocess_week1()
         plot(processed_data, False)
 
     def visualization_week3(self):
         """
         Creates a bar plot visualization for week 3 data.
         """
+        self.plot_week3(self.prepare_week3())
+
+    @traced(category='visualize')
+    def prepare_week3(self) -> pd.DataFrame:
+        """
+        Returns the normalized topic counts per hour plotted in week 3.
+        """
+        if self.preprocessor.cube is not None:
+            return self.preprocessor.cube.topic_counts()
+        return self.preprocessor.preprocess_week3()
+
+    @traced(category='visualize')
+    def plot_week3(self, df_counts_normalized: pd.DataFrame):
+        """
+        Draws the week 3 stacked bar plot from the prepared data.
+        """
         plot = BarPlot(
             title_fig="Kom je naar huis? Tiener appjes van 's ochtens vroeg tot diep in de nacht",
             ylabel="% van Totaal berichten",
@@ -98,5 +131,4 @@ class BarPlotVisualizer(Preprocessor):
             legend_title='Onderwerpen',
         )
         plot.custom_colors = self.config.color_palette
-        df_counts_normalized = self.preprocessor.preprocess_week3()
         plot(df_counts_normalized, True)
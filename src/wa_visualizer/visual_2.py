@@ -6,6 +6,8 @@ from pathlib import Path
 from wa_visualizer.settings import Config
 from wa_visualizer.basic_plots import (BasicScatterPlot, VerticalLine, MovingAverageLinePlot)
 from wa_visualizer.data_processing import Preprocessor
+from wa_visualizer.tracing import traced
+from wa_visualizer.time_buckets import TimeBuckets
 from loguru import logger
 
 class TimeSeriesPlot(BasicScatterPlot):
@@ -54,8 +56,8 @@ class TimeSeriesPlot(BasicScatterPlot):
             p (pd.DataFrame): Data for the main time series.
             p_corona (pd.DataFrame): Data for the highlighted time series during the pandemic.
         """
-        _, ax = plt.subplots(figsize=(12, 6))
-        plt.title(self.title_fig)
+        _, ax = self.new_figure(figsize=(12, 6))
+        ax.set_title(self.title_fig)
 
         # Scatter plots using Seaborn
         self.plot(p.index, p[self.config.timestamp_col], ax=ax, color=self.color)
@@ -83,7 +85,6 @@ class TimeSeriesPlot(BasicScatterPlot):
 
 
         # Save the plot
-        filename = self.config.img_dir / Path(self.filename)
         self.save()
         self.show_plot()  # Show the plot with the legend setting
 
@@ -109,6 +110,31 @@ class TimeSeriesPlotVisualizer(Preprocessor):
         This visualization focuses on the number of messages over time,
         particularly during the lockdown periods.
         """
+        self.plot_week2(self.prepare_week2())
+
+    @traced(category='visualize')
+    def prepare_week2(self) -> tuple:
+        """
+        Returns the message counts per week of the whole period and of the lockdown period.
+
+        Returns:
+            tuple: message counts (p) and lockdown message counts (p_corona)
+        """
+        cube = self.preprocessor.cube
+        if cube is not None:
+            period = map(self.preprocessor.parse_date, self.preprocessor.period)
+            lockdown = map(self.preprocessor.parse_date, self.preprocessor.lockdown)
+            return cube.calc_messages(*period), cube.calc_messages(*lockdown)
+        df_corona, df = self.preprocessor.preprocess_week2()
+        p = self.preprocessor.calc_messages(df)
+        p_corona = self.preprocessor.calc_messages(df_corona)
+        return p, p_corona
+
+    @traced(category='visualize')
+    def plot_week2(self, counts: tuple):
+        """
+        Draws the week 2 time series plot from the prepared message counts.
+        """
         plot = TimeSeriesPlot(
             title_fig="Digitale stilte in tijden van lockdown: van pixel naar persoonlijk",
             xlabel="Periode jaartal-weeknummer",
@@ -119,9 +145,9 @@ class TimeSeriesPlotVisualizer(Preprocessor):
             show_legend=False,  # Do not show legend in this plot
             config=self.config
         )
-        df_corona, df = self.preprocessor.preprocess_week2()
-        p = self.preprocessor.calc_messages(df)
-        p_corona = self.preprocessor.calc_messages(df_corona)
+        # the weeks are counted on integer keys, they get their year-week labels here
+        weeks = TimeBuckets('week')
+        p, p_corona = (frame.set_axis(weeks.labels(frame.index).rename(frame.index.name)) for frame in counts)
         plot(p, p_corona)
 
         
\ No newline at end of file
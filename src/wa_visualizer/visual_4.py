@@ -6,6 +6,7 @@ import matplotlib.pyplot as plt
 from wa_visualizer.settings import Config
 from wa_visualizer.basic_plots import BasicPlot
 from wa_visualizer.data_processing import Preprocessor
+from wa_visualizer.tracing import traced
 from loguru import logger
 
 class FacetGridPlot(BasicPlot):
@@ -46,7 +47,9 @@ class FacetGridPlot(BasicPlot):
         g.set_axis_labels(self.xlabel, self.ylabel)
 
         # Adjust layout to avoid overlap with the main title
-        plt.subplots_adjust(top=0.85)
+        g.fig.subplots_adjust(top=0.85)
+        # the grid creates its own figure, the last facet gets the labels of show_plot
+        self.fig, self.ax = g.fig, g.axes.flat[-1]
 
         # Save the plot
         self.save()
@@ -98,6 +101,22 @@ class RelationshipsPlotVisualizer(Preprocessor):
 
         The plot is saved as '4_relationships_visualization.png'.
 
+        """
+        self.plot_week4(self.prepare_week4())
+
+    @traced(category='visualize')
+    def prepare_week4(self) -> pd.DataFrame:
+        """
+        Returns the average log message length per age and emoji status plotted in week 4.
+        """
+        if self.preprocessor.cube is not None:
+            return self.preprocessor.cube.average_log_length(self.preprocessor.dob_mapping)
+        return self.preprocessor.preprocess_week4()
+
+    @traced(category='visualize')
+    def plot_week4(self, avg_log_df: pd.DataFrame):
+        """
+        Draws the week 4 facet grid from the prepared data.
         """
         plot = FacetGridPlot(
             config=self.config,
@@ -107,9 +126,6 @@ class RelationshipsPlotVisualizer(Preprocessor):
             filename='4_relationships_visualization.png',
         )
 
-        # Preprocess the data for week 4 (average log-transformed message length)
-        avg_log_df = self.preprocessor.preprocess_week4()
-
         # Create the plot using the preprocessed data
         plot(avg_log_df, self.config.age_col, self.config.log_length_col, scatter_size=60)
 
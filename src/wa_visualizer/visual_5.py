@@ -5,28 +5,32 @@ import pandas as pd
 from wa_visualizer.settings import (Config, Embedding)
 from wa_visualizer.basic_plots import BasicPlot
 from wa_visualizer.data_processing import Preprocessor
+from wa_visualizer.tracing import traced
 
 class ScatterPlot(BasicPlot):
     """
     A class for creating scatter plots using Seaborn.
 
     Args:
+        config (Config): Configuration object containing settings for the plot.
         title_fig (str): Title of the figure.
         xlabel (str): Label for the x-axis.
         ylabel (str): Label for the y-axis.
         filename (str): Filename for saving the plot.
         figsize (tuple, optional): The size of the figure in inches (width, height). Default is (20, 8).
         custom_palette (list): Custom color palette for the scatter plot.
+        ax (Axes): Axes of a shared figure to draw on.
         metadata_lb (str, optional): Label for metadata used in hue. Defaults to "author".
         alpha (float, optional): Alpha transparency for the points. Defaults to 0.9.
     """
 
-    def __init__(self, title_fig: str, xlabel: str, ylabel: str, filename: str, custom_palette: list, ax, hue: str, metadata_lb: str = "topic", alpha: float = 0.9, figsize=(20, 8)):
-        super().__init__(title_fig, xlabel, ylabel, filename, figsize)
+    def __init__(self, config: Config, title_fig: str, xlabel: str, ylabel: str, filename: str, custom_palette: list, ax, hue: str, metadata_lb: str = "topic", alpha: float = 0.9, figsize=(20, 8)):
+        super().__init__(config, title_fig, xlabel, ylabel, filename, figsize)
         self.custom_palette = custom_palette
         self.metadata_lb = metadata_lb
         self.alpha = alpha
         self.ax = ax  # Keep track of the axis for plotting
+        self.fig = ax.figure
 
     def plot(self, X: np.ndarray, emb: Embedding)->None:
         """
@@ -90,7 +94,8 @@ class TSNEPlotVisualizer:
             None: The function displays the plot and saves the second plot to a file.
         """
         # Create subplots (1 row, 2 columns)
-        fig, axs = plt.subplots(1, 2, figsize=(20, 8))  
+        canvas = BasicPlot(self.config, title_fig='', xlabel='', ylabel='', filename=filename)
+        fig, axs = canvas.new_figure(figsize=(20, 8), nrows=1, ncols=2)
 
         # Extract labels from metadata
         labels_1 = [emb.metadata[i][self.config.topic_col] for i in range(len(emb.metadata))]
@@ -98,6 +103,7 @@ class TSNEPlotVisualizer:
 
         # Create ScatterPlot instance for 'topic'
         scatter_plot_1 = ScatterPlot(
+            config=self.config,
             title_fig='Focus en Flair: Gespreksonderwerpen die ertoe doen',
             xlabel='t-SNE Component 1',
             ylabel='t-SNE Component 2',
@@ -112,6 +118,7 @@ class TSNEPlotVisualizer:
 
         # Create ScatterPlot instance for 'language'
         scatter_plot_2 = ScatterPlot(
+            config=self.config,
             title_fig='Van pizza tot strand: Italiaans is de taal van eten en vakanties',
             xlabel='t-SNE Component 1',
             ylabel='t-SNE Component 2',
@@ -129,13 +136,15 @@ class TSNEPlotVisualizer:
 
         # Set ticks and grid for the whole figure
         # Adjust the xticks and yticks and round to nearest integer for a clean layout
-        plt.xticks(np.arange(np.floor(np.min(X[:, 0])), np.ceil(np.max(X[:, 0])) + 1, step=20))  
-        plt.yticks(np.arange(np.floor(np.min(X[:, 1])), np.ceil(np.max(X[:, 1])) + 1, step=20))  
-        plt.grid(True)
+        axs[1].set_xticks(np.arange(np.floor(np.min(X[:, 0])), np.ceil(np.max(X[:, 0])) + 1, step=20))  
+        axs[1].set_yticks(np.arange(np.floor(np.min(X[:, 1])), np.ceil(np.max(X[:, 1])) + 1, step=20))  
+        axs[1].grid(True)
 
         # Adjust layout and show plot
-        plt.tight_layout()
-        plt.show()
+        fig.tight_layout()
+        if not canvas.headless:
+            plt.show()
+        canvas.close()
 
       
     def visualization_week5(self):
@@ -145,15 +154,30 @@ class TSNEPlotVisualizer:
         This method processes the data, applies the t-SNE algorithm,
         and generates scatter plots for verbal messages.
         """
-        # Processing pipeline
-        model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+        self.plot_week5(self.prepare_week5())
+
+    @traced(category='visualize')
+    def prepare_week5(self) -> tuple:
+        """
+        Returns the t-SNE map and the embeddings of the verbal messages plotted in week 5.
+
+        Returns:
+            tuple: map positions (X) and the embeddings with their metadata (emb)
+        """
+        df = self.preprocessor.data
         # Select subset with verbal messages
         subset_verbal = df[df[self.config.language_col] != self.config.nonverbal_cat].reset_index(drop=True)
         # Select subset with message log length above 3
         subset = subset_verbal[np.log(subset_verbal[self.config.message_length_col]) >= 3].reset_index(drop=True)
         # Preprocessing step for t-SNE data
-        X, emb = self.preprocessor.preprocess_week5(subset)  # Replace with actual method to get X and emb
+        return self.preprocessor.preprocess_week5(subset)
 
+    @traced(category='visualize')
+    def plot_week5(self, tsne: tuple):
+        """
+        Draws the week 5 double scatterplot from the prepared map and embeddings.
+        """
+        X, emb = tsne
         #create double scatterplot with title and filename
-        self.plot_all_tsne(X, emb)
+        self.plot_all_tsne(X, emb, self.custom_palette)
         
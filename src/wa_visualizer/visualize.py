@@ -1,4 +1,5 @@
 import datetime
+from dataclasses import replace
 from pathlib import Path
 import tomllib
 from loguru import logger
@@ -6,22 +7,32 @@ import pandas as pd
 import seaborn as sns
 import matplotlib.pyplot as plt
 import click
+import pyarrow.parquet as pq
 import numpy as np
 from wa_visualizer.data_cleaning import DataCleaner
 from wa_visualizer.data_processing import Preprocessor
-from wa_visualizer.settings import (BaseRegexes, Folders, Config, BaseStrings, keywordsFilter, extraRegexes, basicConfig)
+from wa_visualizer.settings import (BaseRegexes, Folders, Config, BaseStrings, keywordsFilter, extraRegexes, basicConfig, renderSettings, writeSettings, embeddingSettings, mapSettings, querySettings, traceSettings)
 from wa_visualizer.filehandler import FileHandler
-from wa_visualizer.visual_1_3 import BarPlotVisualizer
-from wa_visualizer.visual_2 import TimeSeriesPlotVisualizer
-from wa_visualizer.visual_4 import RelationshipsPlotVisualizer
-from wa_visualizer.visual_5 import TSNEPlotVisualizer
+from wa_visualizer.pipeline import (PipelineScheduler, STAGES, projection)
+from wa_visualizer.renderer import (FigureRenderer, FigureStore)
+from wa_visualizer.incremental import IncrementalProcessor
+from wa_visualizer.stage_cache import StageCache
+from wa_visualizer.aggregate_cube import AggregateCube
+from wa_visualizer.data_writer import dataWriter
+from wa_visualizer.query_engine import QueryEngine
+from wa_visualizer.tracing import tracer
+from wa_visualizer.batch import BatchProcessor
+from wa_visualizer.chunked import ChunkedPreprocessor
+from wa_visualizer.sketches import (MEASURES, SketchStore)
+from wa_visualizer.search_index import IndexStore
 import sys
 
-def run_visualization_pipeline(folders, week, all=False):
+def run_visualization_pipeline(folders, week, all=False, cache=True, workers=None, render_only=False, filters=None,
+                               config=basicConfig, chunk_size=None):
     """
     Runs a series of visualizations based on the specified week or for all weeks, processing and visualizing data 
-    step-by-step. This function uses a pipeline approach to process data and generate various types of plots for 
-    each week of the data.
+    step-by-step. The weeks are scheduled as a dependency graph: weeks that do not depend on each other run
+    concurrently in a process pool that shares one load of the data.
 
     Args:
         folders (list): List of folder paths containing the data to be processed.
@@ -29,6 +40,13 @@ def run_visualization_pipeline(folders, week, all=False):
                     'all' to visualize plots for all weeks.
         all (bool, optional): If True, generates visualizations for all weeks. Default is False, meaning only 
                                the visualization for the specified week is created.
+        cache (bool, optional): If True, preprocessing results are cached on disk next to the processed data.
+        workers (int, optional): Maximum number of worker processes, defaults to the number of cores.
+        render_only (bool, optional): If True, only renders the figures from the figure data of an earlier run.
+        filters (ds.Expression, optional): Only loads the messages matching the filter, see FileHandler.row_filter.
+        config (Config, optional): Configuration with the column names and the image folder. Default is basicConfig.
+        chunk_size (int, optional): Streams the processed data in chunks of this many messages instead of loading it,
+                                    see ChunkedPreprocessor. Default is None, loading all data.
     
     This function supports visualizing the following plots:
         - Week 1: Bar plots showing basic distribution of data.
@@ -36,70 +54,60 @@ def run_visualization_pipeline(folders, week, all=False):
         - Week 3: Bar plots comparing different categories.
         - Week 4: Relationship plots exploring correlations between different variables.
         - Week 5: t-SNE plots showing high-dimensional data reduced to 2D space.
+
+    Returns:
+        list: the weeks whose figures were not written, because the pipeline or the rendering failed.
     """
-    # Start preprocessor for week visualization
-    preprocessor = Preprocessor(folders, basicConfig, keywordsFilter)
-    # Initialize plot visualizer object
-    bar_plot_visualizer = False
-
-    # Visualize plot for week 1 or all weeks
-    if week.lower() == "1" or all:
-        print("Visualizing plot for week 1")
-        if not bar_plot_visualizer:
-            bar_plot_visualizer = BarPlotVisualizer(preprocessor)
-        bar_plot_visualizer.visualization_week1()
-
-    # Visualize plot for week 2 or all weeks
-    if week.lower() == "2" or all:
-        print("Visualizing plot for week 2")
-        time_series_plot_visualizer = TimeSeriesPlotVisualizer(preprocessor)
-        time_series_plot_visualizer.visualization_week2()
-
-    # Visualize plot for week 3 or all weeks
-    if week.lower() == "3" or all:
-        print("Visualizing plot for week 3")
-        if not bar_plot_visualizer:
-            bar_plot_visualizer = BarPlotVisualizer(preprocessor)
-        bar_plot_visualizer.visualization_week3()
-
-    # Visualize plot for week 4 or all weeks
-    if week.lower() == "4" or all:
-        print("Visualizing plot for week 4")
-        relationships_plot_visualizer = RelationshipsPlotVisualizer(preprocessor)
-        relationships_plot_visualizer.visualization_week4()
-
-    # Visualize plot for week 5 or all weeks
-    if week.lower() == "5" or all:
-        print("Visualizing plot for week 5")
-        relationships_plot_visualizer = TSNEPlotVisualizer(preprocessor)
-        relationships_plot_visualizer.visualization_week5()
-
-
-@click.command()
-@click.option("--week", default="1", help="Week number: input 1 to 5")
-@click.option("--all", is_flag=True, help="Generate all visualizations")
-def main(week, all):
-    """
-    Main function to execute data visualization for specified week.
+    weeks = list(STAGES) if all or week.lower() == "all" else [week]
+    # prepared figure data, rendered headless in a pool of workers in batch mode
+    figures = FigureStore(Path(folders.datafile).parent / 'figures')
+    failed = []
+    if render_only:
+        pending = weeks
+    else:
+        if chunk_size:
+            # out of core: the cube and the week 5 messages are built chunk by chunk
+            preprocessor = ChunkedPreprocessor(folders, config, keywordsFilter, chunk_size, filters)(weeks)
+        else:
+            # Start preprocessor for week visualization, loading only the columns the weeks read
+            # (the schema of the first file of the processed store, once the background writer has
+            # written the cleaned data; an incremental run without a datafile only has parts)
+            dataWriter.flush()
+            store = FileHandler(folders, config, load=False).data_files()
+            if not store:
+                raise FileNotFoundError(f"No processed data found at {folders.datafile}")
+            columns = projection(config, weeks, pq.read_schema(store[0]).names)
+            preprocessor = Preprocessor(folders, config, keywordsFilter, columns=columns, filters=filters)
+        if cache:
+            stage_cache = StageCache(Path(folders.datafile).parent / 'cache',
+                                     (config, keywordsFilter, extraRegexes, preprocessor.dob_mapping,
+                                      embeddingSettings, mapSettings))
+            preprocessor.enable_cache(stage_cache)
+        if not chunk_size:
+            # the weekly aggregates are answered from the aggregate cube
+            preprocessor.enable_cube(AggregateCube(folders, config))
+            preprocessor.enable_sketches(SketchStore(folders, config))
+        scheduler = PipelineScheduler(preprocessor, workers, figures)
+        pending = scheduler(weeks)
+        # finish the background writes before the render pool forks
+        dataWriter.flush()
+        if pending is None:
+            # the pipeline failed and logged the error
+            return weeks
+        # the weeks that failed are logged, the others are still rendered
+        failed = [week for week in weeks if week in scheduler.failed]
+    if pending:
+        return failed + FigureRenderer(folders, config, keywordsFilter, figures, workers)([STAGES[week] for week in pending])
+    return failed
 
-    Args:
-        week (str): The week number (1 to 7) to visualize.
-        all (bool): Flag to indicate whether to generate all visualizations.
-    
-    Raises:
-        ValueError: If the specified week number is not between 1 and 5.
-        FileNotFoundError: If the specified file is not found
-        General Error: for all other cases
+
+def read_folders() -> Folders:
     """
-    #start logger
-    logger.remove()
-    logger.add('./logs/logfile.log' , rotation="1 week", level="DEBUG")
-    logger.add(sys.stderr, level="INFO")
-    
-    possible_options = ["all", '1', '2', '3', '4', '5']
-    if week not in possible_options:
-        raise ValueError('Must be a number between 1 and 7')
+    Reads the paths of the raw and processed data from config.toml in the working directory.
 
+    Returns:
+        Folders: paths of the data
+    """
     configfile = Path("./config.toml").resolve()
     # read configuration file
     with open("config.toml", "rb") as f:
@@ -117,23 +125,118 @@ def main(week, all):
     datafile = (Path(".") / processed / config["current"]).resolve()
     csv_datafile = (Path(".") / processed / config["csv"]).resolve()
 
+    # native .txt export, streamed in chunks when given as input
+    rawtxt = None
+    if config.get("input", "").endswith(".txt"):
+        rawtxt = (Path(".") / raw / config["input"]).resolve()
+
     # Define folder paths
-    folders = Folders(
+    return Folders(
             raw=raw,
             processed=processed,
             datafile = datafile,
             rawdatafile = rawdatafile,
             csvraw =csvraw,            
-            csv=csv_datafile    
+            csv=csv_datafile,
+            rawtxt=rawtxt
         )
 
+
+@click.group(invoke_without_command=True)
+@click.option("--week", default="1", help="Week number: input 1 to 5")
+@click.option("--all", is_flag=True, help="Generate all visualizations")
+@click.option("--incremental", is_flag=True, help="Only process messages newer than the last run")
+@click.option("--no-cache", is_flag=True, help="Recompute all preprocessing stages")
+@click.option("--workers", default=None, type=int, help="Maximum number of worker processes, defaults to the number of cores")
+@click.option("--render-only", is_flag=True, help="Only render the figures from the data of the last run")
+@click.option("--formats", default="png", help="Comma separated output formats, for example png,svg,pdf")
+@click.option("--no-csv", is_flag=True, help="Only write the parquet files, skip the csv export")
+@click.option("--since", default=None, type=click.DateTime(formats=["%Y-%m-%d"]), help="Only use messages from this day on (YYYY-MM-DD)")
+@click.option("--until", default=None, type=click.DateTime(formats=["%Y-%m-%d"]), help="Only use messages up to this day (YYYY-MM-DD)")
+@click.option("--authors", default=None, help="Comma separated authors, only use their messages")
+@click.option("--chunk-size", default=None, type=int, help="Stream the processed data in chunks of this many messages instead of loading it all (out of core)")
+@click.option("--profile", is_flag=True, help="Trace every stage: time, CPU, memory and rows, with a summary and a Chrome trace")
+@click.option("--profile-heap", is_flag=True, help="With --profile, also trace the peak Python heap (slower)")
+@click.option("--trace-file", default=None, type=click.Path(dir_okay=False, path_type=Path), help="Output file of the Chrome trace, defaults to logs/trace.json")
+@click.pass_context
+def main(ctx, week, all, incremental, no_cache, workers, render_only, formats, no_csv, since, until, authors,
+         chunk_size, profile, profile_heap, trace_file):
+    """
+    Main function to execute data visualization for specified week.
+
+    Without a subcommand the visualizations are created; see query for the SQL subcommand.
+
+    Args:
+        ctx (click.Context): context of the command line, with the subcommand to run.
+        week (str): The week number (1 to 7) to visualize.
+        all (bool): Flag to indicate whether to generate all visualizations.
+        incremental (bool): Flag to append only new messages to the processed data.
+        no_cache (bool): Flag to disable the preprocessing stage cache.
+        workers (int): Maximum number of worker processes.
+        render_only (bool): Flag to only render the figures from the prepared data of the last run.
+        formats (str): Comma separated output formats of the figures.
+        no_csv (bool): Flag to skip the csv export of the processed data.
+        since (datetime): First day of the messages to use.
+        until (datetime): Last day of the messages to use.
+        authors (str): Comma separated authors whose messages are used.
+        chunk_size (int): Number of messages per chunk when the processed data is streamed instead of loaded.
+        profile (bool): Flag to trace the stages and report where the time and memory go.
+        profile_heap (bool): Flag to also trace the Python heap of every stage.
+        trace_file (Path): Output file of the Chrome trace.
+    
+    Raises:
+        ValueError: If the specified week number is not between 1 and 5.
+        FileNotFoundError: If the specified file is not found
+        General Error: for all other cases
+    """
+    #start logger
+    logger.remove()
+    logger.add('./logs/logfile.log' , rotation="1 week", level="DEBUG")
+    logger.add(sys.stderr, level="INFO")
+    
+    possible_options = ["all", '1', '2', '3', '4', '5']
+    if week not in possible_options:
+        raise ValueError('Must be a number between 1 and 7')
+
+    # batch mode renders headless, without opening windows
+    renderSettings.formats = tuple(extension.strip().lstrip('.') for extension in formats.split(',') if extension.strip())
+    renderSettings.headless = all or week == "all" or render_only
+    writeSettings.csv = writeSettings.csv and not no_csv
+    if profile:
+        traceSettings.tracemalloc = profile_heap
+        traceSettings.trace_file = trace_file or traceSettings.trace_file
+        tracer.start()
+        # the summary and the trace are written when the command is done
+        ctx.call_on_close(tracer.report)
+    # the options above also apply to the subcommands
+    if ctx.invoked_subcommand is not None:
+        return
+    # row filter pushed down to the parquet reader
+    filters = FileHandler.row_filter(basicConfig, since and since.date(), until and until.date(),
+                                     [author.strip() for author in authors.split(',')] if authors else None)
+
+    folders = read_folders()
+    datafile, csv_datafile = folders.datafile, folders.csv
+
     # check raw datafile existance
-    if not raw.exists() and not csv_raw.exists():
+    if not folders.raw.exists() and not folders.csvraw.exists():
         # Data files does not exist.
         logger.warning("Datafile or csv file does not exists. Please check your path in the config.toml file.")
     
+    if render_only:
+        # redraw the figures from the prepared data, without preprocessing
+        run_visualization_pipeline(folders, week, all, workers=workers, render_only=True)
+
+    elif incremental:
+        # clean, tag and append only the messages after the watermark
+        try:
+            IncrementalProcessor(folders, extraRegexes, basicConfig, keywordsFilter)()
+            run_visualization_pipeline(folders, week, all, not no_cache, workers, filters=filters, chunk_size=chunk_size)
+        except FileNotFoundError as e:
+            logger.error(f"File not found during incremental processing: {e}")
+
     # do cleaning step once, if processed files do not exist
-    if not datafile.exists() or not csv_datafile.exists():
+    elif not datafile.exists() or (writeSettings.csv and not csv_datafile.exists()):
        
         # Datafile or csv doesn't exist, so we need to run the cleaning step.
         try:
@@ -142,7 +245,7 @@ def main(week, all):
             # Run clean and save data to processed folder
             cleandata()
             # run visualizations
-            run_visualization_pipeline(folders, week, all)
+            run_visualization_pipeline(folders, week, all, not no_cache, workers, filters=filters, chunk_size=chunk_size)
         except FileNotFoundError as e:
             # Specific exception if the file is not found
             logger.error(f"File not found during data cleaning: {e}")
@@ -156,8 +259,133 @@ def main(week, all):
     else:
         # Data files exist, no need to clean. Proceed with the next steps.
         logger.info("Source datafile and csv file exists. Proceeding with visualization processing.")
-        run_visualization_pipeline(folders, week, all)
+        run_visualization_pipeline(folders, week, all, not no_cache, workers, filters=filters, chunk_size=chunk_size)
     
     
+@main.command()
+@click.argument("sql")
+@click.option("--output", default=None, type=click.Path(dir_okay=False, path_type=Path), help="Output file, defaults to csv on stdout")
+@click.option("--format", "fmt", default="csv", type=click.Choice(["csv", "parquet"]), help="Output format")
+@click.option("--threads", default=None, type=int, help="Number of query threads, defaults to the number of cores")
+@click.option("--memory-limit", default=None, help="Memory limit of the query, for example 4GB; larger results spill to disk")
+def query(sql, output, fmt, threads, memory_limit):
+    """
+    Runs a SQL query on the processed chat and streams the result.
+
+    The views messages (all processed messages) and cube (the aggregate cube) are available, for example:
+    visualizer query "SELECT author, count(*) FROM messages GROUP BY author"
+
+    Args:
+        sql (str): SQL query
+        output (Path): output file, csv on stdout when not given
+        fmt (str): output format, csv or parquet
+        threads (int): number of query threads
+        memory_limit (str): memory limit of the query
+    """
+    settings = replace(querySettings, threads=threads or querySettings.threads,
+                       memory_limit=memory_limit or querySettings.memory_limit)
+    with QueryEngine(read_folders(), basicConfig, settings) as engine:
+        engine.export(sql, output, fmt)
+
+
+@main.command()
+@click.argument("measure", type=click.Choice([*MEASURES, "vocabulary", "emoji"]))
+@click.option("--by", default="author", type=click.Choice(["author", "year", "all"]), help="Group the result per author, per year or not at all")
+@click.option("--quantiles", default="0.25,0.5,0.75,0.9", help="Comma separated quantiles between 0 and 1")
+@click.option("--top", default=10, type=int, help="Number of emoji per group")
+def sketches(measure, by, quantiles, top):
+    """
+    Answers quantile and vocabulary size queries from the distribution sketches of the processed chat.
+
+    The message length (characters) and reply latency (seconds) quantiles come from t-digests,
+    the vocabulary (distinct words) from HyperLogLog sketches and the most used emoji from the
+    emoji frequencies, for example:
+    visualizer sketches latency --by year --quantiles 0.5,0.99
+    visualizer sketches emoji --by author --top 5
+
+    Args:
+        measure (str): message_length, latency, vocabulary or emoji
+        by (str): author, year or all
+        quantiles (str): comma separated quantiles
+        top (int): number of emoji per group
+    """
+    store = SketchStore(read_folders(), basicConfig)
+    if not store.path.exists():
+        logger.warning(f"No sketches in {store.path}, run the visualizer first")
+        return
+    group = None if by == "all" else by
+    if measure == "vocabulary":
+        result = store.load().vocabulary_size(group).to_frame()
+    elif measure == "emoji":
+        result = store.load().emoji_frequencies(group, top).set_index(group or "all")
+    else:
+        result = store.load().quantiles(measure, [float(q) for q in quantiles.split(',')], group)
+    print(result.to_string(float_format=lambda value: f"{value:.1f}"))
+
+
+@main.command()
+@click.argument("terms", nargs=-1, required=True)
+@click.option("--author", "authors", multiple=True, help="Only messages of this author, can be repeated")
+@click.option("--since", default=None, type=click.DateTime(formats=["%Y-%m-%d"]), help="Only messages from this day on (YYYY-MM-DD)")
+@click.option("--until", default=None, type=click.DateTime(formats=["%Y-%m-%d"]), help="Only messages up to this day (YYYY-MM-DD)")
+@click.option("--any", "any_term", is_flag=True, help="Messages with any of the terms instead of all terms")
+@click.option("--facet", default="author", type=click.Choice(["author", "year", "month"]), help="Count the matches per author, year or month")
+@click.option("--limit", default=20, type=int, help="Number of messages to show")
+def search(terms, authors, since, until, any_term, facet, limit):
+    """
+    Searches the messages of the processed chat with the full-text index.
+
+    All terms must be in a message (or any of them with --any); a term ending with * matches
+    every word starting with it, for example:
+    visualizer search pizza vanav* --author nimble-wombat --since 2020-03-01
+
+    Args:
+        terms (tuple): search terms
+        authors (tuple): only messages of these authors
+        since (datetime): first day of the messages
+        until (datetime): last day of the messages
+        any_term (bool): match any term instead of all terms
+        facet (str): author, year or month
+        limit (int): number of messages to show
+    """
+    store = IndexStore(read_folders(), basicConfig)
+    store.sync()
+    index = store.load()
+    rows = index.search(" ".join(terms), list(authors), since, until, match_all=not any_term)
+    print(f"{len(rows)} messages")
+    counts = index.facet_counts(rows, facet)
+    print(counts[counts > 0].to_string())
+    if len(rows) and limit:
+        print(store.messages(rows[-limit:]).to_string(index=False))
+
+
+@main.command()
+@click.option("--week", default="all", help="Week number to visualize for every chat: 1 to 5 or all")
+@click.option("--workers", default=None, type=int, help="Number of chats processed at the same time, defaults to the number of cores")
+@click.option("--no-cache", is_flag=True, help="Recompute all preprocessing stages")
+@click.option("--pattern", default="*", help="Only process the exports whose name matches this pattern, for example 'family-*'")
+def batch(week, workers, no_cache, pattern):
+    """
+    Processes every chat export in the raw folder in parallel, with cross-chat tables and figures.
+
+    Every .parq datafile and .txt export in the raw folder is cleaned (once), preprocessed and
+    visualized in a worker process, into processed/<chat>/ and img/<chat>/. The tables and
+    figures over all chats are written to processed/all_chats/ and img/all_chats/.
+
+    Args:
+        week (str): week to visualize for every chat, or all
+        workers (int): number of chats processed at the same time
+        no_cache (bool): Flag to disable the preprocessing stage cache.
+        pattern (str): glob pattern of the export names
+    """
+    if week not in ["all", '1', '2', '3', '4', '5']:
+        raise ValueError('Must be a number between 1 and 5 or all')
+    renderSettings.headless = True
+    folders = read_folders()
+    processor = BatchProcessor(folders.raw, folders.processed, extraRegexes, basicConfig, keywordsFilter, workers)
+    results = processor(week, not no_cache, pattern)
+    logger.info("Processed chats:\n" + results.to_string(index=False))
+
+
 if __name__ == "__main__":   
     main("2", all)
@@ -0,0 +1,16 @@
+import pandas as pd
+from wa_visualizer.emoji_engine import EmojiMatcher
+
+
+def test_text_presentation_needs_variation_selector():
+    matcher = EmojiMatcher.shared()
+    messages = pd.Series(['© 2020', 'merk™ en ®', 'ik ❤ pizza', '©️ 2020', 'ik ❤️ pizza', 'geen emoji'])
+    assert matcher.has_emoji(messages).tolist() == [False, False, False, True, True, False]
+
+
+def test_sequences_count_as_one_emoji():
+    matcher = EmojiMatcher.shared()
+    # ZWJ sequence with a skin tone, a flag, a keycap and an emoji without variation selector
+    messages = pd.Series(['👩🏽‍💻 werkt', 'naar 🇮🇹', 'nummer 1️⃣', 'haha 😂😂'])
+    assert matcher.has_emoji(messages).all()
+    assert matcher.extract(messages).tolist() == [['👩🏽‍💻'], ['🇮🇹'], ['1️⃣'], ['😂', '😂']]
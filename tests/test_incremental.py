@@ -0,0 +1,76 @@
+from pathlib import Path
+import pandas as pd
+import pytest
+from wa_visualizer.settings import (Folders, basicConfig, extraRegexes, keywordsFilter)
+from wa_visualizer.data_cleaning import DataCleaner
+from wa_visualizer.data_writer import dataWriter
+from wa_visualizer.filehandler import FileHandler
+from wa_visualizer.incremental import IncrementalProcessor
+
+AUTHORS = ['effervescent-camel', 'nimble-wombat', 'hilarious-goldfinch', 'spangled-rabbit']
+
+
+def raw_messages(start: str, rows: int) -> pd.DataFrame:
+    # one message per minute, the last two share their minute
+    timestamps = pd.date_range(start, periods=rows, freq='min')
+    timestamps = timestamps.where(timestamps != timestamps[-1], timestamps[-2])
+    return pd.DataFrame({
+        basicConfig.timestamp_col: timestamps,
+        basicConfig.author_col: [AUTHORS[i % len(AUTHORS)] for i in range(rows)],
+        basicConfig.message_col: [f'pizza bericht {i}' for i in range(rows)],
+        basicConfig.has_emoji_col: False,
+    })
+
+
+@pytest.fixture
+def folders(tmp_path: Path) -> Folders:
+    (tmp_path / 'raw').mkdir()
+    (tmp_path / 'processed').mkdir()
+    return Folders(raw=tmp_path / 'raw', processed=tmp_path / 'processed', datafile=tmp_path / 'processed' / 'chat.parq',
+                   rawdatafile=tmp_path / 'raw' / 'chat.parq', csvraw=tmp_path / 'raw' / 'chat.csv',
+                   csv=tmp_path / 'processed' / 'chat.csv')
+
+
+def stored_messages(folders: Folders) -> pd.DataFrame:
+    dataWriter.flush()
+    return FileHandler(folders, basicConfig).data
+
+
+def test_incremental_after_full_run(folders: Folders):
+    raw = raw_messages('2021-05-01 10:00', 40)
+    raw.to_parquet(folders.rawdatafile, index=False)
+    # a full run leaves the processed datafile without a watermark
+    DataCleaner(folders, extraRegexes, basicConfig, True)()
+    assert len(stored_messages(folders)) == len(raw)
+
+    # nothing new: the watermark is seeded from the store and nothing is appended
+    assert IncrementalProcessor(folders, extraRegexes, basicConfig, keywordsFilter)() == 0
+    assert len(stored_messages(folders)) == len(raw)
+
+    # new messages after the watermark are appended once
+    new = raw_messages('2021-05-02 10:00', 10)
+    pd.concat([raw, new], ignore_index=True).to_parquet(folders.rawdatafile, index=False)
+    assert IncrementalProcessor(folders, extraRegexes, basicConfig, keywordsFilter)() == len(new)
+    stored = stored_messages(folders)
+    assert len(stored) == len(raw) + len(new)
+    assert not stored.duplicated([basicConfig.timestamp_col, basicConfig.message_col]).any()
+
+    # the appended csv rows follow the header of the csv export
+    exported = pd.read_csv(folders.csv)
+    assert len(exported) == len(raw) + len(new)
+    assert pd.to_datetime(exported[basicConfig.timestamp_col]).is_monotonic_increasing
+
+
+def test_seeded_watermark_counts_removed_messages(folders: Folders):
+    # the last minute holds a system message that the cleaning removes
+    raw = raw_messages('2021-05-01 10:00', 20)
+    raw.loc[len(raw) - 2, basicConfig.author_col] = 'glittering-penguin'
+    raw.to_parquet(folders.rawdatafile, index=False)
+    DataCleaner(folders, extraRegexes, basicConfig, True)()
+    assert len(stored_messages(folders)) == len(raw) - 1
+
+    # the removed message counts as seen, so the last message is not appended again
+    assert IncrementalProcessor(folders, extraRegexes, basicConfig, keywordsFilter)() == 0
+    stored = stored_messages(folders)
+    assert len(stored) == len(raw) - 1
+    assert not stored.duplicated([basicConfig.timestamp_col, basicConfig.message_col]).any()
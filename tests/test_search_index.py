@@ -0,0 +1,79 @@
+import re
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+from wa_visualizer.settings import (Folders, basicConfig, keywordsFilter, searchSettings)
+from wa_visualizer.data_processing import Preprocessor
+from wa_visualizer.search_index import SearchIndex
+
+AUTHORS = ['effervescent-camel', 'nimble-wombat', 'hilarious-goldfinch', 'spangled-rabbit']
+WORDS = ['pizza', 'pizzeria', 'Pizza', 'PIZZA!', 'pasta', 'thuis', 'thuisbasis', 'café', 'CAFÉ', 'eten', 'heten',
+         'vanavond', 'vanavond?', '2020', '20', 'ciao', 'c.i.a.o', 'iemand@example.com', '😀', 'hoi-hoi', 'trein']
+QUERIES = ['pizza', 'pizz', 'piz', 'café', 'caf', 'eten', 'vanavond', '2020', '20', 'ciao', 'c', 'example', 'hoi', 'x']
+
+
+def synthetic_chat(rows: int, seed: int = 5) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    messages = [' '.join(rng.choice(WORDS, size=rng.integers(1, 6))) for _ in range(rows)]
+    return pd.DataFrame({
+        basicConfig.timestamp_col: pd.date_range('2020-03-01', periods=rows, freq='37min'),
+        basicConfig.author_col: rng.choice(AUTHORS, rows),
+        basicConfig.message_col: messages,
+    })
+
+
+@pytest.fixture
+def preprocessor(tmp_path: Path) -> Preprocessor:
+    folders = Folders(raw=tmp_path, processed=tmp_path, datafile=tmp_path / 'chat.parq', rawdatafile=tmp_path / 'raw.parq',
+                      csvraw=tmp_path / 'raw.csv', csv=tmp_path / 'chat.csv')
+    return Preprocessor(folders, basicConfig, keywordsFilter, load=False)
+
+
+@pytest.fixture
+def chat() -> pd.DataFrame:
+    return synthetic_chat(2000)
+
+
+@pytest.fixture
+def index(chat: pd.DataFrame) -> SearchIndex:
+    # two segments, as after an incremental run
+    index = SearchIndex(basicConfig, searchSettings)
+    half = len(chat) // 2
+    for base, part in ((0, chat.iloc[:half]), (half, chat.iloc[half:])):
+        index.add_segment(*index.build_segment(pa.Table.from_pandas(part, preserve_index=False), base))
+    return index
+
+
+def expected_rows(preprocessor: Preprocessor, chat: pd.DataFrame, pattern: str) -> np.ndarray:
+    # the keyword search the index replaces, on whole words (letters and digits)
+    found = preprocessor.contains_keywords(chat[basicConfig.message_col], [pattern])
+    return np.flatnonzero(found.to_numpy())
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_postings_match_keyword_search(preprocessor: Preprocessor, chat: pd.DataFrame, index: SearchIndex, query: str):
+    word = rf'(?<![^\W_]){re.escape(query)}(?![^\W_])'
+    np.testing.assert_array_equal(index.postings(query), expected_rows(preprocessor, chat, word))
+    prefix = rf'(?<![^\W_]){re.escape(query)}'
+    np.testing.assert_array_equal(index.postings(query, prefix=True), expected_rows(preprocessor, chat, prefix))
+
+
+def test_queries_and_compaction(preprocessor: Preprocessor, chat: pd.DataFrame, index: SearchIndex):
+    pizza = set(expected_rows(preprocessor, chat, r'(?<![^\W_])pizz'))
+    evening = set(expected_rows(preprocessor, chat, r'(?<![^\W_])vanavond(?![^\W_])'))
+    assert index.search('pizz* vanavond').tolist() == sorted(pizza & evening)
+    assert index.search('pizz* vanavond', match_all=False).tolist() == sorted(pizza | evening)
+
+    # facet filters on the author and the dates
+    authors = chat[basicConfig.author_col].to_numpy()
+    dates = chat[basicConfig.timestamp_col]
+    inside = (authors == 'nimble-wombat') & (dates >= '2020-03-10') & (dates < '2020-03-21')
+    rows = index.search('pizz*', authors=['nimble-wombat'], start='2020-03-10', end='2020-03-20')
+    assert rows.tolist() == sorted(pizza & set(np.flatnonzero(inside)))
+
+    # one merged segment answers the same
+    compacted = SearchIndex(basicConfig, searchSettings).add_segment(index.merged(), index.facets())
+    for query in QUERIES:
+        np.testing.assert_array_equal(compacted.postings(query, prefix=True), index.postings(query, prefix=True))
@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+import pytest
+from wa_visualizer.settings import (basicConfig, sketchSettings)
+from wa_visualizer.sketches import (HyperLogLog, SketchSet, TDigest)
+
+QUANTILES = [0.001, 0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99, 0.999]
+# relative error of a HyperLogLog count, three standard errors
+HLL_ERROR = 3 * 1.04 / np.sqrt(2 ** sketchSettings.precision)
+
+
+def within_rank(values: np.ndarray, estimates: np.ndarray, q: list, error: float = 0.01) -> bool:
+    # every estimate lies between the exact quantiles at q - error and q + error (also with ties)
+    q = np.asarray(q)
+    lower = np.quantile(values, np.clip(q - error, 0, 1), method='lower')
+    upper = np.quantile(values, np.clip(q + error, 0, 1), method='higher')
+    return bool(((lower <= estimates) & (estimates <= upper)).all())
+
+
+def word(number: int) -> str:
+    # words of letters only, the vocabulary splits on everything else
+    letters = ''
+    while True:
+        number, digit = divmod(number, 26)
+        letters += chr(ord('a') + digit)
+        if not number:
+            return 'w' + letters
+
+
+def synthetic_chat(rows: int, seed: int = 3) -> pd.DataFrame:
+    # message lengths are skewed like a chat: many short messages and a long tail
+    rng = np.random.default_rng(seed)
+    vocabulary = np.array([word(i) for i in range(5000)] + ['a', 'b'])
+    lengths = np.clip(rng.lognormal(1.3, 0.8, rows).astype(int), 1, 60)
+    words = rng.zipf(1.3, lengths.sum()) % len(vocabulary)
+    messages = [' '.join(vocabulary[part]) for part in np.split(words, np.cumsum(lengths)[:-1])]
+    return pd.DataFrame({
+        basicConfig.timestamp_col: pd.Timestamp('2020-01-01') + pd.to_timedelta(np.sort(rng.integers(0, 3 * 365 * 86400, rows)), unit='s'),
+        basicConfig.author_col: rng.choice(['nimble-wombat', 'spangled-rabbit', 'hilarious-goldfinch'], rows),
+        basicConfig.message_col: messages,
+    })
+
+
+@pytest.mark.parametrize('distribution', ['lognormal', 'uniform', 'integers'])
+def test_tdigest_quantile_error(distribution: str):
+    rng = np.random.default_rng(11)
+    values = {'lognormal': rng.lognormal(3, 1.2, 50_000), 'uniform': rng.uniform(-5, 5, 50_000),
+              'integers': rng.integers(1, 40, 50_000).astype(float)}[distribution]
+    digest = TDigest(sketchSettings.compression).add(values)
+    assert digest.count == len(values)
+    assert len(digest.means) <= sketchSettings.compression
+    estimates = digest.quantile(QUANTILES)
+    # the digest interpolates between centroids, integer values are estimated between two integers
+    estimates = np.round(estimates) if distribution == 'integers' else estimates
+    assert within_rank(values, estimates, QUANTILES)
+    # the extremes are exact
+    assert digest.quantile([0, 1]).tolist() == [values.min(), values.max()]
+
+
+def test_tdigest_merge():
+    rng = np.random.default_rng(12)
+    values = rng.lognormal(3, 1.2, 50_000)
+    merged = TDigest(sketchSettings.compression)
+    for chunk in np.array_split(values, 10):
+        merged.merge(TDigest(sketchSettings.compression).add(chunk))
+    assert merged.count == len(values)
+    assert within_rank(values, merged.quantile(QUANTILES), QUANTILES)
+    restored = TDigest.from_bytes(merged.to_bytes())
+    np.testing.assert_array_equal(restored.quantile(QUANTILES), merged.quantile(QUANTILES))
+
+
+@pytest.mark.parametrize('distinct', [10, 1_000, 100_000])
+def test_hyperloglog_count(distinct: int):
+    values = np.array([word(i) for i in range(distinct)] * 2, dtype=object)
+    count = HyperLogLog(sketchSettings.precision).add(values).count()
+    assert abs(count - distinct) <= HLL_ERROR * distinct
+
+
+def test_hyperloglog_merge():
+    first = np.array([word(i) for i in range(0, 60_000)], dtype=object)
+    second = np.array([word(i) for i in range(40_000, 100_000)], dtype=object)
+    merged = HyperLogLog(sketchSettings.precision).add(first).merge(HyperLogLog(sketchSettings.precision).add(second))
+    union = HyperLogLog(sketchSettings.precision).add(np.concatenate([first, second]))
+    # merging is exact: the registers of the union
+    np.testing.assert_array_equal(merged.registers, union.registers)
+    assert abs(merged.count() - 100_000) <= HLL_ERROR * 100_000
+
+
+def test_sketch_set_against_messages():
+    chat = synthetic_chat(20_000)
+    sketches = SketchSet(basicConfig, sketchSettings).add(chat)
+    lengths = chat[basicConfig.message_col].str.len()
+    quantiles = sketches.quantiles('message_length', QUANTILES, by='author')
+    for author, group in lengths.groupby(chat[basicConfig.author_col]):
+        assert quantiles.loc[author, 'count'] == len(group)
+        estimates = np.round(quantiles.loc[author, QUANTILES].to_numpy(dtype=float))
+        assert within_rank(group.to_numpy(), estimates, QUANTILES)
+
+    # words of at least min_word_length characters, split on the spaces
+    words = chat[basicConfig.message_col].str.split().explode()
+    words = words[words.str.len() >= sketchSettings.min_word_length]
+    exact = words.groupby(chat[basicConfig.author_col]).nunique()
+    vocabulary = sketches.vocabulary_size(by='author')
+    assert ((vocabulary - exact).abs() <= HLL_ERROR * exact).all()
+
+    # the sketches of two halves merge into the sketches of the whole chat
+    half = len(chat) // 2
+    merged = SketchSet(basicConfig, sketchSettings).add(chat.iloc[:half]).merge(SketchSet(basicConfig, sketchSettings).add(chat.iloc[half:]))
+    pd.testing.assert_series_equal(merged.vocabulary_size(by=None), sketches.vocabulary_size(by=None))
+    assert merged.quantiles('message_length', by=None)['count'].iat[0] == len(chat)
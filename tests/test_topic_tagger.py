@@ -0,0 +1,55 @@
+import re
+import numpy as np
+import pandas as pd
+import pytest
+from wa_visualizer.settings import (basicConfig, keywordsFilter)
+from wa_visualizer.topic_tagger import TopicTagger
+
+# author names with regex metacharacters, matched literally by the tagger
+AUTHORS = ['nimble-wombat', 'mr.bean', 'c++fan', '(anna)', 'jan|piet', 'kees?']
+
+
+def synthetic_messages(rows: int, seed: int = 7) -> pd.Series:
+    # words of all topics, stopwords and author names, in upper, lower and title case
+    rng = np.random.default_rng(seed)
+    words = [word.replace(r'\b', '') for words in keywordsFilter.topic_keywords.values() for word in words]
+    words += keywordsFilter.dutch_stopwords[:200] + keywordsFilter.italian_frequentwords + AUTHORS
+    words += ['heten', 'eten!', 'mrxbean', 'jan', 'piet', 'kee', 'thuisbasis', 'TREIN', 'Pizza']
+    messages = []
+    for _ in range(rows):
+        picked = rng.choice(words, size=rng.integers(1, 8))
+        message = ' '.join(word.upper() if rng.random() < 0.1 else word for word in picked)
+        messages.append(message if rng.random() < 0.9 else message.replace(' ', ''))
+    return pd.Series(messages + ['', 'eten', 'Eten.', 'heteneten', '😀 eten 😀'])
+
+
+def regex_topics(messages: pd.Series, keywords: dict, default_topic: str) -> pd.Series:
+    # the tagging the tagger replaces: one case-insensitive regex per topic, the first topic that matches wins
+    topics = pd.Series(default_topic, index=messages.index, dtype=object)
+    for topic, words in reversed(list(keywords.items())):
+        topics[messages.str.contains('|'.join(words), case=False, regex=True)] = topic
+    return topics
+
+
+@pytest.fixture
+def keywords() -> dict:
+    keywords = dict(keywordsFilter.topic_keywords)
+    keywords[basicConfig.people_topic] = AUTHORS + keywords[basicConfig.people_topic]
+    return keywords
+
+
+def test_tagger_matches_regex_join(keywords: dict):
+    messages = synthetic_messages(3000)
+    tagger = TopicTagger(basicConfig, keywords, basicConfig.other_topic)
+    # the author names are literal keywords, the regex needs them escaped
+    escaped = dict(keywords)
+    escaped[basicConfig.people_topic] = [re.escape(author) for author in AUTHORS] + keywordsFilter.topic_keywords[basicConfig.people_topic]
+    expected = regex_topics(messages, escaped, basicConfig.other_topic)
+    pd.testing.assert_series_equal(tagger(messages).astype(object), expected, check_names=False)
+
+
+def test_author_names_are_literal(keywords: dict):
+    tagger = TopicTagger(basicConfig, keywords, basicConfig.other_topic)
+    messages = pd.Series(['groet van MR.BEAN', 'mrxbean', 'c++fan hier', 'jan|piet', 'jan', '(anna)', 'kees? ja'])
+    people, other = basicConfig.people_topic, basicConfig.other_topic
+    assert tagger(messages).tolist() == [people, other, people, people, other, people, people]